@@ -0,0 +1,407 @@
+# bench.py
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import resource
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from speed_test_server import PayloadEngine, UdpTransmitter, SERVER_ENGINES, DEFAULT_CHUNK_SIZE
+from speed_test_client import SpeedTestClient, ServerOffer
+
+SERVER_STARTUP_DELAY = 0.2
+THREAD_SAMPLE_INTERVAL = 0.005
+
+# Suite metrics and whether a higher value is better
+SUITE_METRICS = {
+    'throughput_bps': True,
+    'cpu_seconds_per_gb': False,
+    'peak_rss_kb': False,
+    'peak_threads': False,
+    'udp_loss_percent': False,
+}
+
+
+def _legacy_send(sock: socket.socket, nbytes: int) -> int:
+    """Send nbytes the way the server did before PayloadEngine existed."""
+    bytes_sent = 0
+    while bytes_sent < nbytes:
+        current_chunk = min(8192, nbytes - bytes_sent)
+        sock.sendall(random.randbytes(current_chunk))
+        bytes_sent += current_chunk
+    return bytes_sent
+
+
+def _drain(sock: socket.socket):
+    """Read and discard everything from sock until EOF."""
+    buffer = bytearray(1024 * 1024)
+    with sock:
+        while sock.recv_into(buffer):
+            pass
+
+
+def bench_payload(send: Callable[[socket.socket, int], int], nbytes: int) -> Dict[str, float]:
+    """Measure one sender over a loopback TCP connection.
+
+    Args:
+        send (Callable): Function sending nbytes on a connected socket
+        nbytes (int): Number of bytes to send
+
+    Returns:
+        Dict[str, float]: Wall time, sender CPU time and bytes per CPU second.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = socket.create_connection(listener.getsockname())
+        receiver, _ = listener.accept()
+
+    drain_thread = threading.Thread(target=_drain, args=(receiver,))
+    drain_thread.start()
+
+    with sender:
+        sender.settimeout(2)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        sent = send(sender, nbytes)
+        cpu_time = time.thread_time() - cpu_start
+        wall_time = time.perf_counter() - wall_start
+        sender.shutdown(socket.SHUT_WR)
+    drain_thread.join()
+
+    return {
+        'bytes': sent,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'bytes_per_cpu_second': sent / cpu_time if cpu_time > 0 else float('inf'),
+    }
+
+
+def run_payload_bench(nbytes: int, chunk_size: int):
+    """Compare the legacy randbytes sender against both PayloadEngine modes."""
+    buffer_engine = PayloadEngine(chunk_size, use_sendfile=False)
+    senders = {'legacy randbytes': _legacy_send, 'buffer': buffer_engine.send}
+    sendfile_engine = None
+    try:
+        sendfile_engine = PayloadEngine(chunk_size, use_sendfile=True)
+        senders['sendfile'] = sendfile_engine.send
+    except (AttributeError, OSError):
+        pass
+
+    for name, send in senders.items():
+        result = bench_payload(send, nbytes)
+        print(f"{name:>16}: {result['bytes_per_cpu_second'] / 1e6:10.1f} MB/s per core, "
+              f"{result['bytes'] * 8 / result['wall_time'] / 1e9:6.2f} Gbit/s wall")
+
+    if sendfile_engine is not None:
+        sendfile_engine.close()
+
+
+def _legacy_udp_send(sock: socket.socket, address, file_size: int, segment_size: int) -> int:
+    """Send a UDP transfer the way the server did before UdpTransmitter existed."""
+    total_segments = (file_size + segment_size - 1) // segment_size
+    payload = b'\x00' * segment_size
+    header_base = struct.pack('!IbQ', 0xabcddcba, 0x4, total_segments)
+    for segment in range(total_segments):
+        current_chunk_size = min(segment_size, file_size - segment * segment_size)
+        sock.sendto(header_base + struct.pack('!Q', segment) + payload[:current_chunk_size], address)
+    return total_segments
+
+
+def _transmitter_udp_send(use_gso: bool):
+    def send(sock: socket.socket, address, file_size: int, segment_size: int) -> int:
+        transmitter = UdpTransmitter(0xabcddcba, 0x4, file_size, segment_size, use_gso=use_gso)
+        while not transmitter.done:
+            transmitter.send_batch(sock, address)
+        return transmitter.total_segments
+    return send
+
+
+def run_udp_bench(nbytes: int, segment_size: int):
+    """Compare datagrams per CPU second of the legacy UDP sender and UdpTransmitter.
+
+    Datagrams go to a bound loopback socket nobody reads, so only the
+    sending cost is measured.
+    """
+    senders = {
+        'legacy concat': _legacy_udp_send,
+        'batched': _transmitter_udp_send(False),
+        'batched + GSO': _transmitter_udp_send(True),
+    }
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sink:
+        sink.bind(('127.0.0.1', 0))
+        for name, send in senders.items():
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                cpu_start = time.thread_time()
+                packets = send(sock, sink.getsockname(), nbytes, segment_size)
+                cpu_time = time.thread_time() - cpu_start
+            print(f"{name:>16}: {packets / cpu_time:12.0f} packets/s per core")
+
+
+def _sample_threads(stop: threading.Event, peak: List[int]):
+    """Record the highest thread count seen until stop is set (excluding this thread)."""
+    while not stop.is_set():
+        peak[0] = max(peak[0], threading.active_count() - 1)
+        stop.wait(THREAD_SAMPLE_INTERVAL)
+
+
+def _reset_peak_rss() -> bool:
+    """Restart the kernel's record of this process's peak RSS (Linux only).
+
+    Returns:
+        bool: Whether it was reset, so _read_peak_rss_kb reads this case's peak.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _read_peak_rss_kb() -> int:
+    """Peak RSS of this process in KiB since _reset_peak_rss, from /proc/self/status."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    raise OSError("VmHWM missing from /proc/self/status")
+
+
+def run_suite_case(engine: str, file_size: int, tcp_conns: int, udp_conns: int,
+                   segment_size: Optional[int]) -> Dict[str, float]:
+    """Run one test round against an in-process server over loopback.
+
+    The server and client share the process, so CPU time and RSS cover
+    both ends of the transfer. peak_rss_kb is the peak RSS during the case
+    where the kernel lets it be reset (Linux). Elsewhere it is how far the
+    case raised the process's lifetime peak, which only isolates the case
+    when it runs in a fresh process.
+
+    Returns:
+        Dict[str, float]: Metrics named in SUITE_METRICS.
+    """
+    server = SERVER_ENGINES[engine]('bench')
+    server.logger.setLevel(logging.WARNING)
+    server.running = True
+    threading.Thread(target=server.serve, daemon=True).start()
+    time.sleep(SERVER_STARTUP_DELAY)
+
+    client = SpeedTestClient('bench', udp_segment_size=segment_size)
+    client.logger.setLevel(logging.WARNING)
+    offer = ServerOffer('127.0.0.1', server.udp_port, server.tcp_port)
+
+    peak_threads = [0]
+    stop_sampling = threading.Event()
+    sampler = threading.Thread(target=_sample_threads, args=(stop_sampling, peak_threads))
+    sampler.start()
+
+    rss_reset = _reset_peak_rss()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.perf_counter()
+    results = client.run_test(offer, file_size, tcp_conns, udp_conns)
+    wall_time = time.perf_counter() - wall_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    stop_sampling.set()
+    sampler.join()
+    server.running = False
+
+    bytes_received = sum(stats.bytes_received for stats in results)
+    udp_received = [stats.packets_received for stats in results if stats.transfer_type == "UDP"]
+    # Transfers that failed outright count as fully lost
+    udp_received += [0.0] * (udp_conns - len(udp_received))
+
+    cpu_time = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    return {
+        'throughput_bps': bytes_received * 8 / wall_time,
+        'cpu_seconds_per_gb': cpu_time / (bytes_received / 1e9) if bytes_received else float('inf'),
+        'peak_rss_kb': _read_peak_rss_kb() if rss_reset else usage_end.ru_maxrss - usage_start.ru_maxrss,
+        'peak_threads': peak_threads[0],
+        'udp_loss_percent': 100 - statistics.mean(udp_received) if udp_received else 0.0,
+    }
+
+
+def _run_case_in_child(connection, *args):
+    connection.send(run_suite_case(*args))
+    connection.close()
+
+
+def _run_isolated(*args) -> Optional[Dict[str, float]]:
+    """Run run_suite_case in a forked process where available, in-process otherwise.
+
+    Returns:
+        Optional[Dict[str, float]]: The case's metrics, or None if the child died without sending them.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return run_suite_case(*args)
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case_in_child, args=(sender,) + args)
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        print(f"Case {args} failed: child exited with code {process.exitcode}", file=sys.stderr)
+    return result
+
+
+def _case_key(case: Dict) -> Tuple:
+    return case['engine'], case['file_size'], case['tcp_conns'], case['udp_conns'], case['segment_size']
+
+
+def run_suite(engines: List[str], file_sizes: List[int], tcp_counts: List[int],
+              udp_counts: List[int], segment_sizes: List[int], repeat: int) -> Dict:
+    """Run every combination of the given parameters and return a JSON-ready report.
+
+    Each metric is the median over the runs that completed; failed_runs
+    counts the others, and a case where every run failed has no metrics.
+    """
+    cases = []
+    for engine, file_size, tcp_conns, udp_conns in itertools.product(
+            engines, file_sizes, tcp_counts, udp_counts):
+        if tcp_conns == 0 and udp_conns == 0:
+            continue
+        # Segment size only matters when there is UDP traffic
+        for segment_size in (segment_sizes if udp_conns else [None]):
+            runs = [_run_isolated(engine, file_size, tcp_conns, udp_conns, segment_size)
+                    for _ in range(repeat)]
+            runs = [run for run in runs if run is not None]
+            case = {
+                'engine': engine,
+                'file_size': file_size,
+                'tcp_conns': tcp_conns,
+                'udp_conns': udp_conns,
+                'segment_size': segment_size,
+                'failed_runs': repeat - len(runs),
+            }
+            cases.append(case)
+            label = f"{engine:>8} size={file_size} tcp={tcp_conns} udp={udp_conns} seg={segment_size}"
+            if not runs:
+                print(f"{label}: FAILED")
+                continue
+            case.update({metric: statistics.median(run[metric] for run in runs)
+                         for metric in SUITE_METRICS})
+            print(f"{label}: "
+                  f"{case['throughput_bps'] / 1e9:.2f} Gbit/s, {case['cpu_seconds_per_gb']:.2f} CPU s/GB, "
+                  f"{case['peak_rss_kb'] / 1024:.0f} MiB RSS, {case['peak_threads']} threads, "
+                  f"{case['udp_loss_percent']:.1f}% UDP loss")
+
+    return {
+        'meta': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'repeat': repeat,
+            'time': time.time(),
+        },
+        'cases': cases,
+    }
+
+
+def compare_suites(baseline: Dict, current: Dict, threshold: float,
+                   loss_threshold: float) -> List[str]:
+    """Compare two suite reports case by case.
+
+    Args:
+        baseline (Dict): Saved report to compare against
+        current (Dict): Fresh report
+        threshold (float): Allowed relative change in the bad direction, e.g. 0.1 for 10%
+        loss_threshold (float): Allowed increase of UDP loss in percentage points
+
+    Returns:
+        List[str]: One description per regression found.
+    """
+    baseline_cases = {_case_key(case): case for case in baseline['cases']}
+    regressions = []
+    for case in current['cases']:
+        old = baseline_cases.get(_case_key(case))
+        if old is None or 'throughput_bps' not in old:
+            continue
+        if 'throughput_bps' not in case:
+            regressions.append(f"{_case_key(case)} failed")
+            continue
+        for metric, higher_is_better in SUITE_METRICS.items():
+            before, after = old[metric], case[metric]
+            if metric == 'udp_loss_percent':
+                worse = after - before > loss_threshold
+            elif higher_is_better:
+                worse = after < before * (1 - threshold)
+            else:
+                worse = after > before * (1 + threshold)
+            if worse:
+                regressions.append(f"{_case_key(case)} {metric}: {before:.4g} -> {after:.4g}")
+    return regressions
+
+
+def _int_list(text: str) -> List[int]:
+    return [int(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed test server benchmarks")
+    modes = parser.add_subparsers(dest='mode', required=True)
+
+    payload_parser = modes.add_parser('payload', help="TCP payload engines")
+    payload_parser.add_argument('--bytes', type=int, default=1024 * 1024 * 1024,
+                                help="bytes to send per measurement")
+    payload_parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                                help="PayloadEngine chunk size")
+
+    udp_parser = modes.add_parser('udp', help="UDP transmit path")
+    udp_parser.add_argument('--bytes', type=int, default=1024 * 1024 * 1024,
+                            help="bytes to send per measurement")
+    udp_parser.add_argument('--segment-size', type=int, default=1400,
+                            help="UDP payload bytes per datagram")
+
+    suite_parser = modes.add_parser('suite', help="end-to-end loopback matrix")
+    suite_parser.add_argument('--engines', default='threads',
+                              help="comma separated server engines")
+    suite_parser.add_argument('--file-sizes', type=_int_list, default=[10_000_000, 100_000_000])
+    suite_parser.add_argument('--tcp', type=_int_list, default=[0, 1, 4])
+    suite_parser.add_argument('--udp', type=_int_list, default=[0, 1, 4])
+    suite_parser.add_argument('--segment-sizes', type=_int_list, default=[1400, 64000])
+    suite_parser.add_argument('--repeat', type=int, default=3)
+    suite_parser.add_argument('--output', help="write the JSON report here")
+    suite_parser.add_argument('--baseline', help="JSON report to check for regressions against")
+    suite_parser.add_argument('--threshold', type=float, default=0.1,
+                              help="allowed relative regression per metric")
+    suite_parser.add_argument('--loss-threshold', type=float, default=1.0,
+                              help="allowed UDP loss increase in percentage points")
+
+    args = parser.parse_args()
+    if args.mode == 'udp':
+        run_udp_bench(args.bytes, args.segment_size)
+    elif args.mode == 'payload':
+        run_payload_bench(args.bytes, args.chunk_size)
+    else:
+        report = run_suite(args.engines.split(','), args.file_sizes, args.tcp, args.udp,
+                           args.segment_sizes, args.repeat)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare_suites(baseline, report, args.threshold, args.loss_threshold)
+            for regression in regressions:
+                print(f"REGRESSION {regression}")
+            if regressions:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,1243 @@
 # client.py
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import signal
 import socket
+import sqlite3
 import struct
 import threading
 import time
-import logging
+import random
+import re
+import zlib
 import colorama
 from colorama import Fore, Style
-from typing import Tuple, Optional, Dict
-from dataclasses import dataclass
+from collections import deque
+from typing import Tuple, Optional, List, Dict, Deque, TextIO
+from dataclasses import dataclass, asdict, field, replace
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import pathname2url
 import queue
 
+from speed_test_common import (NACK_BITMAP_BYTES, NACK_HEADER, PAYLOAD_MODES, RELIABLE_LINGER, RESULT, TCP_PROFILES,
+                               PayloadGenerator, TcpInfoSample, TcpTuning, add_json_log, apply_tcp_tuning, check_tcp_tuning, payload_slots, read_tcp_info,
+                               setup_logger, stop_logging)
+
 # Initialize colorama for cross-platform ANSI color support
 colorama.init()
 
 
-def setup_logger(name: str, color: str) -> logging.Logger:
-    """Set up a colored logger with the specified name and color."""
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
+PAYLOAD_HEADER = struct.Struct('!IbQQI')
+TIMING_FIELD = struct.Struct('!IQ')  # transmission sequence number, send time in ns since the epoch
+SEQUENCE_MODULUS = 2 ** 32  # transmission sequence numbers wrap around at this
+TIMED_PAYLOAD_HEADER_SIZE = PAYLOAD_HEADER.size + TIMING_FIELD.size
+REQUEST_HEADER = struct.Struct('!IbQ')
+REJECT_MESSAGE = struct.Struct('!IbB')
+STOP_MESSAGE = struct.Struct('!IbI')
+READY_MESSAGE = struct.Struct('!Ib')
+OFFER_MESSAGE = struct.Struct('!IbHH')
+PROBE_MESSAGE = struct.Struct('!IbQ')
+PROBE_REPLY_MESSAGE = struct.Struct('!IbQHHI')
+REPORT_MESSAGE = struct.Struct('!IbQQ')
+REJECT_REASONS = {
+    0x1: "server busy",
+    0x2: "request too large",
+}
+UDP_RECEIVE_BUFFER_SIZE = 65535  # largest datagram
+TCP_RECEIVE_BUFFER_SIZE = 256 * 1024
+DEFAULT_UDP_RCVBUF = 4 * 1024 * 1024  # SO_RCVBUF for UDP sockets, clamped by the kernel
+DRAIN_BATCH = 64  # reads one connection may do back to back before yielding to others
+NACK_INTERVAL = 0.05  # seconds between retransmit requests of a reliable UDP transfer
+UDP_IDLE_TIMEOUT = 1.0  # seconds without a datagram after which a UDP transfer is over
+MAX_NACK_MESSAGES = 8  # NACK messages sent per interval
+_INCOMPLETE_BYTE = re.compile(b'[^\xff]')
+SAMPLE_INTERVAL = 0.1  # seconds per throughput sample
+STEADY_STATE_OMIT = 1.0  # seconds of ramp-up left out of the steady-state speed
+DURATION_GRACE = 1.0  # seconds to wait past the requested duration before stopping the server
+UPLOAD_CHUNK_SIZE = 128 * 1024  # bytes per send call of a TCP upload
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+BOTH = 'both'
+DIRECTIONS = (DOWNLOAD, UPLOAD, BOTH)
+SERVER_TTL = 3.0  # seconds a server stays cached after its last offer or probe reply
+PROBE_TIMEOUT = 0.2  # seconds to wait for probe replies
+SELECTION_STRATEGIES = ('first', 'nearest', 'least-loaded')
+FAN_OUT_WINDOW = 3.0  # seconds fan-out mode collects offers for
+DEFAULT_SEGMENT_SIZE = 64000  # server's UDP segment size when the request does not set one
+TCP_INFO_INTERVAL = 0.1  # seconds between TCP_INFO samples of a transfer
+
+
+class SegmentBitmap:
+    """Compact record of which UDP segments have arrived.
+
+    Uses one bit per segment, so memory stays at total_segments / 8 bytes
+    regardless of how much payload is transferred.
+    """
+
+    def __init__(self, total_segments: int):
+        self.total_segments = total_segments
+        self.received = 0
+        self.frontier = 0  # one past the highest segment received
+        self._bits = bytearray((total_segments + 7) // 8)
+
+    def add(self, segment: int) -> bool:
+        """Mark a segment as received.
+
+        Args:
+            segment (int): Segment index
+
+        Returns:
+            bool: True if the segment is new, False if it is a duplicate or out of range.
+        """
+        if segment >= self.total_segments:
+            return False
+        byte_index = segment >> 3
+        mask = 1 << (segment & 7)
+        if self._bits[byte_index] & mask:
+            return False
+        self._bits[byte_index] |= mask
+        self.received += 1
+        if segment >= self.frontier:
+            self.frontier = segment + 1
+        return True
+
+    @property
+    def complete(self) -> bool:
+        return 0 < self.total_segments == self.received
+
+    def first_missing(self, start: int = 0) -> int:
+        """Return the lowest segment at or after start not received yet, or total_segments if none."""
+        match = _INCOMPLETE_BYTE.search(self._bits, start >> 3)
+        while match is not None:
+            index = match.start()
+            value = self._bits[index]
+            for bit in range(8):
+                segment = index * 8 + bit
+                if segment >= start and not value & (1 << bit):
+                    return min(segment, self.total_segments)
+            match = _INCOMPLETE_BYTE.search(self._bits, index + 1)
+        return self.total_segments
+
+    def window(self, first_byte: int, nbytes: int) -> bytes:
+        """Copy nbytes of the bitmap starting at byte first_byte (segment first_byte * 8)."""
+        return bytes(self._bits[first_byte:first_byte + nbytes])
+
+    def grow(self, total_segments: int):
+        """Extend the bitmap to cover total_segments; used when the total is not known up front."""
+        if total_segments <= self.total_segments:
+            return
+        needed = (total_segments + 7) // 8
+        if needed > len(self._bits):
+            # Grow geometrically so extending one segment at a time stays cheap
+            self._bits.extend(bytes(max(needed - len(self._bits), len(self._bits))))
+        self.total_segments = total_segments
+
+    def __contains__(self, segment: int) -> bool:
+        return segment < self.total_segments and bool(self._bits[segment >> 3] & (1 << (segment & 7)))
+
+
+class ThroughputSampler:
+    """Counts bytes received per fixed interval.
+
+    Intervals are aligned to a shared monotonic epoch (time.perf_counter), so
+    samples of parallel connections started from the same epoch line up and
+    can be summed into an aggregate series.
+    """
+
+    def __init__(self, epoch: float, interval: float = SAMPLE_INTERVAL):
+        self.epoch = epoch
+        self.interval = interval
+        self.bytes_received = 0
+        self.first_byte_at: Optional[float] = None
+        self.last_byte_at: Optional[float] = None
+        self.start_index = 0
+        self.samples: List[int] = []
+        self._interval_bytes = 0
+        self._interval_end = 0.0
+
+    def add(self, nbytes: int, now: float):
+        """Record nbytes received at monotonic time now."""
+        if self.first_byte_at is None:
+            self.first_byte_at = now
+            self.start_index = int((now - self.epoch) / self.interval)
+            self._interval_end = self.epoch + (self.start_index + 1) * self.interval
+        while now >= self._interval_end:
+            # Intervals without any data are recorded as zero
+            self.samples.append(self._interval_bytes)
+            self._interval_bytes = 0
+            self._interval_end += self.interval
+        self._interval_bytes += nbytes
+        self.bytes_received += nbytes
+        self.last_byte_at = now
+
+    def finish(self) -> List[int]:
+        """Close the current interval and return all samples."""
+        if self.first_byte_at is not None:
+            self.samples.append(self._interval_bytes)
+            self._interval_bytes = 0
+        return self.samples
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    rank = max(1, math.ceil(len(sorted_values) * fraction))
+    return sorted_values[rank - 1]
+
+
+def interval_percentiles(samples: List[int], interval: float = SAMPLE_INTERVAL) -> Tuple[float, float, float]:
+    """Compute p50/p95/p99 interval throughput in bits/second.
+
+    The first and last intervals are only partly covered by the transfer, so
+    they are left out when there are enough full intervals.
+
+    Args:
+        samples (List[int]): Bytes received per interval
+        interval (float): Interval length in seconds
+
+    Returns:
+        Tuple[float, float, float]: p50, p95 and p99, or zeros if there are no samples.
+    """
+    if len(samples) > 2:
+        samples = samples[1:-1]
+    if not samples:
+        return 0.0, 0.0, 0.0
+    rates = sorted(nbytes * 8 / interval for nbytes in samples)
+    return _percentile(rates, 0.50), _percentile(rates, 0.95), _percentile(rates, 0.99)
+
+
+class PayloadVerifier:
+    """Checks received payload against the pattern the server was asked to send.
+
+    A TCP stream is the pattern repeated from the seed's offset; running
+    Adler-32 checksums of what arrived and of what should have arrived are
+    compared once the transfer is over. UDP segment N carries the payload
+    of slot N % payload_slots, so its checksum must match that slot's. Both
+    checks run in zlib's C code, so verification stays cheap enough for the
+    receive loops.
+    """
+
+    def __init__(self, generator: PayloadGenerator, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        self.generator = generator
+        self._pattern = memoryview(generator.pattern)
+        self.segment_size = segment_size
+        self.errors = 0
+        self._position = generator.offset
+        self._received = zlib.adler32(b'')
+        self._expected = zlib.adler32(b'')
+        self._slots: Dict[int, int] = {}
+        self._datagram_checksums: Dict[Tuple[int, int], int] = {}
+
+    def update(self, data):
+        """Account for the next bytes of a TCP stream."""
+        self._received = zlib.adler32(data, self._received)
+        remaining = len(data)
+        while remaining:
+            count = min(remaining, len(self._pattern) - self._position)
+            self._expected = zlib.adler32(self._pattern[self._position:self._position + count], self._expected)
+            self._position = (self._position + count) % len(self._pattern)
+            remaining -= count
+
+    def check(self, segment: int, payload, header_size: int):
+        """Check the payload of UDP segment, counting it as an error unless it is its slot's.
+
+        Args:
+            segment (int): Segment number from the datagram's header
+            payload: The datagram after its header
+            header_size (int): Header bytes of the datagram, which the slot count depends on
+        """
+        slots = self._slots.get(header_size)
+        if slots is None:
+            slots = self._slots[header_size] = payload_slots(header_size + self.segment_size)
+        key = (segment % slots, len(payload))
+        checksum = self._datagram_checksums.get(key)
+        if checksum is None:
+            offset = self.generator.datagram_offset(segment, self.segment_size, slots)
+            checksum = self._datagram_checksums[key] = zlib.adler32(self._pattern[offset:offset + len(payload)])
+        if zlib.adler32(payload) != checksum:
+            self.errors += 1
+
+    @property
+    def verified(self) -> bool:
+        """Whether everything received so far matched the pattern."""
+        return self.errors == 0 and self._received == self._expected
+
+
+class RetransmitRequester:
+    """Builds the NACK messages of a reliable UDP transfer.
+
+    Each message carries a window of the received-segment bitmap (a SACK
+    bitmap) starting at the first missing segment. While data is flowing,
+    only gaps below the highest segment seen are reported; once the server
+    has gone quiet for NACK_INTERVAL the tail up to the total is too.
+
+    A requested segment is not asked for again until its retransmission
+    had a round trip (plus one interval) to arrive: the messages mark it
+    as received meanwhile. rtt is set by the receive loop to the time from
+    the request to the first datagram; until then one interval is waited.
+    """
+
+    def __init__(self, magic_cookie: int, msg_type: int, session_id: int, segments: SegmentBitmap):
+        self.magic_cookie = magic_cookie
+        self.msg_type = msg_type
+        self.session_id = session_id
+        self.segments = segments
+        self.requested = 0
+        self.next_at = 0.0
+        self.rtt: Optional[float] = None
+        # (time, first segment, bit mask) of the segments each recent message asked for
+        self._in_flight: Deque[Tuple[float, int, int]] = deque()
+
+    @property
+    def backoff(self) -> float:
+        """Seconds before a requested segment may be requested again."""
+        return (self.rtt or 0.0) + NACK_INTERVAL
+
+    def create_messages(self, now: float, last_packet_time: float) -> List[bytes]:
+        """Build this interval's NACK messages; call once now reaches next_at.
+
+        Returns:
+            List[bytes]: Up to MAX_NACK_MESSAGES messages, empty if nothing is missing.
+        """
+        self.next_at = now + NACK_INTERVAL
+        in_flight = self._in_flight
+        expired_before = now - self.backoff
+        while in_flight and in_flight[0][0] <= expired_before:
+            in_flight.popleft()
+
+        segments = self.segments
+        end = segments.total_segments if now - last_packet_time >= NACK_INTERVAL else segments.frontier
+        messages = []
+        start = segments.first_missing()
+        while start < end and len(messages) < MAX_NACK_MESSAGES:
+            first_byte = start >> 3
+            window_end = min(end, (first_byte + NACK_BITMAP_BYTES) * 8)
+            nbytes = (window_end + 7) // 8 - first_byte
+            base = first_byte * 8
+            window_mask = (1 << (window_end - base)) - 1
+            missing = ~int.from_bytes(segments.window(first_byte, nbytes), 'little') & window_mask
+            for _, asked_base, asked in in_flight:
+                shift = asked_base - base
+                missing &= ~(asked << shift if shift >= 0 else asked >> -shift)
+            if missing:
+                self.requested += bin(missing).count('1')
+                in_flight.append((now, base, missing))
+                bitmap = (~missing & window_mask).to_bytes(nbytes, 'little')
+                messages.append(NACK_HEADER.pack(self.magic_cookie, self.msg_type, self.session_id,
+                                                 base, window_end) + bitmap)
+            start = segments.first_missing(window_end)
+        return messages
+
 
-    # Check if the logger already has handlers to prevent duplicate handlers
-    if not logger.hasHandlers():
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter(
-            f'{color}%(asctime)s - %(levelname)s - %(message)s{Style.RESET_ALL}'
+@dataclass
+class TimingStats:
+    """Data class for the delay, jitter, reordering and loss statistics of a timed UDP transfer.
+
+    Times are in seconds. Delay variation is measured against the smallest
+    transit time seen, so the clock offset between the hosts cancels out.
+    """
+    packets: int
+    jitter: float
+    delay_variation_mean: float
+    delay_variation_max: float
+    reordered_packets: int
+    max_reorder_depth: int
+    lost_packets: int
+    burst_losses: Dict[int, int]  # loss burst length -> number of bursts
+
+
+class PacketTimingAnalyzer:
+    """Incremental timing statistics for timed UDP payload messages.
+
+    Every packet is processed in O(1) and nothing is kept per packet:
+    jitter is the RFC 3550 interarrival jitter estimate, reordering depth
+    is how far a packet's sequence number lags the highest one already
+    seen, and every gap in the sequence is counted as one loss burst of its
+    length when it is detected. A late packet that fills a gap is counted
+    as reordered and removed from the lost packets, but its burst stays
+    counted. The 32-bit sequence numbers on the wire are unwrapped with
+    serial number arithmetic (RFC 1982): a number up to 2**31 ahead of the
+    highest one seen is newer, anything else is older.
+    """
+
+    def __init__(self):
+        self.packets = 0
+        self.highest = -1
+        self.reordered = 0
+        self.max_reorder_depth = 0
+        self.lost = 0
+        self.burst_losses: Dict[int, int] = {}
+        self._jitter = 0.0
+        self._prev_transit: Optional[int] = None
+        self._min_transit = 0
+        self._max_transit = 0
+        self._transit_sum = 0
+
+    def add(self, sequence: int, sent_ns: int, received_ns: int):
+        """Account for one packet.
+
+        Args:
+            sequence (int): Transmission sequence number as sent, modulo 2**32
+            sent_ns (int): Sender's wall-clock send time in nanoseconds
+            received_ns (int): Our wall-clock receive time in nanoseconds
+        """
+        transit = received_ns - sent_ns
+        if self._prev_transit is None:
+            self._min_transit = self._max_transit = transit
+        else:
+            self._jitter += (abs(transit - self._prev_transit) - self._jitter) / 16
+            if transit < self._min_transit:
+                self._min_transit = transit
+            elif transit > self._max_transit:
+                self._max_transit = transit
+        self._prev_transit = transit
+        self._transit_sum += transit
+        self.packets += 1
+
+        # highest is unwrapped; -1 before the first packet makes sequence 0 one ahead
+        ahead = (sequence - self.highest) % SEQUENCE_MODULUS
+        if ahead < SEQUENCE_MODULUS // 2:
+            sequence = self.highest + ahead
+        else:
+            sequence = self.highest - (SEQUENCE_MODULUS - ahead)
+
+        if sequence > self.highest:
+            gap = sequence - self.highest - 1
+            if gap:
+                self.lost += gap
+                self.burst_losses[gap] = self.burst_losses.get(gap, 0) + 1
+            self.highest = sequence
+        else:
+            depth = self.highest - sequence
+            self.reordered += 1
+            if depth > self.max_reorder_depth:
+                self.max_reorder_depth = depth
+            if self.lost:
+                self.lost -= 1
+
+    def result(self) -> TimingStats:
+        """Summarize the packets seen so far."""
+        mean_transit = self._transit_sum / self.packets if self.packets else 0
+        return TimingStats(
+            packets=self.packets,
+            jitter=self._jitter / 1e9,
+            delay_variation_mean=(mean_transit - self._min_transit) / 1e9 if self.packets else 0.0,
+            delay_variation_max=(self._max_transit - self._min_transit) / 1e9,
+            reordered_packets=self.reordered,
+            max_reorder_depth=self.max_reorder_depth,
+            lost_packets=self.lost,
+            burst_losses=dict(sorted(self.burst_losses.items())),
         )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
 
-    return logger
+
+class TcpInfoSampler:
+    """Samples TCP_INFO of a transfer's socket every TCP_INFO_INTERVAL.
+
+    poll only compares timestamps until the next sample is due, so the
+    receive and send loops can call it after every read or send.
+    """
+
+    def __init__(self, sock: socket.socket, epoch: float):
+        self.sock = sock
+        self.epoch = epoch
+        self.samples: List[TcpInfoSample] = []
+        self.next_at = 0.0
+
+    def poll(self, now: float):
+        """Take a sample if one is due at now."""
+        if now >= self.next_at:
+            self.sample(now)
+
+    def sample(self, now: float):
+        """Take a sample right away; call once more before the socket closes."""
+        self.next_at = now + TCP_INFO_INTERVAL
+        self.samples.append(read_tcp_info(self.sock, now - self.epoch))
+
+
+class TransferRejected(Exception):
+    """Raised when the server refuses a transfer request with a reject message."""
+
+
+def _recv_exactly(sock: socket.socket, nbytes: int) -> bytes:
+    """Receive exactly nbytes of a small control message from a stream socket.
+
+    Raises:
+        ConnectionError: If the server closes the connection first
+    """
+    data = b''
+    while len(data) < nbytes:
+        chunk = sock.recv(nbytes - len(data))
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        data += chunk
+    return data
+
+
+async def _recv_exactly_async(loop: asyncio.AbstractEventLoop, sock: socket.socket,
+                              nbytes: int, timeout: float = 2) -> bytes:
+    """Receive exactly nbytes from a non-blocking stream socket; the asyncio counterpart of _recv_exactly.
+
+    Raises:
+        ConnectionError: If the server closes the connection first
+        asyncio.TimeoutError: If nothing arrives for timeout seconds
+    """
+    data = b''
+    while len(data) < nbytes:
+        chunk = await asyncio.wait_for(loop.sock_recv(sock, nbytes - len(data)), timeout)
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        data += chunk
+    return data
+
+
+def _format_request_options(**options) -> str:
+    """Format request options as space separated key=value fields.
+
+    Options whose value is None are left out so the server applies its default.
+    """
+    return ''.join(f" {key}={value}" for key, value in options.items() if value is not None)
 
 
 @dataclass
 class TransferStats:
-    """Data class for storing transfer statistics."""
+    """Data class for storing transfer statistics.
+
+    All times are measured with time.perf_counter. Offsets are seconds since
+    the epoch of the round the transfer belonged to. speed is the goodput from
+    sending the request to the last byte received, so connection setup and the
+    UDP idle timeout are not counted. steady_speed is the mean over the full
+    sample intervals after the ramp-up. For uploads, bytes_received and speed
+    are what the server reports having received, while the samples count
+    bytes handed to the kernel by the client. completion_time (request to last
+    missing segment) and retransmission_ratio (segments requested again per
+    segment) are only set for reliable UDP transfers, and timing only for
+    UDP transfers with timestamps. payload_verified is only set when the
+    client verifies payload: whether every byte matched the requested pattern.
+    tcp_info holds the TCP_INFO samples of the client's socket of a TCP
+    transfer when the client samples them, so its sender fields only
+    describe uploads.
+    """
     transfer_type: str
     transfer_num: int
     total_time: float
     speed: float
+    direction: str = DOWNLOAD
     packets_received: Optional[float] = None
+    bytes_received: int = 0
+    connect_time: float = 0.0
+    time_to_first_byte: Optional[float] = None
+    steady_state_time: float = 0.0
+    tail_time: float = 0.0
+    first_byte_offset: Optional[float] = None
+    last_byte_offset: Optional[float] = None
+    sample_interval: float = SAMPLE_INTERVAL
+    sample_start: int = 0
+    samples: List[int] = field(default_factory=list)
+    p50_speed: float = 0.0
+    p95_speed: float = 0.0
+    p99_speed: float = 0.0
+    steady_speed: float = 0.0
+    completion_time: Optional[float] = None
+    retransmission_ratio: Optional[float] = None
+    timing: Optional[TimingStats] = None
+    payload_verified: Optional[bool] = None
+    tcp_info: List[TcpInfoSample] = field(default_factory=list)
+
+
+def _build_transfer_stats(transfer_type: str, transfer_num: int, sampler: ThroughputSampler,
+                          started: float, requested: float, finished: float,
+                          packets_received: Optional[float] = None,
+                          omit: float = STEADY_STATE_OMIT) -> TransferStats:
+    """Turn the timestamps and samples of one transfer into TransferStats.
+
+    Args:
+        transfer_type (str): "TCP" or "UDP"
+        transfer_num (int): Transfer identifier number
+        sampler (ThroughputSampler): Sampler that saw every received byte
+        started (float): When the transfer started, before connecting
+        requested (float): When the request was sent
+        finished (float): When the transfer ended, including any idle wait
+        packets_received (Optional[float]): Percentage of UDP segments received
+        omit (float): Seconds of ramp-up left out of steady_speed, if the transfer is long enough
+    """
+    samples = sampler.finish()
+    first_byte_at = sampler.first_byte_at
+    last_byte_at = sampler.last_byte_at if sampler.last_byte_at is not None else finished
+    transfer_time = last_byte_at - requested
+    speed = sampler.bytes_received * 8 / transfer_time if transfer_time > 0 else 0.0
+    p50, p95, p99 = interval_percentiles(samples, sampler.interval)
+    # The first and last intervals are partial; skip the ramp-up when enough is left
+    full_intervals = samples[1:-1]
+    steady = full_intervals[int(omit / sampler.interval):] or full_intervals
+    return TransferStats(
+        transfer_type=transfer_type,
+        transfer_num=transfer_num,
+        total_time=finished - started,
+        speed=speed,
+        packets_received=packets_received,
+        bytes_received=sampler.bytes_received,
+        connect_time=requested - started,
+        time_to_first_byte=None if first_byte_at is None else first_byte_at - requested,
+        steady_state_time=0.0 if first_byte_at is None else last_byte_at - first_byte_at,
+        tail_time=finished - last_byte_at,
+        first_byte_offset=None if first_byte_at is None else first_byte_at - sampler.epoch,
+        last_byte_offset=None if sampler.last_byte_at is None else last_byte_at - sampler.epoch,
+        sample_interval=sampler.interval,
+        sample_start=sampler.start_index,
+        samples=samples,
+        p50_speed=p50,
+        p95_speed=p95,
+        p99_speed=p99,
+        steady_speed=sum(steady) * 8 / (len(steady) * sampler.interval) if steady else speed,
+    )
+
+
+def _apply_upload_report(stats: TransferStats, bytes_received: int, receive_time: float):
+    """Replace the client-side byte count and speed of an upload with the server's report.
+
+    Args:
+        stats (TransferStats): Stats built from the client's send samples
+        bytes_received (int): Payload bytes the server received
+        receive_time (float): Seconds from the server's ready message to the last byte it received
+    """
+    stats.direction = UPLOAD
+    stats.bytes_received = bytes_received
+    stats.speed = bytes_received * 8 / receive_time if receive_time > 0 else 0.0
+
+
+def _format_tcp_info(stats: TransferStats) -> str:
+    """Summarize the TCP_INFO samples of a transfer for its report line.
+
+    Uploads show the sender's view of the path, downloads the receiver's:
+    the client only samples its own socket, and the server's sending side
+    of a download is only in the server's log.
+    """
+    last = stats.tcp_info[-1]
+    if stats.direction == UPLOAD:
+        return (f", rtt {last.rtt * 1000:.3f} ms (min {last.min_rtt * 1000:.3f} ms), "
+                f"max cwnd {max(sample.cwnd for sample in stats.tcp_info)} segments, "
+                f"retransmits {last.retransmits}, "
+                f"max delivery rate {max(sample.delivery_rate for sample in stats.tcp_info):.1f} bits/second")
+    return (f", receiver rtt {last.rcv_rtt * 1000:.3f} ms, "
+            f"max receive window {max(sample.rcv_space for sample in stats.tcp_info)} bytes")
+
+
+def aggregate_goodput(results: List[TransferStats]) -> float:
+    """Combined goodput of parallel transfers in bits/second.
+
+    Total bytes received divided by the time from the earliest first byte to
+    the latest last byte of transfers that ran in the same round.
+    """
+    active = [stats for stats in results if stats.first_byte_offset is not None]
+    if not active:
+        return 0.0
+    elapsed = max(stats.last_byte_offset for stats in active) - min(stats.first_byte_offset for stats in active)
+    total_bytes = sum(stats.bytes_received for stats in active)
+    return total_bytes * 8 / elapsed if elapsed > 0 else 0.0
+
+
+def aggregate_samples(results: List[TransferStats]) -> List[int]:
+    """Sum the interval samples of transfers from the same round.
+
+    Returns:
+        List[int]: Bytes received per interval by all transfers together,
+        starting at the first interval any of them received data in.
+    """
+    active = [stats for stats in results if stats.samples]
+    if not active:
+        return []
+    start = min(stats.sample_start for stats in active)
+    end = max(stats.sample_start + len(stats.samples) for stats in active)
+    combined = [0] * (end - start)
+    for stats in active:
+        offset = stats.sample_start - start
+        for i, nbytes in enumerate(stats.samples):
+            combined[offset + i] += nbytes
+    return combined
+
+
+@dataclass
+class ServerOffer:
+    """Data class for a server that announced itself with an offer message."""
+    address: str
+    udp_port: int
+    tcp_port: int
+
+
+@dataclass
+class KnownServer:
+    """Data class for a cached server; rtt and load come from its last probe reply."""
+    offer: ServerOffer
+    last_seen: float  # time.monotonic value of the last offer or probe reply
+    rtt: Optional[float] = None
+    load: Optional[int] = None
+
+
+@dataclass
+class FanOutResult:
+    """Data class for the test round fan-out mode ran against one server."""
+    server: ServerOffer
+    started: float  # Unix time the round started at
+    results: List[TransferStats]
+    rtt: Optional[float] = None  # probed round trip time in seconds
+    error: Optional[str] = None
+
+
+class ServerDiscovery:
+    """Keeps a cache of live servers in the background.
+
+    A daemon thread keeps the broadcast port bound and records every offer,
+    so picking a server never waits for the next broadcast once one has
+    been heard. Servers that have not been heard from for ttl seconds are
+    evicted. Known servers, and any added by hand, can be probed by
+    unicast: a probe reply refreshes the entry and measures its round trip
+    time and load.
+    """
+
+    def __init__(self, client: 'SpeedTestClient', ttl: float = SERVER_TTL,
+                 probe_timeout: float = PROBE_TIMEOUT):
+        """Create a discovery cache for client; call start to begin listening.
+
+        Args:
+            client (SpeedTestClient): Client whose broadcast port, message types and logger are used
+            ttl (float): Seconds a server stays cached after it was last heard from
+            probe_timeout (float): Seconds to wait for probe replies
+        """
+        self.client = client
+        self.ttl = ttl
+        self.probe_timeout = probe_timeout
+        self.running = False
+        self._servers: Dict[Tuple[str, int], KnownServer] = {}
+        self._static: List[ServerOffer] = []
+        self._changed = threading.Condition()
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Bind the broadcast port and start recording offers."""
+        self._sock = self.client._open_broadcast_socket()
+        # Wake up regularly to notice stop
+        self._sock.settimeout(0.5)
+        self.running = True
+        self._thread = threading.Thread(target=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop listening and release the broadcast port."""
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def add(self, offer: ServerOffer):
+        """Add a server to probe by unicast even if it never broadcasts an offer."""
+        self._static.append(offer)
+
+    def _listen(self):
+        while self.running:
+            try:
+                data, (server_addr, _) = self._sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                self.client.logger.error("Error receiving offers: %s", e)
+                continue
+            offer = self.client._parse_offer(data, server_addr)
+            if offer is not None:
+                self._update(offer)
+
+    def _update(self, offer: ServerOffer, rtt: Optional[float] = None, load: Optional[int] = None):
+        """Record that offer's server was just heard from."""
+        key = (offer.address, offer.tcp_port)
+        with self._changed:
+            known = self._servers.get(key)
+            if known is None:
+                self.client.logger.info("Received offer from %s,%s", offer.address, self.client.team_name)
+                self._servers[key] = KnownServer(offer, time.monotonic(), rtt, load)
+            else:
+                known.offer = offer
+                known.last_seen = time.monotonic()
+                if rtt is not None:
+                    known.rtt, known.load = rtt, load
+            self._changed.notify_all()
+
+    def servers(self) -> List[KnownServer]:
+        """Evict expired servers and return the live ones, in the order they were first heard."""
+        expired_before = time.monotonic() - self.ttl
+        with self._changed:
+            for key in [key for key, known in self._servers.items() if known.last_seen < expired_before]:
+                del self._servers[key]
+            return list(self._servers.values())
+
+    def wait_for_server(self, timeout: Optional[float] = None) -> bool:
+        """Block until at least one server is cached.
+
+        Returns:
+            bool: False if timeout seconds passed first.
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: bool(self._servers), timeout)
+
+    def probe(self, offers: List[ServerOffer]) -> Dict[Tuple[str, int], KnownServer]:
+        """Send one probe to each server's UDP port and wait for the replies.
+
+        Replies refresh the cache and record each server's round trip time
+        and load. Host names are resolved before probing, since replies
+        come from a numeric address; they are matched back to the name
+        they were probed by.
+
+        Returns:
+            Dict[Tuple[str, int], KnownServer]: Servers that replied within
+            probe_timeout, keyed by (address, TCP port) with the address as given in offers.
+        """
+        client = self.client
+        token = random.getrandbits(64)
+        replied: Dict[Tuple[str, int], KnownServer] = {}
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            # Resolved (IP, UDP port) -> send time and the address the server was given by
+            sent_at: Dict[Tuple[str, int], float] = {}
+            names: Dict[Tuple[str, int], str] = {}
+            for offer in offers:
+                try:
+                    destination = socket.getaddrinfo(offer.address, offer.udp_port, socket.AF_INET,
+                                                     socket.SOCK_DGRAM)[0][4]
+                    sock.sendto(PROBE_MESSAGE.pack(client.MAGIC_COOKIE, client.PROBE_MESSAGE_TYPE, token),
+                                destination)
+                    sent_at[destination] = time.perf_counter()
+                    names.setdefault(destination, offer.address)
+                except OSError as e:
+                    client.logger.warning("Could not probe %s: %s", offer.address, e)
+
+            deadline = time.perf_counter() + self.probe_timeout
+            while sent_at:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    data, source = sock.recvfrom(1024)
+                except socket.timeout:
+                    break
+                received_at = time.perf_counter()
+                if len(data) != PROBE_REPLY_MESSAGE.size or source not in sent_at:
+                    continue
+                magic_cookie, msg_type, reply_token, udp_port, tcp_port, load = PROBE_REPLY_MESSAGE.unpack(data)
+                if magic_cookie != client.MAGIC_COOKIE or msg_type != client.PROBE_REPLY_MESSAGE_TYPE or \
+                        reply_token != token:
+                    continue
+                offer = ServerOffer(names[source], udp_port, tcp_port)
+                rtt = received_at - sent_at.pop(source)
+                self._update(offer, rtt, load)
+                replied[(offer.address, tcp_port)] = KnownServer(offer, time.monotonic(), rtt, load)
+        return replied
+
+    def collect(self, window: float) -> List[KnownServer]:
+        """Gather offers for window seconds and return every server found.
+
+        Cached servers and servers added by hand are probed once at the end,
+        so the result carries round trip times; servers added by hand are
+        only returned if they replied.
+        """
+        time.sleep(window)
+        cached = {(known.offer.address, known.offer.tcp_port): known for known in self.servers()}
+        candidates = {key: known.offer for key, known in cached.items()}
+        for offer in self._static:
+            candidates.setdefault((offer.address, offer.tcp_port), offer)
+        replied = self.probe(list(candidates.values())) if candidates else {}
+        found = [replied.get(key) or cached[key] for key in candidates if key in replied or key in cached]
+        self.client.logger.info("Found %d servers in %.1f seconds", len(found), window)
+        return found
+
+    def select(self, strategy: str = 'nearest') -> ServerOffer:
+        """Pick a server to test, blocking only while none is known.
+
+        Args:
+            strategy (str): first for the live server heard first, nearest for the
+                lowest probed round trip time, least-loaded for the fewest active
+                transfers (ties broken by round trip time)
+
+        Returns:
+            ServerOffer: The chosen server.
+
+        Raises:
+            ValueError: If strategy is not one of SELECTION_STRATEGIES
+        """
+        if strategy not in SELECTION_STRATEGIES:
+            raise ValueError(f"strategy must be one of {', '.join(SELECTION_STRATEGIES)}")
+        while True:
+            cached = self.servers()
+            if strategy == 'first' and cached:
+                return cached[0].offer
+
+            candidates = {(known.offer.address, known.offer.tcp_port): known.offer for known in cached}
+            for offer in self._static:
+                candidates.setdefault((offer.address, offer.tcp_port), offer)
+            replied = list(self.probe(list(candidates.values())).values()) if candidates else []
+            if replied:
+                if strategy == 'least-loaded':
+                    best = min(replied, key=lambda known: (known.load, known.rtt))
+                else:
+                    best = min(replied, key=lambda known: known.rtt)
+                self.client.logger.info(
+                    "Selected server %s (%.2f ms, %s active transfers)",
+                    best.offer.address, best.rtt * 1000, best.load)
+                return best.offer
+            if cached:
+                # Nobody answered the probe, but offers are still arriving
+                return cached[0].offer
+            self.wait_for_server(1)
+
+
+STORE_BATCH_ROWS = 1000  # most transfers written in one transaction
+STORE_FLUSH_INTERVAL = 1.0  # seconds a stored round may wait for others to share its transaction
+STORE_COMPACT_INTERVAL = 3600.0  # seconds between retention passes
+STORE_DELETE_BATCH = 10000  # rows deleted per transaction by a retention pass
+RAW_RETENTION_DAYS = 30  # days individual transfers are kept
+HISTORY_RETENTION_DAYS = 400  # days hourly speed histograms are kept
+HISTOGRAM_BUCKETS_PER_OCTAVE = 16  # speed histogram resolution, about 4.4% per bucket
+_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    server TEXT NOT NULL,
+    protocol TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    connections INTEGER NOT NULL,
+    transfer_num INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    speed REAL NOT NULL,
+    steady_speed REAL NOT NULL,
+    p50_speed REAL NOT NULL,
+    p95_speed REAL NOT NULL,
+    p99_speed REAL NOT NULL,
+    packets_received REAL
+);
+CREATE INDEX IF NOT EXISTS transfers_by_series ON transfers (server, protocol, time);
+CREATE INDEX IF NOT EXISTS transfers_by_time ON transfers (time);
+CREATE TABLE IF NOT EXISTS speed_histogram (
+    server TEXT NOT NULL,
+    protocol TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    direction TEXT NOT NULL,
+    connections INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (server, protocol, hour, direction, connections, bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS speed_histogram_by_hour ON speed_histogram (hour);
+"""
+
+
+@dataclass
+class SpeedPercentiles:
+    """Data class for speed percentiles of the transfers in a time window.
+
+    start and end are Unix times; speeds are in bits/second and accurate to
+    one histogram bucket. The percentiles are 0 when count is 0.
+    """
+    start: float
+    end: float
+    count: int
+    p50_speed: float
+    p95_speed: float
+    p99_speed: float
+
+
+@dataclass
+class TrendComparison:
+    """Data class comparing a recent window of a series against the window before it.
+
+    change is the relative change of the p50 speed, None without baseline transfers.
+    """
+    baseline: SpeedPercentiles
+    recent: SpeedPercentiles
+    change: Optional[float]
+
+
+def _speed_bucket(speed: float) -> int:
+    """Histogram bucket of a speed in bits/second; speeds below 1 share bucket 0."""
+    return round(math.log2(max(speed, 1.0)) * HISTOGRAM_BUCKETS_PER_OCTAVE)
+
+
+def _histogram_percentiles(histogram: Dict[int, int], start: float, end: float) -> SpeedPercentiles:
+    """Nearest-rank percentiles of a bucket -> count histogram, as the buckets' speeds."""
+    count = sum(histogram.values())
+    speeds = []
+    for fraction in (0.50, 0.95, 0.99):
+        rank = max(1, math.ceil(count * fraction))
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= rank:
+                speeds.append(2 ** (bucket / HISTOGRAM_BUCKETS_PER_OCTAVE))
+                break
+        else:
+            speeds.append(0.0)
+    return SpeedPercentiles(start, end, count, *speeds)
+
+
+class ResultStore:
+    """SQLite store of transfer results, for months of history per server.
+
+    Every transfer is kept as a row for raw_retention_days, and counted
+    into an hourly histogram of speeds on a log scale per server, protocol,
+    direction and connection count, kept for history_retention_days. The
+    percentile and trend queries read only the histograms, so their cost
+    depends on the time span asked for, not on how many transfers were
+    stored.
+
+    The database runs in WAL mode, so queries from other processes do not
+    block writes. Rounds handed to add_round are written by a writer thread
+    that batches them into few transactions and runs the retention pass
+    every STORE_COMPACT_INTERVAL, so a test round never waits on the disk.
+    The first retention pass runs STORE_COMPACT_INTERVAL after opening, so
+    short runs do not pay for one.
+    """
+
+    def __init__(self, path: str, raw_retention_days: float = RAW_RETENTION_DAYS,
+                 history_retention_days: float = HISTORY_RETENTION_DAYS, read_only: bool = False):
+        """Open or create the store at path and start its writer thread.
+
+        A read_only store only answers queries: the database must already
+        exist, it is never written to and no writer thread is started.
+
+        Raises:
+            sqlite3.Error: If the database cannot be opened or is not a result store
+        """
+        self.path = path
+        self.read_only = read_only
+        self.raw_retention = raw_retention_days * 86400
+        self.history_retention = history_retention_days * 86400
+        self.logger = setup_logger('SpeedTestClient', Fore.MAGENTA)
+        self._queue: queue.Queue = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        db = self._connect()
+        try:
+            if read_only:
+                db.execute("SELECT 1 FROM speed_histogram LIMIT 1").fetchall()
+                return
+            # Only takes effect on a new database, before its first table
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            db.execute("PRAGMA journal_mode = WAL")
+            db.executescript(_STORE_SCHEMA)
+        finally:
+            db.close()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.read_only:
+            return sqlite3.connect(f"file:{pathname2url(self.path)}?mode=ro", uri=True, timeout=30)
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA synchronous = NORMAL")
+        return db
+
+    def add_round(self, server: ServerOffer, started: float, tcp_conns: int, udp_conns: int,
+                  results: List[TransferStats]):
+        """Queue the transfers of one round for writing.
+
+        Args:
+            server (ServerOffer): Server the round ran against; stored by address, since
+                its ports change whenever it restarts
+            started (float): Unix time the round started at
+            tcp_conns (int): TCP transfers per direction in the round
+            udp_conns (int): UDP transfers in the round
+            results (List[TransferStats]): Transfers that completed
+        """
+        self._queue.put([
+            (started, server.address, stats.transfer_type, stats.direction,
+             tcp_conns if stats.transfer_type == "TCP" else udp_conns, stats.transfer_num,
+             stats.bytes_received, stats.speed, stats.steady_speed, stats.p50_speed,
+             stats.p95_speed, stats.p99_speed, stats.packets_received)
+            for stats in results
+        ])
+
+    def close(self):
+        """Write every queued round and stop the writer thread."""
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        db = self._connect()
+        next_compact = time.monotonic() + STORE_COMPACT_INTERVAL
+        try:
+            running = True
+            while running:
+                rows = []
+                try:
+                    item = self._queue.get(timeout=max(0.0, next_compact - time.monotonic()))
+                    deadline = time.monotonic() + STORE_FLUSH_INTERVAL
+                    while item is not None:
+                        rows.extend(item)
+                        if len(rows) >= STORE_BATCH_ROWS:
+                            break
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    running = item is not None
+                except queue.Empty:
+                    pass
+                try:
+                    if rows:
+                        self._insert(db, rows)
+                    if time.monotonic() >= next_compact:
+                        next_compact = time.monotonic() + STORE_COMPACT_INTERVAL
+                        self._compact(db, time.time())
+                except sqlite3.Error as e:
+                    self.logger.error("Error writing results to %s: %s", self.path, e)
+        finally:
+            db.close()
+
+    def _insert(self, db: sqlite3.Connection, rows: List[tuple]):
+        """Insert transfers and count them into the histograms in one transaction."""
+        histogram: Dict[tuple, int] = {}
+        for row in rows:
+            started, server, protocol, direction, connections = row[:5]
+            key = (server, protocol, int(started // 3600), direction, connections, _speed_bucket(row[7]))
+            histogram[key] = histogram.get(key, 0) + 1
+        with db:
+            db.executemany("INSERT INTO transfers (time, server, protocol, direction, connections, "
+                           "transfer_num, bytes, speed, steady_speed, p50_speed, p95_speed, p99_speed, "
+                           "packets_received) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            db.executemany("INSERT INTO speed_histogram VALUES (?, ?, ?, ?, ?, ?, ?) "
+                           "ON CONFLICT (server, protocol, hour, direction, connections, bucket) "
+                           "DO UPDATE SET count = count + excluded.count",
+                           [key + (count,) for key, count in histogram.items()])
+
+    def _compact(self, db: sqlite3.Connection, now: float):
+        """Apply the retention policy and hand the freed pages back to the file system.
+
+        Old transfers are deleted in batches of STORE_DELETE_BATCH, so each
+        transaction stays short.
+        """
+        cutoff = now - self.raw_retention
+        while True:
+            with db:
+                deleted = db.execute("DELETE FROM transfers WHERE id IN "
+                                     "(SELECT id FROM transfers WHERE time < ? LIMIT ?)",
+                                     (cutoff, STORE_DELETE_BATCH)).rowcount
+            if deleted < STORE_DELETE_BATCH:
+                break
+        with db:
+            db.execute("DELETE FROM speed_histogram WHERE hour < ?",
+                       (int((now - self.history_retention) // 3600),))
+        db.execute("PRAGMA incremental_vacuum").fetchall()
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _load_histograms(self, server: str, protocol: str, first_hour: int, end_hour: int,
+                         direction: str, connections: Optional[int]) -> Dict[int, Dict[int, int]]:
+        """Hourly histograms (hour -> bucket -> count) of a series for the hours in [first_hour, end_hour)."""
+        query = ("SELECT hour, bucket, SUM(count) FROM speed_histogram "
+                 "WHERE server = ? AND protocol = ? AND hour >= ? AND hour < ? AND direction = ?")
+        params: list = [server, protocol, first_hour, end_hour, direction]
+        if connections is not None:
+            query += " AND connections = ?"
+            params.append(connections)
+        db = self._connect()
+        try:
+            rows = db.execute(query + " GROUP BY hour, bucket", params).fetchall()
+        finally:
+            db.close()
+        by_hour: Dict[int, Dict[int, int]] = {}
+        for hour, bucket, count in rows:
+            by_hour.setdefault(hour, {})[bucket] = count
+        return by_hour
+
+    def series(self) -> List[Tuple[str, str, str, int]]:
+        """Every (server, protocol, direction, connections) series with history in the store."""
+        db = self._connect()
+        try:
+            return db.execute("SELECT DISTINCT server, protocol, direction, connections "
+                              "FROM speed_histogram ORDER BY 1, 2, 3, 4").fetchall()
+        finally:
+            db.close()
+
+    def percentiles(self, server: str, protocol: str, start: float, end: Optional[float] = None,
+                    direction: str = DOWNLOAD, connections: Optional[int] = None) -> SpeedPercentiles:
+        """Speed percentiles of a series between the Unix times start and end (default now).
+
+        The window is widened to whole hours. connections of None covers every connection count.
+        """
+        end = time.time() if end is None else end
+        first_hour, end_hour = math.floor(start / 3600), math.ceil(end / 3600)
+        histogram: Dict[int, int] = {}
+        for buckets in self._load_histograms(server, protocol, first_hour, end_hour,
+                                             direction, connections).values():
+            for bucket, count in buckets.items():
+                histogram[bucket] = histogram.get(bucket, 0) + count
+        return _histogram_percentiles(histogram, first_hour * 3600, end_hour * 3600)
+
+    def rolling_percentiles(self, server: str, protocol: str, start: float, end: Optional[float] = None,
+                            window: float = 7 * 86400, step: float = 86400, direction: str = DOWNLOAD,
+                            connections: Optional[int] = None) -> List[SpeedPercentiles]:
+        """Speed percentiles of a series over a window sliding from start to end (default now).
+
+        One result per step, for the window seconds ending at each step
+        boundary. window and step are rounded up to whole hours.
+        """
+        end = time.time() if end is None else end
+        window_hours = max(1, math.ceil(window / 3600))
+        step_hours = max(1, math.ceil(step / 3600))
+        end_hour = math.ceil(end / 3600)
+        ends = list(range(end_hour, math.floor(start / 3600), -step_hours))[::-1] or [end_hour]
+        by_hour = self._load_histograms(server, protocol, ends[0] - window_hours, end_hour,
+                                        direction, connections)
+
+        # Slide the window hour by hour, adding the hour entering it and removing the one leaving
+        histogram: Dict[int, int] = {}
+        results = []
+        hour = ends[0] - window_hours
+        for window_end in ends:
+            while hour < window_end:
+                for bucket, count in by_hour.get(hour, {}).items():
+                    histogram[bucket] = histogram.get(bucket, 0) + count
+                for bucket, count in by_hour.get(hour - window_hours, {}).items():
+                    histogram[bucket] -= count
+                    if not histogram[bucket]:
+                        del histogram[bucket]
+                hour += 1
+            results.append(_histogram_percentiles(histogram, (window_end - window_hours) * 3600,
+                                                  window_end * 3600))
+        return results
+
+    def compare_trend(self, server: str, protocol: str, recent: float = 7 * 86400,
+                      baseline: float = 28 * 86400, now: Optional[float] = None,
+                      direction: str = DOWNLOAD, connections: Optional[int] = None) -> TrendComparison:
+        """Compare the last recent seconds of a series with the baseline seconds before them."""
+        now = time.time() if now is None else now
+        recent_stats = self.percentiles(server, protocol, now - recent, now, direction, connections)
+        baseline_stats = self.percentiles(server, protocol, recent_stats.start - baseline,
+                                          recent_stats.start, direction, connections)
+        change = None
+        if baseline_stats.count and recent_stats.count:
+            change = recent_stats.p50_speed / baseline_stats.p50_speed - 1
+        return TrendComparison(baseline_stats, recent_stats, change)
+
+
+def _validate_parameters(file_size: int, tcp_conns: int, udp_conns: int,
+                         duration: Optional[float] = None):
+    """Check test parameters.
+
+    A file size of 0 is allowed with a duration and means no size limit.
+
+    Raises:
+        ValueError: If input values are invalid
+    """
+    if file_size < 0 or tcp_conns < 0 or udp_conns < 0 or (file_size == 0 and duration is None):
+        raise ValueError("Values must be positive")
+
+    if duration is not None and not duration > 0:
+        raise ValueError("Duration must be positive")
+
+    if tcp_conns == 0 and udp_conns == 0:
+        raise ValueError("Must have at least one connection")
 
 
 def _get_user_input() -> Tuple[int, int, int]:
@@ -60,13 +1259,7 @@ def _get_user_input() -> Tuple[int, int, int]:
             file_size = int(input("Enter file size (in bytes): "))
             tcp_conns = int(input("Enter number of TCP connections: "))
             udp_conns = int(input("Enter number of UDP connections: "))
-
-            if file_size <= 0 or tcp_conns < 0 or udp_conns < 0:
-                raise ValueError("Values must be positive")
-
-            if tcp_conns == 0 and udp_conns == 0:
-                raise ValueError("Must have at least one connection")
-
+            _validate_parameters(file_size, tcp_conns, udp_conns)
             return file_size, tcp_conns, udp_conns
         except ValueError as e:
             print(f"{Fore.RED}Invalid input: {e}{Style.RESET_ALL}")
@@ -77,75 +1270,456 @@ class SpeedTestClient:
     OFFER_MESSAGE_TYPE = 0x2
     REQUEST_MESSAGE_TYPE = 0x3
     PAYLOAD_MESSAGE_TYPE = 0x4
+    REJECT_MESSAGE_TYPE = 0x5
+    STOP_MESSAGE_TYPE = 0x6
+    NACK_MESSAGE_TYPE = 0x7
+    TIMED_PAYLOAD_MESSAGE_TYPE = 0x8
+    READY_MESSAGE_TYPE = 0x9
+    REPORT_MESSAGE_TYPE = 0xa
+    PROBE_MESSAGE_TYPE = 0xb
+    PROBE_REPLY_MESSAGE_TYPE = 0xc
 
-    def __init__(self, team_name, broadcast_port: int = 13117):
+    def __init__(self, team_name, broadcast_port: int = 13117,
+                 udp_segment_size: Optional[int] = None, udp_rate: Optional[int] = None,
+                 duration: Optional[float] = None, omit: float = STEADY_STATE_OMIT,
+                 processes: int = 1, cpus: Optional[List[int]] = None,
+                 receive_buffer: Optional[int] = None, reliable_udp: bool = False,
+                 udp_timestamps: bool = False, direction: str = DOWNLOAD,
+                 selection: str = 'nearest', server_ttl: float = SERVER_TTL,
+                 payload: Optional[str] = None, payload_ratio: float = 1.0,
+                 payload_seed: Optional[int] = None, verify_payload: bool = False,
+                 tcp_tuning: Optional[TcpTuning] = None, tcp_info: bool = False,
+                 store: Optional[ResultStore] = None):
         """Initialize a new SpeedTestClient instance.
         Sets up client with statistics tracking, logging, and broadcast port
         for server discovery.
 
         Args:
         broadcast_port (int): Port to listen for server broadcasts. Defaults to 13117.
+        udp_segment_size (Optional[int]): UDP payload bytes per datagram. Defaults to the server's choice.
+        udp_rate (Optional[int]): Offered UDP load in bits/second. Defaults to unpaced.
+        duration (Optional[float]): Stream every transfer for this many seconds instead of
+            until file_size bytes arrived. Defaults to size-bounded transfers.
+        omit (float): Seconds of ramp-up left out of the steady-state speed.
+        processes (int): Worker processes to spread each round's transfers over. Defaults to 1,
+            which runs every transfer as a thread of this process.
+        cpus (Optional[List[int]]): CPUs to pin worker processes to, assigned round-robin. With a
+            single process, its transfer threads are pinned to all of them instead.
+        receive_buffer (Optional[int]): SO_RCVBUF in bytes for every transfer socket. Defaults to
+            the kernel's autotuning for TCP and DEFAULT_UDP_RCVBUF for UDP.
+        reliable_udp (bool): Ask the server to resend missing UDP segments until every one arrived.
+        udp_timestamps (bool): Ask for timed UDP payload and report delay, jitter and reordering.
+        direction (str): download, upload, or both to run an upload alongside every TCP
+            download. UDP transfers are always downloads.
+        selection (str): How to pick among discovered servers; one of SELECTION_STRATEGIES.
+        server_ttl (float): Seconds a discovered server stays eligible after its last offer.
+        payload (Optional[str]): Payload mode to ask for, one of PAYLOAD_MODES; also used for
+            uploads. Defaults to the server's payload (and random uploads).
+        payload_ratio (float): Target compression ratio of the ratio payload.
+        payload_seed (Optional[int]): Seed picking the offset into the payload pattern to ask for.
+        verify_payload (bool): Check every received byte against the pattern; picks a
+            random seed if none is given.
+        tcp_tuning (Optional[TcpTuning]): Socket options of every TCP connection; receive_buffer,
+            if given, overrides its rcvbuf. Defaults to the kernel's defaults.
+        tcp_info (bool): Sample TCP_INFO of every TCP connection into TransferStats.tcp_info
+            (Linux only).
+        store (Optional[ResultStore]): Store to record every round's transfers in.
+
+        Raises:
+            ValueError: If processes is not positive, cpus holds an unavailable CPU,
+                reliable_udp is combined with a duration, direction, selection or payload is
+                unknown, or payload_ratio is below 1
+            OSError: If the platform lacks fork, CPU affinity when cpus is given, TCP_INFO
+                when tcp_info is set, or an option of tcp_tuning
         """
+        if processes <= 0:
+            raise ValueError("processes must be positive")
+        if reliable_udp and duration is not None:
+            raise ValueError("reliable UDP transfers need a file size, not a duration")
+        if direction not in DIRECTIONS:
+            raise ValueError(f"direction must be one of {', '.join(DIRECTIONS)}")
+        if selection not in SELECTION_STRATEGIES:
+            raise ValueError(f"selection must be one of {', '.join(SELECTION_STRATEGIES)}")
+        if payload is not None and payload not in PAYLOAD_MODES:
+            raise ValueError(f"payload must be one of {', '.join(PAYLOAD_MODES)}")
+        if not 1 <= payload_ratio < float('inf'):
+            raise ValueError("payload_ratio must be at least 1")
+        if processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            raise OSError("Client worker processes need fork support")
+        if cpus and not hasattr(os, 'sched_setaffinity'):
+            raise OSError("Pinning client workers to CPUs is not supported on this platform")
+        if tcp_info and not hasattr(socket, 'TCP_INFO'):
+            raise OSError("TCP_INFO sampling is only supported on Linux")
+        if cpus and not set(cpus) <= os.sched_getaffinity(0):
+            raise ValueError(f"cpus must be among the CPUs this process may run on: "
+                             f"{sorted(os.sched_getaffinity(0))}")
         self.team_name = team_name
         self.broadcast_port = broadcast_port
+        self.udp_segment_size = udp_segment_size
+        self.udp_rate = udp_rate
+        self.duration = duration
+        self.omit = omit
+        self.processes = processes
+        self.cpus = cpus
+        self.receive_buffer = receive_buffer
+        self.reliable_udp = reliable_udp
+        self.udp_timestamps = udp_timestamps
+        self.direction = direction
+        self.selection = selection
+        self.discovery = ServerDiscovery(self, server_ttl)
+        if verify_payload and payload_seed is None:
+            payload_seed = random.getrandbits(32)
+        if payload is None and payload_seed is not None:
+            payload = 'random'
+        self.payload = payload
+        self.payload_ratio = payload_ratio
+        self.payload_seed = payload_seed
+        self.verify_payload = verify_payload
+        # Only generated for a given payload, which uploads send as well
+        self._payload_generator: Optional[PayloadGenerator] = None
+        if payload is not None:
+            self._payload_generator = PayloadGenerator(payload, payload_ratio, payload_seed)
+            upload_pattern = self._payload_generator.pattern[:UPLOAD_CHUNK_SIZE]
+        else:
+            upload_pattern = random.randbytes(UPLOAD_CHUNK_SIZE)
+        self._upload_payload = memoryview(upload_pattern)
+        self.tcp_tuning = tcp_tuning or TcpTuning()
+        self.tcp_info = tcp_info
+        self.store = store
         self.running = False
         self.logger = setup_logger('SpeedTestClient', Fore.MAGENTA)
+        for warning in check_tcp_tuning(self.tcp_tuning):
+            self.logger.warning(warning)
         self.stats_queue: queue.Queue[TransferStats] = queue.Queue()
 
+    def _check_reject(self, data, nbytes: int):
+        """Raise TransferRejected if the first nbytes of data are a reject message from the server."""
+        if nbytes < REJECT_MESSAGE.size:
+            return
+        magic_cookie, msg_type, reason = REJECT_MESSAGE.unpack_from(data)
+        if magic_cookie == self.MAGIC_COOKIE and msg_type == self.REJECT_MESSAGE_TYPE:
+            raise TransferRejected(REJECT_REASONS.get(reason, f"reason {reason}"))
+
+    def _set_receive_buffer(self, sock: socket.socket, default: Optional[int] = None):
+        """Apply the configured SO_RCVBUF to sock, or default if none is configured."""
+        size = self.receive_buffer or default
+        if size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+    def _create_tcp_socket(self) -> socket.socket:
+        """Create a TCP socket with the tuning profile and any configured SO_RCVBUF applied."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            apply_tcp_tuning(sock, self.tcp_tuning)
+            self._set_receive_buffer(sock)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _create_tcp_info_sampler(self, sock: socket.socket, epoch: float) -> Optional[TcpInfoSampler]:
+        """Create a TCP_INFO sampler for one connection, or None unless tcp_info is set."""
+        return TcpInfoSampler(sock, epoch) if self.tcp_info else None
+
+    def _payload_options(self) -> Dict[str, Optional[str]]:
+        """Request options asking for the configured payload, if any."""
+        if self.payload is None:
+            return {}
+        return {'payload': self.payload,
+                'ratio': self.payload_ratio if self.payload == 'ratio' else None,
+                'seed': self.payload_seed}
+
+    def _create_verifier(self) -> Optional[PayloadVerifier]:
+        """Create a payload verifier for one download, or None unless verify_payload is set."""
+        if not self.verify_payload:
+            return None
+        return PayloadVerifier(self._payload_generator, self.udp_segment_size or DEFAULT_SEGMENT_SIZE)
+
+    def _create_tcp_request(self, file_size: int, direction: str = DOWNLOAD) -> bytes:
+        """Create the TCP request line, with a duration option in duration mode."""
+        if direction == UPLOAD:
+            options = _format_request_options(duration=self.duration, direction=direction)
+        else:
+            options = _format_request_options(duration=self.duration, **self._payload_options())
+        return f"{file_size}{options}\n".encode()
+
+    def _check_ready(self, reply: bytes):
+        """Check the server's reply to an upload request.
+
+        Args:
+            reply (bytes): A ready message, or a complete reject message
+
+        Raises:
+            TransferRejected: If the reply is a reject message
+        """
+        self._check_reject(reply, len(reply))
+        magic_cookie, msg_type = READY_MESSAGE.unpack_from(reply)
+        if magic_cookie != self.MAGIC_COOKIE or msg_type != self.READY_MESSAGE_TYPE:
+            raise Exception("Unexpected reply to upload request")
+
+    def _is_reject_start(self, reply: bytes) -> bool:
+        """Whether the READY_MESSAGE.size bytes of reply start a reject message."""
+        return READY_MESSAGE.unpack(reply) == (self.MAGIC_COOKIE, self.REJECT_MESSAGE_TYPE)
+
+    def _parse_upload_report(self, report: bytes) -> Tuple[int, float]:
+        """Parse the report message ending an upload.
+
+        Returns:
+            Tuple[int, float]: Bytes the server received and seconds it took.
+        """
+        magic_cookie, msg_type, bytes_received, receive_ns = REPORT_MESSAGE.unpack(report)
+        if magic_cookie != self.MAGIC_COOKIE or msg_type != self.REPORT_MESSAGE_TYPE:
+            raise Exception("Received corrupted upload report")
+        return bytes_received, receive_ns / 1e9
+
+    def _create_udp_request(self, file_size: int, session_id: int) -> bytes:
+        """Create a UDP request message carrying this client's options."""
+        request = REQUEST_HEADER.pack(self.MAGIC_COOKIE,
+                                      self.REQUEST_MESSAGE_TYPE,
+                                      file_size
+                                      )
+        return request + _format_request_options(segment_size=self.udp_segment_size,
+                                                 rate=self.udp_rate,
+                                                 session=session_id,
+                                                 duration=self.duration,
+                                                 reliable=1 if self.reliable_udp else None,
+                                                 timestamps=1 if self.udp_timestamps else None,
+                                                 **self._payload_options()).encode('ascii')
+
+    def _create_stop_message(self, session_id: int) -> bytes:
+        """Create the message ending the duration transfer with session_id."""
+        return STOP_MESSAGE.pack(self.MAGIC_COOKIE, self.STOP_MESSAGE_TYPE, session_id)
+
+    def _receive_udp_packet(self, buffer, nbytes: int, now: float, session_id: int,
+                            segments: SegmentBitmap, sampler: ThroughputSampler,
+                            analyzer: Optional[PacketTimingAnalyzer] = None,
+                            verifier: Optional[PayloadVerifier] = None):
+        """Account for one datagram received by the UDP transfer with session_id.
+
+        Args:
+            buffer: Buffer holding the datagram
+            nbytes (int): Length of the datagram
+            now (float): perf_counter value when it arrived
+            session_id (int): Session ID the transfer asked for
+            segments (SegmentBitmap): Segments received so far; grown as totals become known
+            sampler (ThroughputSampler): Counts payload bytes of new segments
+            analyzer (Optional[PacketTimingAnalyzer]): Fed with the timing field of timed payload
+            verifier (Optional[PayloadVerifier]): Checks the payload of new segments
+
+        Raises:
+            TransferRejected: If the datagram is a reject message
+        """
+        self._check_reject(buffer, nbytes)
+
+        if nbytes < PAYLOAD_HEADER.size:
+            self.logger.warning("Received truncated UDP packet payout, ignoring...")
+            return
+
+        # Parse header in place
+        magic_cookie, msg_type, total_segs, current_seg, packet_session = \
+            PAYLOAD_HEADER.unpack_from(buffer)
+
+        if magic_cookie != self.MAGIC_COOKIE:
+            self.logger.warning("Received corrupted UDP packet payout, ignoring...")
+            return
+
+        if packet_session != session_id:
+            # Belongs to another session from the same server
+            return
+
+        header_size = PAYLOAD_HEADER.size
+        if msg_type == self.TIMED_PAYLOAD_MESSAGE_TYPE and nbytes >= TIMED_PAYLOAD_HEADER_SIZE:
+            header_size = TIMED_PAYLOAD_HEADER_SIZE
+            if analyzer is not None:
+                sequence, sent_ns = TIMING_FIELD.unpack_from(buffer, PAYLOAD_HEADER.size)
+                analyzer.add(sequence, sent_ns, time.time_ns())
+        elif msg_type != self.PAYLOAD_MESSAGE_TYPE:
+            self.logger.warning("Received corrupted UDP packet payout, ignoring...")
+            return
+
+        # A duration transfer has no total: it is however far the server got
+        segments.grow(total_segs or current_seg + 1)
+        if segments.add(current_seg):
+            # Only new segments count towards goodput
+            sampler.add(nbytes - header_size, now)
+            if verifier is not None:
+                verifier.check(current_seg, memoryview(buffer)[header_size:nbytes], header_size)
+
+    def _create_retransmit_requester(self, session_id: int,
+                                     segments: SegmentBitmap) -> Optional[RetransmitRequester]:
+        """Create the NACK builder of a UDP transfer, or None unless reliable_udp is set."""
+        if not self.reliable_udp:
+            return None
+        return RetransmitRequester(self.MAGIC_COOKIE, self.NACK_MESSAGE_TYPE, session_id, segments)
+
+    def _build_udp_stats(self, transfer_num: int, segments: SegmentBitmap, sampler: ThroughputSampler,
+                         started: float, requested: float, finished: float,
+                         requester: Optional[RetransmitRequester] = None,
+                         analyzer: Optional[PacketTimingAnalyzer] = None,
+                         verifier: Optional[PayloadVerifier] = None) -> TransferStats:
+        """Turn a finished UDP transfer into TransferStats."""
+        if segments.total_segments == 0:
+            raise Exception("Never received total segment count")
+
+        packets_received = (segments.received / segments.total_segments) * 100
+        stats = _build_transfer_stats("UDP", transfer_num, sampler, started,
+                                      requested, finished, packets_received, self.omit)
+        if requester is not None:
+            if segments.complete:
+                stats.completion_time = sampler.last_byte_at - requested
+            stats.retransmission_ratio = requester.requested / segments.total_segments
+        if analyzer is not None:
+            stats.timing = analyzer.result()
+        if verifier is not None:
+            stats.payload_verified = verifier.verified
+        return stats
+
     def _handle_tcp_transfer(self, server_address: str, server_port: int,
-                             file_size: int, transfer_num: int):
+                             file_size: int, transfer_num: int,
+                             stats_queue: Optional[queue.Queue] = None,
+                             epoch: Optional[float] = None):
         """Handle single TCP file transfer.
         Creates TCP connection, requests file transfer, measures speed
         and updates statistics.
         Args:
             server_address (str): Server IP address
             server_port (int): Server TCP port
-            file_size (int): Requested file size in bytes
+            file_size (int): Requested file size in bytes; 0 for no limit in duration mode
             transfer_num (int): Transfer identifier number
+            stats_queue (Optional[queue.Queue]): Where to put the result. Defaults to self.stats_queue.
+            epoch (Optional[float]): perf_counter value samples are aligned to. Defaults to the transfer start.
         """
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
+            sampler = ThroughputSampler(start_time if epoch is None else epoch)
+            limit = file_size or float('inf')
 
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            with self._create_tcp_socket() as sock:
                 # Set a timeout of 2 seconds for the connection attempt
                 sock.settimeout(2)
                 try:
                     sock.connect((server_address, server_port))
                 except socket.timeout:  # server is down although client is given "valid" server_address and server port
-                    self.logger.error(f"Connection to {server_address}:{server_port} timed out.")
+                    self.logger.error("Connection to %s:%s timed out.", server_address, server_port)
                     return
                 except socket.error as e:
-                    self.logger.error(f"Socket error during connection: {e}")
+                    self.logger.error("Socket error during connection: %s", e)
                     return
 
                 # Send file size request
-                sock.send(f"{file_size}\n".encode())
+                request_time = time.perf_counter()
+                sock.send(self._create_tcp_request(file_size))
+                # Closing the connection stops a server that overruns the duration
+                stop_at = float('inf') if self.duration is None else \
+                    request_time + self.duration + DURATION_GRACE
 
-                # Receive data
-                bytes_received = 0
-                while bytes_received < file_size:
-                    chunk = sock.recv(8192)
-                    if not chunk:
+                # Receive data into one reusable buffer
+                buffer = bytearray(TCP_RECEIVE_BUFFER_SIZE)
+                view = memoryview(buffer)
+                verifier = self._create_verifier()
+                tcp_info = self._create_tcp_info_sampler(sock, sampler.epoch)
+                nbytes = sock.recv_into(buffer)
+                self._check_reject(buffer, nbytes)
+                if nbytes:
+                    sampler.add(nbytes, time.perf_counter())
+                    if verifier is not None:
+                        verifier.update(view[:nbytes])
+                while nbytes and sampler.bytes_received < limit and sampler.last_byte_at < stop_at:
+                    nbytes = sock.recv_into(buffer)
+                    if not nbytes:
                         break
-                    bytes_received += len(chunk)
+                    now = time.perf_counter()
+                    sampler.add(nbytes, now)
+                    if verifier is not None:
+                        verifier.update(view[:nbytes])
+                    if tcp_info is not None:
+                        tcp_info.poll(now)
+                if tcp_info is not None:
+                    tcp_info.sample(time.perf_counter())
 
-            end_time = time.time()
-            total_time = end_time - start_time
-            speed = (file_size * 8) / total_time  # bits per second
+            end_time = time.perf_counter()
+            stats = _build_transfer_stats("TCP", transfer_num, sampler, start_time,
+                                          request_time, end_time, omit=self.omit)
+            if verifier is not None:
+                stats.payload_verified = verifier.verified
+            if tcp_info is not None:
+                stats.tcp_info = tcp_info.samples
+            (self.stats_queue if stats_queue is None else stats_queue).put(stats)
 
-            stats = TransferStats(
-                transfer_type="TCP",
-                transfer_num=transfer_num,
-                total_time=total_time,
-                speed=speed
-            )
-            self.stats_queue.put(stats)
+        except TransferRejected as e:
+            self.logger.warning("TCP transfer %s rejected by server: %s", transfer_num, e)
+        except Exception as e:
+            self.logger.error("Error in TCP transfer %s: %s", transfer_num, e)
+
+    def _handle_tcp_upload(self, server_address: str, server_port: int,
+                           file_size: int, transfer_num: int,
+                           stats_queue: Optional[queue.Queue] = None,
+                           epoch: Optional[float] = None):
+        """Handle single TCP upload.
 
+        Requests an upload, waits for the server's ready message, sends
+        file_size bytes (or for the duration) from the shared upload payload
+        and closes its side of the connection. The server then reports what
+        it received, which becomes the transfer's speed. Arguments are as
+        for _handle_tcp_transfer.
+        """
+        try:
+            start_time = time.perf_counter()
+            sampler = ThroughputSampler(start_time if epoch is None else epoch)
+            limit = file_size or float('inf')
+            payload = self._upload_payload
+
+            with self._create_tcp_socket() as sock:
+                sock.settimeout(2)
+                try:
+                    sock.connect((server_address, server_port))
+                except socket.timeout:
+                    self.logger.error("Connection to %s:%s timed out.", server_address, server_port)
+                    return
+                except socket.error as e:
+                    self.logger.error("Socket error during connection: %s", e)
+                    return
+
+                sock.send(self._create_tcp_request(file_size, UPLOAD))
+                reply = _recv_exactly(sock, READY_MESSAGE.size)
+                if self._is_reject_start(reply):
+                    reply += _recv_exactly(sock, REJECT_MESSAGE.size - READY_MESSAGE.size)
+                self._check_ready(reply)
+
+                request_time = time.perf_counter()
+                stop_at = float('inf') if self.duration is None else request_time + self.duration
+                tcp_info = self._create_tcp_info_sampler(sock, sampler.epoch)
+                now = request_time
+                while sampler.bytes_received < limit and now < stop_at:
+                    count = min(len(payload), limit - sampler.bytes_received)
+                    sock.sendall(payload[:count])
+                    now = time.perf_counter()
+                    sampler.add(count, now)
+                    if tcp_info is not None:
+                        tcp_info.poll(now)
+                sock.shutdown(socket.SHUT_WR)
+                bytes_received, receive_time = self._parse_upload_report(
+                    _recv_exactly(sock, REPORT_MESSAGE.size))
+                if tcp_info is not None:
+                    tcp_info.sample(time.perf_counter())
+
+            end_time = time.perf_counter()
+            stats = _build_transfer_stats("TCP", transfer_num, sampler, start_time,
+                                          request_time, end_time, omit=self.omit)
+            _apply_upload_report(stats, bytes_received, receive_time)
+            if tcp_info is not None:
+                stats.tcp_info = tcp_info.samples
+            (self.stats_queue if stats_queue is None else stats_queue).put(stats)
+
+        except TransferRejected as e:
+            self.logger.warning("TCP upload %s rejected by server: %s", transfer_num, e)
         except Exception as e:
-            self.logger.error(f"Error in TCP transfer {transfer_num}: {e}")
+            self.logger.error("Error in TCP upload %s: %s", transfer_num, e)
 
     def _handle_udp_transfer(self, server_address: str, server_port: int,
-                             file_size: int, transfer_num: int):
+                             file_size: int, transfer_num: int,
+                             stats_queue: Optional[queue.Queue] = None,
+                             epoch: Optional[float] = None):
         """Handle single UDP file transfer.
 
         Sends UDP request, receives segmented response, tracks packet loss,
@@ -154,189 +1728,1006 @@ class SpeedTestClient:
         Args:
             server_address (str): Server IP address
             server_port (int): Server UDP port
-            file_size (int): Requested file size in bytes
+            file_size (int): Requested file size in bytes; 0 for no limit in duration mode
             transfer_num (int): Transfer identifier number
+            stats_queue (Optional[queue.Queue]): Where to put the result. Defaults to self.stats_queue.
+            epoch (Optional[float]): perf_counter value samples are aligned to. Defaults to the transfer start.
         """
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
+            sampler = ThroughputSampler(start_time if epoch is None else epoch)
 
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65535)
+                self._set_receive_buffer(sock, DEFAULT_UDP_RCVBUF)
                 # Send request
-                request = struct.pack('!IbQ',
-                                      self.MAGIC_COOKIE,
-                                      self.REQUEST_MESSAGE_TYPE,
-                                      file_size
-                                      )
-                sock.sendto(request, (server_address, server_port))
+                session_id = random.getrandbits(32)
+                request_time = time.perf_counter()
+                sock.sendto(self._create_udp_request(file_size, session_id), (server_address, server_port))
+                stop_at = float('inf') if self.duration is None else \
+                    request_time + self.duration + DURATION_GRACE
 
-                # Receive data
-                received_segments: Dict[int, bytes] = {}
-                total_segments = None
-                last_packet_time = time.time()
+                # Receive data into one reusable buffer; only segment numbers are kept
+                buffer = bytearray(UDP_RECEIVE_BUFFER_SIZE)
+                segments = SegmentBitmap(0)
+                requester = self._create_retransmit_requester(session_id, segments)
+                analyzer = PacketTimingAnalyzer() if self.udp_timestamps else None
+                verifier = self._create_verifier()
+                last_packet_time = request_time
+                # A transfer still missing segments waits as long as the server lingers for requests
+                idle_timeout = UDP_IDLE_TIMEOUT if requester is None else RELIABLE_LINGER
+                # Wake up often enough to send retransmit requests on time
+                sock.settimeout(idle_timeout if requester is None else NACK_INTERVAL)
 
-                while time.time() - last_packet_time < 1:  # 1 second timeout
+                while time.perf_counter() - last_packet_time < idle_timeout and last_packet_time < stop_at:
                     try:
-                        sock.settimeout(1)
-                        data, _ = sock.recvfrom(65535)
-                        last_packet_time = time.time()
-
-                        # Parse header
-                        header_size = struct.calcsize('!IbQQ')
-                        magic_cookie, msg_type, total_segs, current_seg = \
-                            struct.unpack('!IbQQ', data[:header_size])
-
-                        if magic_cookie != self.MAGIC_COOKIE or \
-                                msg_type != self.PAYLOAD_MESSAGE_TYPE:
-                            self.logger.warning("Received corrupted UDP packet payout, ignoring...")
-                            continue
-
-                        total_segments = total_segs
-                        received_segments[current_seg] = data[header_size:]
-
+                        nbytes = sock.recv_into(buffer)
+                        now = last_packet_time = time.perf_counter()
+                        self._receive_udp_packet(buffer, nbytes, last_packet_time,
+                                                 session_id, segments, sampler, analyzer, verifier)
                     except socket.timeout:
-                        continue
+                        now = time.perf_counter()
+                    if requester is not None and segments.total_segments:
+                        if segments.complete:
+                            break
+                        if now >= requester.next_at:
+                            if requester.rtt is None:
+                                requester.rtt = sampler.first_byte_at - request_time
+                            for message in requester.create_messages(now, last_packet_time):
+                                sock.sendto(message, (server_address, server_port))
+
+                if self.duration is not None or requester is not None:
+                    # Harmless if the server already reached the deadline or gave up
+                    sock.sendto(self._create_stop_message(session_id), (server_address, server_port))
 
-            end_time = time.time()
-            total_time = end_time - start_time
+            end_time = time.perf_counter()
 
             # Calculate statistics
-            if total_segments is None:
-                raise Exception("Never received total segment count")
-
-            packets_received = (len(received_segments) / total_segments) * 100
-            speed = (file_size * 8) / total_time  # bits per second
-
-            stats = TransferStats(
-                transfer_type="UDP",
-                transfer_num=transfer_num,
-                total_time=total_time,
-                speed=speed,
-                packets_received=packets_received
-            )
-            self.stats_queue.put(stats)
+            stats = self._build_udp_stats(transfer_num, segments, sampler,
+                                          start_time, request_time, end_time, requester, analyzer,
+                                          verifier)
+            (self.stats_queue if stats_queue is None else stats_queue).put(stats)
 
+        except TransferRejected as e:
+            self.logger.warning("UDP transfer %s rejected by server: %s", transfer_num, e)
         except Exception as e:
-            self.logger.error(f"Error in UDP transfer {transfer_num}: {e}")
+            self.logger.error("Error in UDP transfer %s: %s", transfer_num, e)
 
-    def _print_transfer_stats(self):
+    def _print_transfer_stats(self, results: List[TransferStats]):
         """Print statistics for completed transfers.
         Outputs formatted statistics including:
         - Transfer type (TCP/UDP)
         - Transfer number
-        - Total time
-        - Transfer speed
+        - Total time and its phases
+        - Transfer speed, steady-state speed and p50/p95/p99 interval speed
         - Packet loss (UDP only)
+        - Aggregate goodput of all transfers, per direction when both ran
         """
-        while not self.stats_queue.empty():
-            stats = self.stats_queue.get()
-            if stats.transfer_type == "TCP":
+        for stats in results:
+            ttfb = stats.time_to_first_byte or 0.0
+            kind = "upload" if stats.direction == UPLOAD else "transfer"
+            message = (
+                f"{stats.transfer_type} {kind} #{stats.transfer_num} finished, "
+                f"total time: {stats.total_time:.2f} seconds "
+                f"(connect {stats.connect_time * 1000:.1f} ms, first byte {ttfb * 1000:.1f} ms, "
+                f"steady {stats.steady_state_time:.2f} s, tail {stats.tail_time:.2f} s), "
+                f"total speed: {stats.speed:.1f} bits/second, "
+                f"steady-state speed: {stats.steady_speed:.1f} bits/second, "
+                f"interval p50/p95/p99: {stats.p50_speed:.1f}/{stats.p95_speed:.1f}/"
+                f"{stats.p99_speed:.1f} bits/second"
+            )
+            if stats.transfer_type == "UDP":
+                message += (f", percentage of packets received successfully: "
+                            f"{stats.packets_received:.1f}%")
+            if stats.retransmission_ratio is not None:
+                completion = "incomplete" if stats.completion_time is None else \
+                    f"complete after {stats.completion_time:.2f} seconds"
+                message += (f", {completion}, retransmission ratio: "
+                            f"{stats.retransmission_ratio * 100:.1f}%")
+            if stats.timing is not None:
+                timing = stats.timing
+                message += (f", jitter: {timing.jitter * 1000:.3f} ms, delay variation mean/max: "
+                            f"{timing.delay_variation_mean * 1000:.3f}/{timing.delay_variation_max * 1000:.3f} ms, "
+                            f"reordered: {timing.reordered_packets} (max depth {timing.max_reorder_depth}), "
+                            f"loss bursts: {timing.burst_losses or 'none'}")
+            if stats.payload_verified is not None:
+                message += f", payload {'verified' if stats.payload_verified else 'CORRUPTED'}"
+            if stats.tcp_info:
+                message += _format_tcp_info(stats)
+            self.logger.info(message, extra=RESULT)
+
+        by_direction: Dict[str, List[TransferStats]] = {}
+        for stats in results:
+            by_direction.setdefault(stats.direction, []).append(stats)
+        for direction, group in by_direction.items():
+            if len(group) > 1 or len(by_direction) > 1:
+                label = "Aggregate" if len(by_direction) == 1 else f"Aggregate {direction}"
+                p50, p95, p99 = interval_percentiles(aggregate_samples(group))
                 self.logger.info(
-                    f"TCP transfer #{stats.transfer_num} finished, "
-                    f"total time: {stats.total_time:.2f} seconds, "
-                    f"total speed: {stats.speed:.1f} bits/second"
-                )
+                    "%s goodput: %.1f bits/second, interval p50/p95/p99: %.1f/%.1f/%.1f bits/second",
+                    label, aggregate_goodput(group), p50, p95, p99, extra=RESULT)
+
+    def _print_fan_out_matrix(self, surveyed: List[FanOutResult]):
+        """Print one row per server: probed RTT, aggregate TCP and UDP goodput in Mbit/s and UDP loss."""
+        print(f"{Fore.CYAN}{'server':<28}{'rtt ms':>9}{'tcp down':>12}{'tcp up':>12}"
+              f"{'udp':>12}{'udp loss %':>12}{Style.RESET_ALL}")
+        for entry in surveyed:
+            name = f"{entry.server.address}:{entry.server.tcp_port}"
+            rtt = "-" if entry.rtt is None else f"{entry.rtt * 1000:.2f}"
+            if entry.error is not None:
+                print(f"{name:<28}{rtt:>9}  {Fore.RED}failed: {entry.error}{Style.RESET_ALL}")
+                continue
+            tcp = [stats for stats in entry.results if stats.transfer_type == "TCP"]
+            tcp_down = [stats for stats in tcp if stats.direction == DOWNLOAD]
+            tcp_up = [stats for stats in tcp if stats.direction == UPLOAD]
+            udp = [stats for stats in entry.results if stats.transfer_type == "UDP"]
+            columns = [f"{aggregate_goodput(group) / 1e6:.1f}" if group else "-"
+                       for group in (tcp_down, tcp_up, udp)]
+            loss = f"{100 - sum(stats.packets_received for stats in udp) / len(udp):.2f}" if udp else "-"
+            print(f"{name:<28}{rtt:>9}{columns[0]:>12}{columns[1]:>12}{columns[2]:>12}{loss:>12}")
+
+    def run_test(self, server: ServerOffer, file_size: int, tcp_conns: int,
+                 udp_conns: int) -> List[TransferStats]:
+        """Run one test round against server.
+
+        Starts all TCP and UDP transfers concurrently and waits for them.
+        TCP transfers go in the client's direction; with both, every TCP
+        download has an upload with the same number running alongside it.
+        With more than one process they are dealt round-robin across forked
+        worker processes, so receive loops do not share one GIL. With one
+        process and cpus set, the calling thread and the transfer threads are
+        pinned to all of cpus.
+
+        Args:
+            server (ServerOffer): Server to test against
+            file_size (int): Requested file size in bytes per transfer; 0 for no limit in duration mode
+            tcp_conns (int): Number of TCP transfers
+            udp_conns (int): Number of UDP transfers
+
+        Returns:
+            List[TransferStats]: Statistics of every transfer that completed.
+
+        Raises:
+            ValueError: If the parameters are invalid
+        """
+        _validate_parameters(file_size, tcp_conns, udp_conns, self.duration)
+        # Shared by all transfers so their samples line up, across processes too
+        epoch = time.perf_counter()
+        tcp_directions = [DOWNLOAD, UPLOAD] if self.direction == BOTH else [self.direction]
+        transfers = [("TCP", i + 1, direction) for i in range(tcp_conns) for direction in tcp_directions] + \
+                    [("UDP", i + 1, DOWNLOAD) for i in range(udp_conns)]
+
+        if self.processes > 1:
+            return self._run_in_processes(server, file_size, transfers, epoch)
+        if self.cpus:
+            # Pins the calling thread; the transfer threads it starts inherit the affinity
+            os.sched_setaffinity(0, self.cpus)
+        return self._run_transfers(server, file_size, transfers, epoch)
+
+    def _run_transfers(self, server: ServerOffer, file_size: int,
+                       transfers: List[Tuple[str, int, str]], epoch: float) -> List[TransferStats]:
+        """Run transfers, given as (protocol, transfer number, direction) triples, as threads of this process."""
+        results: queue.Queue = queue.Queue()
+
+        # Start transfer threads
+        threads = []
+        for transfer_type, transfer_num, direction in transfers:
+            if transfer_type == "TCP" and direction == UPLOAD:
+                target, port = self._handle_tcp_upload, server.tcp_port
+            elif transfer_type == "TCP":
+                target, port = self._handle_tcp_transfer, server.tcp_port
             else:
-                self.logger.info(
-                    f"UDP transfer #{stats.transfer_num} finished, "
-                    f"total time: {stats.total_time:.2f} seconds, "
-                    f"total speed: {stats.speed:.1f} bits/second, "
-                    f"percentage of packets received successfully: "
-                    f"{stats.packets_received:.1f}%"
-                )
+                target, port = self._handle_udp_transfer, server.udp_port
+            thread = threading.Thread(
+                target=target,
+                args=(server.address, port, file_size, transfer_num, results, epoch)
+            )
+            thread.start()
+            threads.append(thread)
+
+        # Wait for all transfers to complete
+        for thread in threads:
+            thread.join()
+
+        return [results.get() for _ in range(results.qsize())]
+
+    def _run_in_processes(self, server: ServerOffer, file_size: int,
+                          transfers: List[Tuple[str, int, str]], epoch: float) -> List[TransferStats]:
+        """Fork worker processes that each run a share of transfers, and gather their stats."""
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes: List[multiprocessing.Process] = []
+        for worker_id in range(min(self.processes, len(transfers))):
+            cpu = self.cpus[worker_id % len(self.cpus)] if self.cpus else None
+            process = context.Process(
+                target=_run_client_worker,
+                args=(self, worker_id, cpu, server, file_size,
+                      transfers[worker_id::self.processes], epoch, results))
+            process.start()
+            processes.append(process)
+
+        collected: Dict[int, List[TransferStats]] = {}
+        try:
+            while len(collected) < len(processes):
+                try:
+                    worker_id, stats = results.get(timeout=1)
+                    collected[worker_id] = stats
+                except queue.Empty:
+                    if not any(process.is_alive() for process in processes):
+                        self.logger.error("A client worker process exited without reporting")
+                        break
+        finally:
+            for process in processes:
+                if process.is_alive() and len(collected) < len(processes):
+                    process.terminate()
+                process.join()
+
+        return [stats for worker_id in sorted(collected) for stats in collected[worker_id]]
+
+    def _open_broadcast_socket(self) -> socket.socket:
+        """Bind a UDP socket to the broadcast port to receive server offers."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:  # for linux os
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', self.broadcast_port))  # client listen on port 13117 for broadcast messages
+        except Exception as ignore:  # for windows os
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', self.broadcast_port))
+        return sock
+
+    def _parse_offer(self, data: bytes, server_addr: str) -> Optional[ServerOffer]:
+        """Parse an offer message from server_addr, or return None if it is not one."""
+        try:
+            magic_cookie, msg_type, udp_port, tcp_port = OFFER_MESSAGE.unpack(data)
+        except struct.error:
+            self.logger.error("Received malformed offer message")
+            return None
+
+        if magic_cookie != self.MAGIC_COOKIE or \
+                msg_type != self.OFFER_MESSAGE_TYPE:
+            self.logger.warning("Received corrupted UDP offer packet, ignoring...")
+            return None
+        return ServerOffer(server_addr, udp_port, tcp_port)
+
+    def wait_for_offer(self, sock: socket.socket) -> ServerOffer:
+        """Block until a valid offer arrives on the broadcast socket.
+
+        Args:
+            sock (socket.socket): Socket returned by _open_broadcast_socket
+
+        Returns:
+            ServerOffer: The server that sent the offer.
+        """
+        while True:
+            data, (server_addr, _) = sock.recvfrom(1024)
+            offer = self._parse_offer(data, server_addr)
+            if offer is not None:
+                self.logger.info("Received offer from %s,%s", server_addr, self.team_name)
+                return offer
+
+    def run_batch(self, file_size: int, tcp_conns: int, udp_conns: int,
+                  repeat: int, output: Optional[TextIO] = None,
+                  server: Optional[ServerOffer] = None, interval: float = 0):
+        """Run test rounds back to back without prompting.
+
+        Picks a discovered server once (unless one is given), with the
+        client's selection strategy, and reuses it for every round. Each round is logged and, if output is given, written to it as
+        one JSON line.
+
+        Args:
+            file_size (int): Requested file size in bytes per transfer
+            tcp_conns (int): Number of TCP transfers per round
+            udp_conns (int): Number of UDP transfers per round
+            repeat (int): Number of rounds; 0 runs until interrupted
+            output (Optional[TextIO]): JSONL sink for round results
+            server (Optional[ServerOffer]): Server to test; discovered from offers if None
+            interval (float): Seconds to pause between rounds
+        """
+        _validate_parameters(file_size, tcp_conns, udp_conns, self.duration)
+        self.running = True
+        if server is None:
+            self.logger.info("Client started, listening for offer requests...")
+            self.discovery.start()
+            try:
+                server = self.discovery.select(self.selection)
+            finally:
+                self.discovery.stop()
+
+        round_num = 0
+        try:
+            while self.running and (repeat == 0 or round_num < repeat):
+                round_num += 1
+                started = time.time()
+                results = self.run_test(server, file_size, tcp_conns, udp_conns)
+                self._print_transfer_stats(results)
+                if self.store is not None:
+                    self.store.add_round(server, started, tcp_conns, udp_conns, results)
+
+                if output is not None:
+                    downloads = [stats for stats in results if stats.direction == DOWNLOAD]
+                    uploads = [stats for stats in results if stats.direction == UPLOAD]
+                    output.write(json.dumps({
+                        'round': round_num,
+                        'timestamp': started,
+                        'team_name': self.team_name,
+                        'server': asdict(server),
+                        'file_size': file_size,
+                        'duration': self.duration,
+                        'tcp_conns': tcp_conns,
+                        'udp_conns': udp_conns,
+                        'direction': self.direction,
+                        'aggregate_goodput': aggregate_goodput(results),
+                        'aggregate_samples': aggregate_samples(results),
+                        'download_goodput': aggregate_goodput(downloads),
+                        'download_samples': aggregate_samples(downloads),
+                        'upload_goodput': aggregate_goodput(uploads),
+                        'upload_samples': aggregate_samples(uploads),
+                        'transfers': [asdict(stats) for stats in results],
+                    }) + '\n')
+                    output.flush()
+
+                if interval:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+
+    def run_fan_out(self, file_size: int, tcp_conns: int, udp_conns: int,
+                    window: float = FAN_OUT_WINDOW, concurrency: int = 0,
+                    output: Optional[TextIO] = None) -> List[FanOutResult]:
+        """Test every server offering within window seconds, several at a time.
+
+        Collects offers (and probes servers added to discovery by hand) for
+        window seconds, then runs one test round against each server found
+        on a pool of concurrency threads, so surveying N servers takes about
+        as long as testing one when the links are not shared. The rounds are
+        printed as one matrix and, if output is given, written to it as one
+        JSON line.
+
+        Args:
+            file_size (int): Requested file size in bytes per transfer
+            tcp_conns (int): Number of TCP transfers per server
+            udp_conns (int): Number of UDP transfers per server
+            window (float): Seconds to collect offers for
+            concurrency (int): Servers tested at once; 0 tests every server at once
+            output (Optional[TextIO]): JSONL sink for the survey
+
+        Returns:
+            List[FanOutResult]: One entry per server found, in the order they were heard.
+
+        Raises:
+            ValueError: If the parameters are invalid, concurrency is negative or the client
+                uses worker processes, which would be forked from several pool threads at once
+        """
+        _validate_parameters(file_size, tcp_conns, udp_conns, self.duration)
+        if concurrency < 0:
+            raise ValueError("Concurrency must not be negative")
+        if self.processes > 1:
+            raise ValueError("Fan-out mode runs with a single process")
+        self.running = True
+        self.logger.info("Client started, collecting offers for %.1f seconds...", window)
+        self.discovery.start()
+        try:
+            found = self.discovery.collect(window)
+        finally:
+            self.discovery.stop()
+        if not found:
+            self.logger.warning("No servers found")
+            self.running = False
+            return []
+
+        def test_server(known: KnownServer) -> FanOutResult:
+            started = time.time()
+            try:
+                results = self.run_test(known.offer, file_size, tcp_conns, udp_conns)
+            except Exception as e:
+                self.logger.error("Error testing %s: %s", known.offer.address, e)
+                return FanOutResult(known.offer, started, [], known.rtt, str(e))
+            if self.store is not None:
+                self.store.add_round(known.offer, started, tcp_conns, udp_conns, results)
+            return FanOutResult(known.offer, started, results, known.rtt)
+
+        pool = ThreadPoolExecutor(max_workers=concurrency or len(found))
+        try:
+            surveyed = list(pool.map(test_server, found))
+        finally:
+            # On an interrupt, servers not yet started are skipped
+            pool.shutdown(cancel_futures=True)
+            self.running = False
+
+        self._print_fan_out_matrix(surveyed)
+        if output is not None:
+            output.write(json.dumps({
+                'timestamp': surveyed[0].started,
+                'team_name': self.team_name,
+                'file_size': file_size,
+                'duration': self.duration,
+                'tcp_conns': tcp_conns,
+                'udp_conns': udp_conns,
+                'direction': self.direction,
+                'concurrency': concurrency or len(found),
+                'servers': [{
+                    'server': asdict(entry.server),
+                    'timestamp': entry.started,
+                    'rtt': entry.rtt,
+                    'error': entry.error,
+                    'transfers': [asdict(stats) for stats in entry.results],
+                } for entry in surveyed],
+            }) + '\n')
+            output.flush()
+        return surveyed
 
     def start(self):
         """Start the speed test client.
         Main client loop that:
         1. Gets user parameters
-        2. Listens for server offers
+        2. Picks a server from those discovered in the background
         3. Initiates concurrent transfers
         4. Reports results
-        5. Returns to listening state
-        Runs until interrupted.
+        5. Returns to step 1
+        Runs until interrupted. Offers are collected for the whole session,
+        so a round only waits for one when no live server is known yet.
         """
         self.running = True
         self.logger.info("Client started, listening for offer requests...")
+        self.discovery.start()
+        try:
+            self._run_interactive()
+        finally:
+            self.discovery.stop()
+            self.running = False
+
+    def _run_interactive(self):
         while self.running:
             try:
                 # Get user parameters
                 # start up phase
                 file_size, tcp_conns, udp_conns = _get_user_input()
 
-                # Listen for server offers
-                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-                    try:  # for linux os
-                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-                        sock.bind(('', self.broadcast_port))  # client listen on port 13117 for broadcast messages
-                    except Exception as ignore:  # for windows os
-                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                        sock.bind(('', self.broadcast_port))
+                server = self.discovery.select(self.selection)
 
-                    while self.running:
-                        data, (server_addr, _) = sock.recvfrom(1024)
+                started = time.time()
+                results = self.run_test(server, file_size, tcp_conns, udp_conns)
 
-                        # Parse offer message
-                        try:
-                            magic_cookie, msg_type, udp_port, tcp_port = \
-                                struct.unpack('!IbHH', data)
-
-                            if magic_cookie != self.MAGIC_COOKIE or \
-                                    msg_type != self.OFFER_MESSAGE_TYPE:
-                                self.logger.warning("Received corrupted UDP offer packet, ignoring...")
-                                continue
-
-                            self.logger.info(f"Received offer from {server_addr},{self.team_name}")
-
-                            # Start transfer threads
-                            threads = []
-
-                            # Start TCP transfers
-                            for i in range(tcp_conns):
-                                thread = threading.Thread(
-                                    target=self._handle_tcp_transfer,
-                                    args=(server_addr, tcp_port, file_size, i + 1)
-                                )
-                                thread.start()
-                                threads.append(thread)
-
-                            # Start UDP transfers
-                            for i in range(udp_conns):
-                                thread = threading.Thread(
-                                    target=self._handle_udp_transfer,
-                                    args=(server_addr, udp_port, file_size, i + 1)
-                                )
-                                thread.start()
-                                threads.append(thread)
-
-                            # Wait for all transfers to complete
-                            for thread in threads:
-                                thread.join()
-
-                            # Print transfer statistics
-                            self._print_transfer_stats()
-
-                            self.logger.info(
-                                "All transfers complete, listening to offer requests"
-                            )
-                            break
+                # Print transfer statistics
+                self._print_transfer_stats(results)
+                if self.store is not None:
+                    self.store.add_round(server, started, tcp_conns, udp_conns, results)
 
-                        except struct.error:
-                            self.logger.error("Received malformed offer message")
-                            continue
-                        except Exception as e:
-                            self.logger.error(f"Error handling offer: {e}")
-                            continue
+                self.logger.info(
+                    "All transfers complete, ready for the next round"
+                )
 
             except KeyboardInterrupt:
                 break
 
             except Exception as e:
-                self.logger.error(f"Error in client main loop: {e}")
+                self.logger.error("Error in client main loop: %s", e)
+
+
+class _ReadWaiter:
+    """Lets a coroutine wait for a non-blocking socket to become readable.
+
+    The reader stays registered with the event loop for the whole transfer,
+    so waiting costs no epoll_ctl calls.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, sock: socket.socket):
+        self._loop = loop
+        self._fd = sock.fileno()
+        self._future: Optional[asyncio.Future] = None
+        loop.add_reader(self._fd, self._wake)
+
+    def _wake(self):
+        if self._future is not None and not self._future.done():
+            self._future.set_result(None)
+
+    def _expire(self):
+        if self._future is not None and not self._future.done():
+            self._future.set_exception(socket.timeout("timed out"))
+
+    async def wait(self, timeout: float):
+        """Wait until the socket has data queued.
+
+        Raises:
+            socket.timeout: If nothing arrives within timeout seconds
+        """
+        self._future = self._loop.create_future()
+        timer = self._loop.call_later(timeout, self._expire)
+        try:
+            await self._future
+        finally:
+            timer.cancel()
+            self._future = None
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+
+
+class AsyncSpeedTestClient(SpeedTestClient):
+    """Speed test client running every transfer of a round on one asyncio event loop.
+
+    Speaks the same wire protocol as SpeedTestClient, but sockets are
+    non-blocking and a readable connection is drained with recv_into until
+    the kernel has nothing queued (up to DRAIN_BATCH reads before other
+    connections get a turn). The loop's TCP transfers share one receive
+    buffer and its UDP transfers another, so hundreds of connections need
+    one thread and no allocation per read.
+    """
+
+    def _run_transfers(self, server: ServerOffer, file_size: int,
+                       transfers: List[Tuple[str, int, str]], epoch: float) -> List[TransferStats]:
+        """Run transfers, given as (protocol, transfer number, direction) triples, on a new event loop."""
+        return asyncio.run(self._run_transfers_async(server, file_size, transfers, epoch))
+
+    async def _run_transfers_async(self, server: ServerOffer, file_size: int,
+                                   transfers: List[Tuple[str, int, str]], epoch: float) -> List[TransferStats]:
+        tcp_buffer = bytearray(TCP_RECEIVE_BUFFER_SIZE)
+        udp_buffer = bytearray(UDP_RECEIVE_BUFFER_SIZE)
+        coroutines = []
+        for transfer_type, transfer_num, direction in transfers:
+            if transfer_type == "TCP" and direction == UPLOAD:
+                coroutines.append(self._tcp_upload(server.address, server.tcp_port, file_size,
+                                                   transfer_num, epoch))
+            elif transfer_type == "TCP":
+                coroutines.append(self._tcp_transfer(server.address, server.tcp_port, file_size,
+                                                     transfer_num, epoch, tcp_buffer))
+            else:
+                coroutines.append(self._udp_transfer(server.address, server.udp_port, file_size,
+                                                     transfer_num, epoch, udp_buffer))
+        results = await asyncio.gather(*coroutines)
+        return [stats for stats in results if stats is not None]
+
+    async def _tcp_transfer(self, server_address: str, server_port: int, file_size: int,
+                            transfer_num: int, epoch: float, buffer: bytearray) -> Optional[TransferStats]:
+        """Handle single TCP file transfer; the asyncio counterpart of _handle_tcp_transfer."""
+        loop = asyncio.get_running_loop()
+        try:
+            start_time = time.perf_counter()
+            sampler = ThroughputSampler(epoch)
+            limit = file_size or float('inf')
+
+            with self._create_tcp_socket() as sock:
+                sock.setblocking(False)
+                try:
+                    await asyncio.wait_for(loop.sock_connect(sock, (server_address, server_port)), 2)
+                except asyncio.TimeoutError:
+                    self.logger.error("Connection to %s:%s timed out.", server_address, server_port)
+                    return None
+                except OSError as e:
+                    self.logger.error("Socket error during connection: %s", e)
+                    return None
+
+                request_time = time.perf_counter()
+                await loop.sock_sendall(sock, self._create_tcp_request(file_size))
+                stop_at = float('inf') if self.duration is None else \
+                    request_time + self.duration + DURATION_GRACE
+
+                readable = _ReadWaiter(loop, sock)
+                view = memoryview(buffer)
+                verifier = self._create_verifier()
+                tcp_info = self._create_tcp_info_sampler(sock, epoch)
+                try:
+                    first_read = True
+                    reads = 0
+                    while sampler.bytes_received < limit and (sampler.last_byte_at or request_time) < stop_at:
+                        try:
+                            nbytes = sock.recv_into(buffer)
+                        except BlockingIOError:
+                            reads = 0
+                            await readable.wait(2)
+                            continue
+                        if first_read:
+                            self._check_reject(buffer, nbytes)
+                            first_read = False
+                        if not nbytes:
+                            break
+                        now = time.perf_counter()
+                        sampler.add(nbytes, now)
+                        if verifier is not None:
+                            verifier.update(view[:nbytes])
+                        if tcp_info is not None:
+                            tcp_info.poll(now)
+                        reads += 1
+                        if reads >= DRAIN_BATCH:
+                            reads = 0
+                            await asyncio.sleep(0)
+                finally:
+                    readable.close()
+                if tcp_info is not None:
+                    tcp_info.sample(time.perf_counter())
+
+            end_time = time.perf_counter()
+            stats = _build_transfer_stats("TCP", transfer_num, sampler, start_time,
+                                          request_time, end_time, omit=self.omit)
+            if verifier is not None:
+                stats.payload_verified = verifier.verified
+            if tcp_info is not None:
+                stats.tcp_info = tcp_info.samples
+            return stats
+
+        except TransferRejected as e:
+            self.logger.warning("TCP transfer %s rejected by server: %s", transfer_num, e)
+        except Exception as e:
+            self.logger.error("Error in TCP transfer %s: %s", transfer_num, e)
+        return None
+
+    async def _tcp_upload(self, server_address: str, server_port: int, file_size: int,
+                          transfer_num: int, epoch: float) -> Optional[TransferStats]:
+        """Handle single TCP upload; the asyncio counterpart of _handle_tcp_upload."""
+        loop = asyncio.get_running_loop()
+        try:
+            start_time = time.perf_counter()
+            sampler = ThroughputSampler(epoch)
+            limit = file_size or float('inf')
+            payload = self._upload_payload
+
+            with self._create_tcp_socket() as sock:
+                sock.setblocking(False)
+                try:
+                    await asyncio.wait_for(loop.sock_connect(sock, (server_address, server_port)), 2)
+                except asyncio.TimeoutError:
+                    self.logger.error("Connection to %s:%s timed out.", server_address, server_port)
+                    return None
+                except OSError as e:
+                    self.logger.error("Socket error during connection: %s", e)
+                    return None
+
+                await loop.sock_sendall(sock, self._create_tcp_request(file_size, UPLOAD))
+                reply = await _recv_exactly_async(loop, sock, READY_MESSAGE.size)
+                if self._is_reject_start(reply):
+                    reply += await _recv_exactly_async(loop, sock, REJECT_MESSAGE.size - READY_MESSAGE.size)
+                self._check_ready(reply)
+
+                request_time = time.perf_counter()
+                stop_at = float('inf') if self.duration is None else request_time + self.duration
+                tcp_info = self._create_tcp_info_sampler(sock, epoch)
+                now = request_time
+                while sampler.bytes_received < limit and now < stop_at:
+                    count = min(len(payload), limit - sampler.bytes_received)
+                    await loop.sock_sendall(sock, payload[:count])
+                    now = time.perf_counter()
+                    sampler.add(count, now)
+                    if tcp_info is not None:
+                        tcp_info.poll(now)
+                sock.shutdown(socket.SHUT_WR)
+                bytes_received, receive_time = self._parse_upload_report(
+                    await _recv_exactly_async(loop, sock, REPORT_MESSAGE.size))
+                if tcp_info is not None:
+                    tcp_info.sample(time.perf_counter())
+
+            end_time = time.perf_counter()
+            stats = _build_transfer_stats("TCP", transfer_num, sampler, start_time,
+                                          request_time, end_time, omit=self.omit)
+            _apply_upload_report(stats, bytes_received, receive_time)
+            if tcp_info is not None:
+                stats.tcp_info = tcp_info.samples
+            return stats
+
+        except TransferRejected as e:
+            self.logger.warning("TCP upload %s rejected by server: %s", transfer_num, e)
+        except Exception as e:
+            self.logger.error("Error in TCP upload %s: %s", transfer_num, e)
+        return None
+
+    async def _udp_transfer(self, server_address: str, server_port: int, file_size: int,
+                            transfer_num: int, epoch: float, buffer: bytearray) -> Optional[TransferStats]:
+        """Handle single UDP file transfer; the asyncio counterpart of _handle_udp_transfer."""
+        try:
+            start_time = time.perf_counter()
+            sampler = ThroughputSampler(epoch)
+
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                self._set_receive_buffer(sock, DEFAULT_UDP_RCVBUF)
+                sock.setblocking(False)
+                session_id = random.getrandbits(32)
+                request_time = time.perf_counter()
+                sock.sendto(self._create_udp_request(file_size, session_id), (server_address, server_port))
+                stop_at = float('inf') if self.duration is None else \
+                    request_time + self.duration + DURATION_GRACE
+
+                segments = SegmentBitmap(0)
+                requester = self._create_retransmit_requester(session_id, segments)
+                analyzer = PacketTimingAnalyzer() if self.udp_timestamps else None
+                verifier = self._create_verifier()
+                last_packet_time = request_time
+                # A transfer still missing segments waits as long as the server lingers for requests
+                idle_timeout = UDP_IDLE_TIMEOUT if requester is None else RELIABLE_LINGER
+                readable = _ReadWaiter(asyncio.get_running_loop(), sock)
+                try:
+                    reads = 0
+                    while last_packet_time < stop_at:
+                        try:
+                            nbytes = sock.recv_into(buffer)
+                            now = last_packet_time = time.perf_counter()
+                            self._receive_udp_packet(buffer, nbytes, last_packet_time,
+                                                     session_id, segments, sampler, analyzer, verifier)
+                            reads += 1
+                        except BlockingIOError:
+                            reads = 0
+                            now = time.perf_counter()
+                            timeout = last_packet_time + idle_timeout - now
+                            if timeout <= 0:
+                                break
+                            if requester is not None:
+                                timeout = min(timeout, max(0.0, requester.next_at - now))
+                            try:
+                                await readable.wait(timeout)
+                            except socket.timeout:
+                                now = time.perf_counter()
+
+                        if requester is not None and segments.total_segments:
+                            if segments.complete:
+                                break
+                            if now >= requester.next_at:
+                                if requester.rtt is None:
+                                    requester.rtt = sampler.first_byte_at - request_time
+                                for message in requester.create_messages(now, last_packet_time):
+                                    sock.sendto(message, (server_address, server_port))
+                        if reads >= DRAIN_BATCH:
+                            reads = 0
+                            await asyncio.sleep(0)
+                finally:
+                    readable.close()
+
+                if self.duration is not None or requester is not None:
+                    # Harmless if the server already reached the deadline or gave up
+                    sock.sendto(self._create_stop_message(session_id), (server_address, server_port))
+
+            end_time = time.perf_counter()
+            return self._build_udp_stats(transfer_num, segments, sampler,
+                                         start_time, request_time, end_time, requester, analyzer,
+                                         verifier)
+
+        except TransferRejected as e:
+            self.logger.warning("UDP transfer %s rejected by server: %s", transfer_num, e)
+        except Exception as e:
+            self.logger.error("Error in UDP transfer %s: %s", transfer_num, e)
+        return None
+
+
+CLIENT_ENGINES = {
+    'threads': SpeedTestClient,
+    'asyncio': AsyncSpeedTestClient,
+}
+
+
+def _run_client_worker(client: SpeedTestClient, worker_id: int, cpu: Optional[int],
+                       server: ServerOffer, file_size: int, transfers: List[Tuple[str, int, str]],
+                       epoch: float, results: 'multiprocessing.Queue'):
+    """Entry point of a client worker process.
+
+    Optionally pins itself to cpu, runs its transfers as threads and sends
+    their TransferStats back through results.
+    """
+    # Interrupts are handled by the parent, which then terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    results.put((worker_id, client._run_transfers(server, file_size, transfers, epoch)))
+    results.close()
+    stop_logging()
+    results.join_thread()
+
+
+def run_test(server: ServerOffer, file_size: int, tcp_conns: int, udp_conns: int,
+             udp_segment_size: Optional[int] = None,
+             udp_rate: Optional[int] = None,
+             duration: Optional[float] = None,
+             omit: float = STEADY_STATE_OMIT,
+             processes: int = 1,
+             cpus: Optional[List[int]] = None,
+             receive_buffer: Optional[int] = None,
+             engine: str = 'threads',
+             reliable_udp: bool = False,
+             udp_timestamps: bool = False,
+             direction: str = DOWNLOAD,
+             payload: Optional[str] = None,
+             payload_ratio: float = 1.0,
+             payload_seed: Optional[int] = None,
+             verify_payload: bool = False,
+             tcp_tuning: Optional[TcpTuning] = None,
+             tcp_info: bool = False,
+             team_name: str = "TheIndigenous_server") -> List[TransferStats]:
+    """Run one test round against server without any prompts or discovery.
+
+    Args:
+        server (ServerOffer): Server to test against
+        file_size (int): Requested file size in bytes per transfer
+        tcp_conns (int): Number of TCP transfers
+        udp_conns (int): Number of UDP transfers
+        udp_segment_size (Optional[int]): UDP payload bytes per datagram
+        udp_rate (Optional[int]): Offered UDP load in bits/second
+        duration (Optional[float]): Stream every transfer for this many seconds
+        omit (float): Seconds of ramp-up left out of the steady-state speed
+        processes (int): Worker processes to spread the transfers over
+        cpus (Optional[List[int]]): CPUs to pin the worker processes, or the transfer threads, to
+        receive_buffer (Optional[int]): SO_RCVBUF in bytes for every transfer socket
+        engine (str): Key of CLIENT_ENGINES running the transfers
+        reliable_udp (bool): Have the server resend missing UDP segments
+        udp_timestamps (bool): Measure delay, jitter and reordering of UDP transfers
+        direction (str): download, upload or both for the TCP transfers
+        payload (Optional[str]): Payload mode to ask the server for
+        payload_ratio (float): Target compression ratio of the ratio payload
+        payload_seed (Optional[int]): Seed picking the offset into the payload pattern to ask for
+        verify_payload (bool): Check every received byte against the requested pattern
+        tcp_tuning (Optional[TcpTuning]): Socket options of every TCP connection
+        tcp_info (bool): Sample TCP_INFO of every TCP connection
+        team_name (str): Name of the testing client
+
+    Returns:
+        List[TransferStats]: Statistics of every transfer that completed.
+    """
+    client = CLIENT_ENGINES[engine](team_name, udp_segment_size=udp_segment_size,
+                                    udp_rate=udp_rate, duration=duration, omit=omit, processes=processes,
+                                    cpus=cpus, receive_buffer=receive_buffer,
+                                    reliable_udp=reliable_udp, udp_timestamps=udp_timestamps,
+                                    direction=direction, payload=payload, payload_ratio=payload_ratio,
+                                    payload_seed=payload_seed, verify_payload=verify_payload,
+                                    tcp_tuning=tcp_tuning, tcp_info=tcp_info)
+    return client.run_test(server, file_size, tcp_conns, udp_conns)
+
+
+def _print_history(store: ResultStore):
+    """Print the trend of every series in store: the last week against the four weeks before."""
+    for server, protocol, direction, connections in store.series():
+        trend = store.compare_trend(server, protocol, direction=direction, connections=connections)
+        change = "n/a" if trend.change is None else f"{trend.change:+.1%}"
+        print(f"{server} {protocol} {direction} x{connections}: "
+              f"p50 {trend.recent.p50_speed:.1f}, p95 {trend.recent.p95_speed:.1f}, "
+              f"p99 {trend.recent.p99_speed:.1f} bits/second "
+              f"over {trend.recent.count} transfers; "
+              f"p50 {change} against {trend.baseline.count} transfers before")
+
+
+def _parse_server(text: str) -> ServerOffer:
+    """Parse a HOST:TCP_PORT:UDP_PORT command line argument."""
+    try:
+        address, tcp_port, udp_port = text.rsplit(':', 2)
+        return ServerOffer(address, int(udp_port), int(tcp_port))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected HOST:TCP_PORT:UDP_PORT")
+
+
+def _cpu_list(text: str) -> List[int]:
+    """Parse a comma separated list of CPU numbers."""
+    try:
+        return [int(cpu) for cpu in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected comma separated CPU numbers")
 
 
 def main():
-    client = SpeedTestClient("TheIndigenous_server")
-    client.start()
+    parser = argparse.ArgumentParser(
+        description="Network speed test client. Without --file-size or --duration it prompts interactively.")
+    parser.add_argument('--team-name', default="TheIndigenous_server")
+    parser.add_argument('--engine', choices=sorted(CLIENT_ENGINES), default='threads',
+                        help="threads: one thread per connection, asyncio: one event loop for all connections")
+    parser.add_argument('--file-size', type=int, help="bytes per transfer; enables batch mode")
+    parser.add_argument('--tcp', type=int, default=1, help="TCP connections per round")
+    parser.add_argument('--udp', type=int, default=1, help="UDP connections per round")
+    parser.add_argument('--repeat', type=int, default=1, help="rounds to run, 0 for unlimited")
+    parser.add_argument('--interval', type=float, default=0, help="seconds between rounds")
+    parser.add_argument('--output', help="append one JSON line per round to this file")
+    parser.add_argument('--server', type=_parse_server,
+                        help="HOST:TCP_PORT:UDP_PORT to test instead of waiting for an offer")
+    parser.add_argument('--udp-segment-size', type=int, help="UDP payload bytes per datagram")
+    parser.add_argument('--udp-rate', type=int, help="offered UDP load in bits/second")
+    parser.add_argument('--duration', type=float,
+                        help="stream each transfer for this many seconds; enables batch mode")
+    parser.add_argument('--omit', type=float, default=STEADY_STATE_OMIT,
+                        help="seconds of ramp-up left out of the steady-state speed")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="worker processes to spread each round's connections over")
+    parser.add_argument('--cpus', type=_cpu_list,
+                        help="comma separated CPUs to pin worker processes to "
+                             "(with --processes 1, the transfer threads share them)")
+    parser.add_argument('--rcvbuf', type=int,
+                        help="SO_RCVBUF in bytes for every connection (default: kernel autotuning for TCP, "
+                             f"{DEFAULT_UDP_RCVBUF} for UDP)")
+    parser.add_argument('--tcp-profile', choices=TCP_PROFILES, default='default',
+                        help="socket options of every TCP connection; the options below override it")
+    parser.add_argument('--sndbuf', type=int, help="SO_SNDBUF in bytes for every TCP connection")
+    parser.add_argument('--tcp-congestion', help="TCP congestion control algorithm, e.g. cubic or bbr")
+    parser.add_argument('--notsent-lowat', type=int, help="TCP_NOTSENT_LOWAT in bytes")
+    parser.add_argument('--mss', type=int, help="TCP maximum segment size in bytes")
+    parser.add_argument('--tcp-info', action='store_true',
+                        help="sample TCP_INFO (RTT, cwnd, retransmits, pacing and delivery rate) "
+                             "of every TCP connection")
+    parser.add_argument('--reliable-udp', action='store_true',
+                        help="have the server resend missing UDP segments until all arrive")
+    parser.add_argument('--udp-timestamps', action='store_true',
+                        help="report UDP delay variation, jitter, reordering and loss bursts")
+    parser.add_argument('--select', choices=SELECTION_STRATEGIES, default='nearest',
+                        help="how to pick among discovered servers")
+    parser.add_argument('--probe', type=_parse_server, action='append', default=[],
+                        help="HOST:TCP_PORT:UDP_PORT of a server to probe by unicast; may be repeated")
+    parser.add_argument('--server-ttl', type=float, default=SERVER_TTL,
+                        help="seconds a discovered server stays cached after it was last heard from")
+    parser.add_argument('--payload', choices=PAYLOAD_MODES,
+                        help="payload to ask for (default: the server's)")
+    parser.add_argument('--payload-ratio', type=float, default=1.0,
+                        help="target compression ratio of the ratio payload")
+    parser.add_argument('--payload-seed', type=int, help="seed picking the offset into the payload pattern the payload starts at")
+    parser.add_argument('--verify-payload', action='store_true',
+                        help="check received payload with a rolling checksum")
+    parser.add_argument('--log-json', metavar='PATH',
+                        help="also append log records to PATH as JSON lines")
+    parser.add_argument('--direction', choices=DIRECTIONS, default=DOWNLOAD,
+                        help="TCP transfer direction; both runs an upload alongside every download")
+    parser.add_argument('--store', metavar='PATH',
+                        help="record every round in the SQLite result store at PATH")
+    parser.add_argument('--raw-retention-days', type=float, default=RAW_RETENTION_DAYS,
+                        help="days the store keeps individual transfers")
+    parser.add_argument('--history-retention-days', type=float, default=HISTORY_RETENTION_DAYS,
+                        help="days the store keeps hourly speed histograms")
+    parser.add_argument('--history', action='store_true',
+                        help="print the stored speed trend of every server and exit")
+    parser.add_argument('--fan-out', action='store_true',
+                        help="test every server offering within --fan-out-window and print one matrix")
+    parser.add_argument('--fan-out-window', type=float, default=FAN_OUT_WINDOW,
+                        help="seconds to collect offers for in fan-out mode")
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help="servers tested at once in fan-out mode, 0 for all of them")
+    args = parser.parse_args()
+    if args.fan_out and args.processes > 1:
+        parser.error("--fan-out cannot be combined with --processes")
+    store = None
+    if args.store:
+        store = ResultStore(args.store, args.raw_retention_days, args.history_retention_days,
+                            read_only=args.history)
+    elif args.history:
+        parser.error("--history requires --store")
+    if args.history:
+        try:
+            _print_history(store)
+        finally:
+            store.close()
+        return
+    tcp_tuning = replace(TCP_PROFILES[args.tcp_profile], **{
+        key: value for key, value in (('sndbuf', args.sndbuf), ('congestion', args.tcp_congestion),
+                                      ('notsent_lowat', args.notsent_lowat), ('mss', args.mss))
+        if value is not None})
+
+    client = CLIENT_ENGINES[args.engine](args.team_name, udp_segment_size=args.udp_segment_size,
+                                         udp_rate=args.udp_rate, duration=args.duration, omit=args.omit,
+                                         processes=args.processes, cpus=args.cpus,
+                                         receive_buffer=args.rcvbuf, reliable_udp=args.reliable_udp,
+                                         udp_timestamps=args.udp_timestamps, direction=args.direction,
+                                         selection=args.select, server_ttl=args.server_ttl,
+                                         payload=args.payload,
+                                         payload_ratio=args.payload_ratio, payload_seed=args.payload_seed,
+                                         verify_payload=args.verify_payload, tcp_tuning=tcp_tuning,
+                                         tcp_info=args.tcp_info, store=store)
+    if args.log_json:
+        add_json_log(client.logger, args.log_json)
+    for offer in args.probe:
+        client.discovery.add(offer)
+    output = None
+    try:
+        if args.file_size is None and args.duration is None:
+            if args.fan_out:
+                parser.error("--fan-out requires --file-size or --duration")
+            client.start()
+            return
+        if args.file_size is None:
+            # Duration mode without a size cap
+            args.file_size = 0
+
+        output = open(args.output, 'a') if args.output else None
+        if args.fan_out:
+            if args.server is not None:
+                client.discovery.add(args.server)
+            client.run_fan_out(args.file_size, args.tcp, args.udp, args.fan_out_window,
+                               args.concurrency, output)
+            return
+        client.run_batch(args.file_size, args.tcp, args.udp, args.repeat, output,
+                         args.server, args.interval)
+    finally:
+        if output is not None:
+            output.close()
+        if store is not None:
+            store.close()
 
 
 if __name__ == "__main__":
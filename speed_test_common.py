@@ -0,0 +1,483 @@
+# common.py
+"""Code shared by the speed test client and server.
+
+Both scripts import from here whatever has to behave identically on the
+two ends of a connection, so it cannot drift apart.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+from colorama import Style
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+PAYLOAD_MODES = ('zeros', 'random', 'ratio')
+PAYLOAD_POOL_SIZE = 4 * 1024 * 1024  # bytes of every payload pattern
+PATTERN_BLOCK_SIZE = 4096
+PAYLOAD_BASE_SEED = 0x5eed  # seed of the random bytes every pattern is built from
+MAX_GSO_SEGMENTS = 64  # most datagrams the server sends in one sendmsg call
+MAX_UDP_PAYLOAD = 65507
+# Seconds a finished reliable UDP transfer waits for retransmit requests, and a client
+# missing segments waits for data before giving up
+RELIABLE_LINGER = 2.0
+NACK_HEADER = struct.Struct('!IbIQQ')  # retransmit request, followed by a received-segment bitmap
+NACK_BITMAP_BYTES = 1024  # bitmap bytes per NACK message, covering 8192 segments
+MAX_NACK_SIZE = NACK_HEADER.size + NACK_BITMAP_BYTES
+# struct tcp_info of linux/tcp.h up to tcpi_delivery_rate, keeping only snd_mss, rtt,
+# rttvar, snd_cwnd, rcv_rtt, rcv_space, total_retrans, pacing_rate, min_rtt and delivery_rate
+TCP_INFO = struct.Struct('=16xI48xII4xI8xIIIQ36xI8xQ')
+_UNSET_RATE = 2 ** 64 - 1  # pacing rate the kernel reports before it computed one
+
+
+LOG_QUEUE_SIZE = 10000  # records waiting for the listener thread before new ones are dropped
+LOG_RATE_LIMIT = 20  # records per message template and level passed per LOG_RATE_INTERVAL
+LOG_RATE_INTERVAL = 1.0  # seconds
+RESULT = {'result': True}  # extra of records reporting a result, which are never rate limited
+
+
+class _RateLimitFilter(logging.Filter):
+    """Drops repetitive records on the logging thread, before they are queued.
+
+    Records below WARNING that do not report a result are grouped by message
+    template and level. Within each LOG_RATE_INTERVAL window a group passes
+    at most LOG_RATE_LIMIT records, and never the same arguments twice in a
+    row. The number dropped is set as record.suppressed on the group's next
+    record that passes, unless flush hands it on first.
+    """
+
+    def __init__(self, limit: int = LOG_RATE_LIMIT, interval: float = LOG_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        # (template, level) -> [window start, passed, suppressed, last args, last suppressed record]
+        self._groups: Dict[Tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or getattr(record, 'result', False):
+            return True
+        key = (str(record.msg), record.levelno)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None or record.created - group[0] >= self.interval:
+                suppressed = 0 if group is None else group[2]
+                group = self._groups[key] = [record.created, 0, suppressed, None, None]
+            elif group[1] >= self.limit or record.args == group[3]:
+                group[2] += 1
+                group[4] = record
+                return False
+            group[1] += 1
+            group[3] = record.args
+            record.suppressed, group[2], group[4] = group[2], 0, None
+        return True
+
+    def flush(self, now: Optional[float] = None) -> List[logging.LogRecord]:
+        """Take the suppressed counts of groups whose window ended by now, or of every group.
+
+        Returns:
+            List[logging.LogRecord]: For each group with a count, the last
+            record it dropped, with record.suppressed counting the others.
+        """
+        records = []
+        with self._lock:
+            for group in self._groups.values():
+                if group[2] and (now is None or now - group[0] >= self.interval):
+                    record = group[4]
+                    record.suppressed = group[2] - 1
+                    records.append(record)
+                    group[2], group[4] = 0, None
+        return records
+
+    def reset_after_fork(self):
+        """Replace the lock, which another thread may have held when the process forked."""
+        self._lock = threading.Lock()
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for a QueueListener without formatting them on the logging thread.
+
+    Messages are only built from their template and arguments by the
+    listener's handlers, so arguments must not be mutated after logging. A
+    full queue drops the record instead of blocking the thread that logged
+    it; the count is set as record.dropped on the next record queued.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # Handler.handle already holds the lock; it is reentrant, and taking
+        # it here keeps the count safe for callers of emit
+        with self.lock:
+            record.dropped = self.dropped
+            try:
+                self.queue.put_nowait(record)
+                self.dropped = 0
+            except queue.Full:
+                self.dropped += 1
+
+
+class _FlushingQueueListener(logging.handlers.QueueListener):
+    """QueueListener that also writes out suppressed counts once their window has ended.
+
+    It wakes at least every rate limit interval, so a count is reported
+    even when its group logs nothing more.
+    """
+
+    def __init__(self, log_queue: queue.Queue, rate_limit: _RateLimitFilter, *handlers: logging.Handler):
+        super().__init__(log_queue, *handlers)
+        self.rate_limit = rate_limit
+        self._next_flush = 0.0
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        while True:
+            try:
+                record = self.queue.get(block, self.rate_limit.interval)
+                received = True
+            except queue.Empty:
+                # None is the stop sentinel, so a timeout is told apart with a flag
+                received = False
+            now = time.time()
+            if now >= self._next_flush:
+                self._next_flush = now + self.rate_limit.interval
+                for summary in self.rate_limit.flush(now):
+                    self.handle(summary)
+            if received:
+                return record
+
+
+class _ConsoleFormatter(logging.Formatter):
+    """Colored console format noting how many earlier records were suppressed or dropped."""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        if getattr(record, 'suppressed', 0):
+            record.message += f" ({record.suppressed} similar messages suppressed)"
+        if getattr(record, 'dropped', 0):
+            record.message += f" ({record.dropped} messages dropped)"
+        return super().formatMessage(record)
+
+
+class _JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key in ('suppressed', 'dropped'):
+            if getattr(record, key, 0):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _LogPipeline:
+    """Moves the records of one logger from its queue to its handlers on a listener thread."""
+
+    def __init__(self, handler: logging.Handler):
+        self.queue_handler = _LazyQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        self.rate_limit = _RateLimitFilter()
+        self.queue_handler.addFilter(self.rate_limit)
+        self.handlers = [handler]
+        self.listener: Optional[_FlushingQueueListener] = None
+        self.start()
+
+    def start(self):
+        self.listener = _FlushingQueueListener(self.queue_handler.queue, self.rate_limit, *self.handlers)
+        self.listener.start()
+
+    def stop(self):
+        """Write out the queued records and stop the listener thread."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def close(self):
+        """Stop the listener, then write out every suppressed count still pending."""
+        self.stop()
+        for record in self.rate_limit.flush():
+            for handler in self.handlers:
+                handler.handle(record)
+
+    def add_handler(self, handler: logging.Handler):
+        self.stop()
+        self.handlers.append(handler)
+        self.start()
+
+    def reset_after_fork(self):
+        """Give a forked child its own queue and listener; the parent's thread does not survive fork."""
+        self.rate_limit.reset_after_fork()
+        self.queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.start()
+
+
+_log_pipelines: Dict[str, _LogPipeline] = {}
+
+
+def setup_logger(name: str, color: str) -> logging.Logger:
+    """Set up a colored logger with the specified name and color.
+
+    The calling thread only filters a record and queues it; a listener
+    thread formats and writes it, so logging never blocks a transfer.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+
+    # Check if the logger already has handlers to prevent duplicate handlers
+    if not logger.hasHandlers():
+        handler = logging.StreamHandler()
+        formatter = _ConsoleFormatter(
+            f'{color}%(asctime)s - %(levelname)s - %(message)s{Style.RESET_ALL}'
+        )
+        handler.setFormatter(formatter)
+        pipeline = _log_pipelines[name] = _LogPipeline(handler)
+        logger.addHandler(pipeline.queue_handler)
+
+    return logger
+
+
+def add_json_log(logger: logging.Logger, path: str):
+    """Also append every record of a logger set up by setup_logger to path, one JSON object per line."""
+    handler = logging.FileHandler(path)
+    handler.setFormatter(_JsonFormatter())
+    _log_pipelines[logger.name].add_handler(handler)
+
+
+def stop_logging():
+    """Write out every queued record; runs at exit, and must be called before a worker process exits."""
+    for pipeline in _log_pipelines.values():
+        pipeline.close()
+
+
+def _reset_logging_after_fork():
+    for pipeline in _log_pipelines.values():
+        pipeline.reset_after_fork()
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_reset_logging_after_fork)
+
+
+def payload_slots(datagram_size: int) -> int:
+    """Number of distinct UDP payloads of a transfer with datagrams of datagram_size bytes.
+
+    Segment N carries the payload of slot N % payload_slots. It is the
+    largest power of two that is at most MAX_GSO_SEGMENTS and whose
+    datagrams fit in MAX_UDP_PAYLOAD bytes together, so the server can
+    keep one pre-built datagram per slot.
+    """
+    slots = 1
+    while slots * 2 <= MAX_GSO_SEGMENTS and slots * 2 * datagram_size <= MAX_UDP_PAYLOAD:
+        slots *= 2
+    return slots
+
+
+def pattern_key(mode: str, ratio: float = 1.0) -> Tuple[str, int]:
+    """Key of the pattern of mode and ratio; ratios with the same key share a pattern.
+
+    Raises:
+        ValueError: If the mode is unknown or the ratio is below 1
+    """
+    if mode not in PAYLOAD_MODES:
+        raise ValueError(f"payload must be one of {', '.join(PAYLOAD_MODES)}")
+    if not 1 <= ratio < float('inf'):
+        raise ValueError("ratio must be at least 1")
+    if mode != 'ratio':
+        return mode, 0
+    return mode, max(1, round(PATTERN_BLOCK_SIZE / ratio))
+
+
+class PayloadGenerator:
+    """Deterministic payload pattern shared read-only by every transfer using it.
+
+    zeros is all zero bytes, random is incompressible, and ratio keeps the
+    first 1/ratio of every PATTERN_BLOCK_SIZE block of the random pattern
+    and zeroes the rest, so it compresses by about ratio. The random bytes
+    always come from PAYLOAD_BASE_SEED; a seed only picks the offset the
+    payload starts at, so seeded payloads are views of one pattern per mode
+    and ratio that cost nothing to create with reseeded.
+    """
+
+    def __init__(self, mode: str = 'random', ratio: float = 1.0,
+                 seed: Optional[int] = None, size: int = PAYLOAD_POOL_SIZE):
+        """Generate the pattern.
+
+        Args:
+            mode (str): One of PAYLOAD_MODES. Defaults to random.
+            ratio (float): Target compression ratio of the ratio mode, at least 1.
+            seed (Optional[int]): Seed picking the start offset. Defaults to unseeded.
+            size (int): Pattern size in bytes.
+
+        Raises:
+            ValueError: If the mode is unknown or the ratio is below 1
+        """
+        self.key = pattern_key(mode, ratio)
+        self.mode = mode
+        self.ratio = ratio
+        if mode == 'zeros':
+            self.pattern = bytes(size)
+        else:
+            pattern = random.Random(PAYLOAD_BASE_SEED).randbytes(size)
+            if mode == 'ratio':
+                random_bytes = self.key[1]
+                zeros = bytes(PATTERN_BLOCK_SIZE - random_bytes)
+                buffer = bytearray(pattern)
+                for start in range(random_bytes, size, PATTERN_BLOCK_SIZE):
+                    buffer[start:start + len(zeros)] = zeros[:size - start]
+                pattern = bytes(buffer)
+            self.pattern = pattern
+        self.seed = None
+        self.offset = 0
+        self._set_seed(seed)
+
+    def _set_seed(self, seed: Optional[int]):
+        self.seed = seed
+        self.offset = 0 if seed is None else random.Random(seed).randrange(len(self.pattern))
+
+    def reseeded(self, seed: Optional[int]) -> 'PayloadGenerator':
+        """Return a generator for seed sharing this one's pattern."""
+        generator = copy.copy(self)
+        generator._set_seed(seed)
+        return generator
+
+    @property
+    def seeded(self) -> bool:
+        return self.seed is not None
+
+    def datagram_offset(self, segment: int, segment_size: int, slots: int) -> int:
+        """Offset into the pattern of the payload carried by UDP segment, given the transfer's slot count."""
+        return (self.offset + (segment % slots) * segment_size) % (len(self.pattern) - segment_size + 1)
+
+
+@dataclass(frozen=True)
+class TcpTuning:
+    """Data class for the socket options of a TCP tuning profile; None keeps the kernel's default.
+
+    sndbuf and rcvbuf are SO_SNDBUF and SO_RCVBUF in bytes (setting one turns
+    off the kernel's autotuning of that buffer, and the kernel clamps it to
+    net.core.wmem_max or rmem_max), congestion is a TCP_CONGESTION algorithm,
+    notsent_lowat a TCP_NOTSENT_LOWAT in bytes and mss a TCP_MAXSEG in bytes.
+    """
+    sndbuf: Optional[int] = None
+    rcvbuf: Optional[int] = None
+    congestion: Optional[str] = None
+    notsent_lowat: Optional[int] = None
+    mss: Optional[int] = None
+
+
+TCP_PROFILES = {
+    'default': TcpTuning(),
+    'throughput': TcpTuning(sndbuf=32 * 1024 * 1024, rcvbuf=32 * 1024 * 1024, congestion='bbr'),
+    'latency': TcpTuning(notsent_lowat=16 * 1024),
+}
+
+
+def apply_tcp_tuning(sock: socket.socket, tuning: TcpTuning):
+    """Set the options of tuning on sock.
+
+    Set before connecting, they already apply to the handshake. Set on a
+    listening socket, they are inherited by every connection it accepts,
+    and SO_RCVBUF and TCP_MAXSEG already apply to the handshake.
+
+    Raises:
+        OSError: If the kernel refuses an option, e.g. an unavailable congestion control algorithm
+        AttributeError: If the platform lacks one of the socket options
+    """
+    if tuning.sndbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, tuning.sndbuf)
+    if tuning.rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, tuning.rcvbuf)
+    if tuning.congestion is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CONGESTION, tuning.congestion.encode())
+    if tuning.notsent_lowat is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, tuning.notsent_lowat)
+    if tuning.mss is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG, tuning.mss)
+
+
+def check_tcp_tuning(tuning: TcpTuning) -> List[str]:
+    """Try tuning on a throwaway socket, so options the host cannot apply fail at startup.
+
+    Returns:
+        List[str]: Warnings about buffer sizes the kernel clamped.
+
+    Raises:
+        OSError: If the platform or kernel does not support an option of tuning
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            apply_tcp_tuning(sock, tuning)
+        except AttributeError as e:
+            raise OSError(f"TCP tuning is not supported on this platform: {e}") from None
+        except OSError as e:
+            raise OSError(f"Cannot apply TCP tuning {tuning}: {e}") from None
+        warnings = []
+        for name, option, size, limit in (('SO_SNDBUF', socket.SO_SNDBUF, tuning.sndbuf, 'wmem_max'),
+                                          ('SO_RCVBUF', socket.SO_RCVBUF, tuning.rcvbuf, 'rmem_max')):
+            # Linux reports twice the size set, so only a clamped size reads back smaller
+            if size is not None and sock.getsockopt(socket.SOL_SOCKET, option) < size:
+                warnings.append(f"{name} of {size} bytes was clamped by the kernel; "
+                                f"raise net.core.{limit} to use it")
+        return warnings
+
+
+@dataclass
+class TcpInfoSample:
+    """Data class for one TCP_INFO reading of a socket.
+
+    offset is seconds since the round's epoch, times are in seconds and rates
+    in bits/second. rtt, cwnd (in segments of mss bytes), pacing_rate,
+    delivery_rate and retransmits describe what the socket itself sends:
+    the data of an upload, but only acknowledgments when it receives a
+    download. The receiving side's view is rcv_rtt and rcv_space, its
+    estimate of the round trip time and of the receive window it needs.
+    """
+    offset: float
+    rtt: float
+    rtt_var: float
+    min_rtt: float
+    cwnd: int
+    mss: int
+    retransmits: int
+    pacing_rate: Optional[float]
+    delivery_rate: float
+    rcv_rtt: float
+    rcv_space: int
+
+
+def read_tcp_info(sock: socket.socket, offset: float = 0.0) -> TcpInfoSample:
+    """Read TCP_INFO of sock (Linux only); fields an older kernel does not report read as 0."""
+    data = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+    (mss, rtt, rtt_var, cwnd, rcv_rtt, rcv_space, retransmits, pacing_rate,
+     min_rtt, delivery_rate) = TCP_INFO.unpack(data.ljust(TCP_INFO.size, b'\0'))
+    return TcpInfoSample(
+        offset=offset,
+        rtt=rtt / 1e6,
+        rtt_var=rtt_var / 1e6,
+        min_rtt=min_rtt / 1e6,
+        cwnd=cwnd,
+        mss=mss,
+        retransmits=retransmits,
+        pacing_rate=None if pacing_rate == _UNSET_RATE else pacing_rate * 8,
+        delivery_rate=delivery_rate * 8,
+        rcv_rtt=rcv_rtt / 1e6,
+        rcv_space=rcv_space,
+    )
@@ -1,41 +1,147 @@
 # server.py
+import argparse
+import asyncio
+import http.server
+import os
 import socket
 import struct
 import threading
 import time
 import random
 import logging
+import multiprocessing
+import queue
+import signal
 import colorama
-from colorama import Fore, Style
-from typing import Tuple
+from collections import deque
+from colorama import Fore
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Dict, Optional, List, Callable, Deque, Set
+from dataclasses import dataclass, fields, replace
+
+from speed_test_common import (MAX_NACK_SIZE, NACK_HEADER, PAYLOAD_MODES, PAYLOAD_POOL_SIZE, MAX_UDP_PAYLOAD,
+                               RELIABLE_LINGER, RESULT, TCP_PROFILES, PayloadGenerator, TcpTuning, add_json_log, apply_tcp_tuning, check_tcp_tuning,
+                               pattern_key, payload_slots, read_tcp_info, setup_logger, stop_logging)
 
 # Initialize colorama for cross-platform ANSI color support
 colorama.init()
 
 
-def setup_logger(name: str, color: str) -> logging.Logger:
-    """Set up a colored logger with the specified name and color."""
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-
-    # Check if the logger already has handlers to prevent duplicate handlers
-    if not logger.hasHandlers():
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter(
-            f'{color}%(asctime)s - %(levelname)s - %(message)s{Style.RESET_ALL}'
-        )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-
-    return logger
-
-
 def get_server_ip():
     hostname = socket.gethostname()
     ip_address = socket.gethostbyname(hostname)
     return ip_address
 
 
+def _parse_request_options(text: str) -> Dict[str, str]:
+    """Parse the optional space separated key=value fields of a request.
+
+    Args:
+        text (str): Option text following the fixed part of a request
+
+    Returns:
+        Dict[str, str]: Option names mapped to their raw values.
+
+    Raises:
+        ValueError: If a field is not of the form key=value
+    """
+    options = {}
+    for field in text.split():
+        key, sep, value = field.partition('=')
+        if not sep or not key:
+            raise ValueError(f"Malformed request option {field!r}")
+        options[key] = value
+    return options
+
+
+def _parse_duration(options: Dict[str, str]) -> Optional[float]:
+    """Read the optional duration option of a request.
+
+    Args:
+        options (Dict[str, str]): Options returned by _parse_request_options
+
+    Returns:
+        Optional[float]: Seconds to stream for, or None for a size-bounded transfer.
+
+    Raises:
+        ValueError: If the duration is not a positive finite number
+    """
+    if 'duration' not in options:
+        return None
+    duration = float(options['duration'])
+    if not 0 < duration < float('inf'):
+        raise ValueError("duration must be a positive number of seconds")
+    return duration
+
+
+def _parse_direction(options: Dict[str, str]) -> str:
+    """Read the optional direction option of a TCP request, defaulting to download.
+
+    Raises:
+        ValueError: If the direction is not one of TCP_DIRECTIONS
+    """
+    direction = options.get('direction', DOWNLOAD)
+    if direction not in TCP_DIRECTIONS:
+        raise ValueError(f"direction must be one of {', '.join(TCP_DIRECTIONS)}")
+    return direction
+
+
+def _parse_payload(options: Dict[str, str]) -> Optional[Tuple[str, float, Optional[int]]]:
+    """Read the optional payload, ratio and seed options of a request.
+
+    Returns:
+        Optional[Tuple[str, float, Optional[int]]]: Mode, ratio and seed of the
+        PayloadGenerator asked for, or None for the server's default payload.
+
+    Raises:
+        ValueError: If an option is malformed or out of range
+    """
+    if not {'payload', 'ratio', 'seed'} & options.keys():
+        return None
+    seed = options.get('seed')
+    mode, ratio = options.get('payload', 'random'), float(options.get('ratio', 1))
+    # Raises ValueError for a bad mode or ratio while the request is parsed
+    pattern_key(mode, ratio)
+    return mode, ratio, None if seed is None else int(seed)
+
+
+def _parse_flag(options: Dict[str, str], key: str) -> bool:
+    """Read an optional 0/1 request option, defaulting to 0.
+
+    Raises:
+        ValueError: If the value is not 0 or 1
+    """
+    value = options.get(key, '0')
+    if value not in ('0', '1'):
+        raise ValueError(f"{key} must be 0 or 1")
+    return value == '1'
+
+
+def _missing_segments(bitmap, base: int, end: int) -> List[int]:
+    """List the segments a NACK message reports missing.
+
+    Args:
+        bitmap: Received-segment bitmap starting at segment base, one bit per
+            segment, least significant bit first
+        base (int): Segment of the first bit
+        end (int): Segment after the last one the client is asking about
+
+    Returns:
+        List[int]: Segments in [base, end) whose bit is clear.
+    """
+    missing = []
+    for index, byte in enumerate(bitmap):
+        if byte == 0xff:
+            continue
+        first = base + index * 8
+        for bit in range(8):
+            if first + bit >= end:
+                return missing
+            if not byte & (1 << bit):
+                missing.append(first + bit)
+    return missing
+
+
 def _get_random_port() -> int:
     """Get an available random port number.
 
@@ -47,13 +153,1023 @@ def _get_random_port() -> int:
         return s.getsockname()[1]
 
 
+DEFAULT_CHUNK_SIZE = 128 * 1024
+PACED_CHUNK_SIZE = 16 * 1024  # most bytes per send call of a TCP transfer paced by its egress share
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+TCP_DIRECTIONS = (DOWNLOAD, UPLOAD)
+UPLOAD_GRACE = 1.0  # seconds an upload may run past its duration before the server stops counting
+MAX_CACHED_PAYLOADS = 8  # patterns of distinct payload modes and ratios kept
+
+
+class PayloadEngine:
+    """Reusable payload shared by all TCP transfers.
+
+    The pattern of a PayloadGenerator (incompressible by default) is
+    generated once at startup and chunks are sent as memoryview slices of
+    it, wrapping around at its end. Optionally the pattern is copied into a
+    memfd and streamed with sendfile instead, so the payload never passes
+    through Python. Either way no payload bytes are allocated per chunk.
+    """
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 pool_size: int = PAYLOAD_POOL_SIZE,
+                 use_sendfile: bool = False,
+                 generator: Optional[PayloadGenerator] = None):
+        """Build the payload pool.
+
+        Args:
+            chunk_size (int): Bytes handed to the kernel per send call.
+            pool_size (int): Size of the random pattern, raised to at least chunk_size.
+                Ignored when a generator is given.
+            use_sendfile (bool): Stream from a memfd with sendfile (Linux only).
+                Only pays off with large chunks, so it defaults to False.
+            generator (Optional[PayloadGenerator]): Pattern to send. Defaults to an
+                unseeded random pattern of pool_size bytes. A seeded pattern is
+                streamed from the seed's offset, so clients can verify it.
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        if generator is None:
+            generator = PayloadGenerator('random', size=max(pool_size, chunk_size))
+        self.chunk_size = chunk_size
+        self.generator = generator
+        self.pool_size = len(generator.pattern)
+        self._pattern = generator.pattern
+        self._view = memoryview(self._pattern)
+        self._file = None
+
+        if use_sendfile:
+            fd = os.memfd_create('speedtest-payload')
+            self._file = os.fdopen(fd, 'w+b', buffering=0)
+            self._file.write(self._pattern)
+
+    @property
+    def uses_sendfile(self) -> bool:
+        return self._file is not None
+
+    def _start_offset(self) -> int:
+        """Where a transfer starts in the pattern: the seed's offset if seeded, otherwise anywhere."""
+        if self.generator.seeded:
+            return self.generator.offset
+        return random.randrange(0, self.pool_size)
+
+    def send(self, sock: socket.socket, nbytes: int, pacer: Optional['TokenBucket'] = None,
+             deadline: Optional[float] = None,
+             counters: Optional['TransferCounters'] = None) -> int:
+        """Send nbytes of pattern data on a connected stream socket.
+
+        Args:
+            sock (socket.socket): Connected TCP socket
+            nbytes (int): Number of bytes to send; 0 means no limit when a deadline is given
+            pacer (Optional[TokenBucket]): Bucket consumed before every chunk, if any. Chunks
+                are cut to its burst size, so a slow share is paced in small slices.
+            deadline (Optional[float]): time.perf_counter value to stop streaming at.
+                With a deadline, the client closing the connection ends the transfer
+                normally instead of raising.
+            counters (Optional[TransferCounters]): Live counters kept up to date after every chunk
+
+        Returns:
+            int: Number of bytes actually sent.
+        """
+        offset = self._start_offset()
+        bytes_sent = 0
+        limit = nbytes if nbytes or deadline is None else float('inf')
+
+        chunk_size = self.chunk_size if pacer is None else min(self.chunk_size, pacer.burst)
+
+        try:
+            while bytes_sent < limit and (deadline is None or time.perf_counter() < deadline):
+                count = min(chunk_size, limit - bytes_sent, self.pool_size - offset)
+                if pacer is not None:
+                    pacer.consume(count)
+
+                if self._file is not None:
+                    sent = sock.sendfile(self._file, offset, count)
+                    if sent == 0:
+                        break
+                else:
+                    sock.sendall(self._view[offset:offset + count])
+                    sent = count
+
+                bytes_sent += sent
+                offset = (offset + sent) % self.pool_size
+                if counters is not None:
+                    counters.bytes_sent = bytes_sent
+        except (BrokenPipeError, ConnectionResetError):
+            # A client ending a duration transfer closes the connection on us
+            if deadline is None:
+                _count_send_error(counters)
+                raise
+        except OSError:
+            _count_send_error(counters)
+            raise
+
+        return bytes_sent
+
+    async def send_async(self, writer: asyncio.StreamWriter, nbytes: int,
+                         pacer: Optional['TokenBucket'] = None,
+                         deadline: Optional[float] = None,
+                         counters: Optional['TransferCounters'] = None) -> int:
+        """Send nbytes of pattern data on an asyncio stream.
+
+        Waits for the transport to drain after every chunk, so at most about
+        one chunk per connection is ever buffered in user space. pacer,
+        deadline and counters work as in send.
+
+        Returns:
+            int: Number of bytes actually sent.
+        """
+        offset = self._start_offset()
+        bytes_sent = 0
+        limit = nbytes if nbytes or deadline is None else float('inf')
+        loop = asyncio.get_running_loop()
+        chunk_size = self.chunk_size if pacer is None else min(self.chunk_size, pacer.burst)
+
+        try:
+            while bytes_sent < limit and (deadline is None or time.perf_counter() < deadline):
+                count = min(chunk_size, limit - bytes_sent, self.pool_size - offset)
+                if pacer is not None:
+                    delay = pacer.reserve(count)
+                    if delay:
+                        await asyncio.sleep(delay)
+
+                if self._file is not None:
+                    sent = await loop.sendfile(writer.transport, self._file, offset, count)
+                    if sent == 0:
+                        break
+                else:
+                    writer.write(self._view[offset:offset + count])
+                    await writer.drain()
+                    sent = count
+
+                bytes_sent += sent
+                offset = (offset + sent) % self.pool_size
+                if counters is not None:
+                    counters.bytes_sent = bytes_sent
+        except (BrokenPipeError, ConnectionResetError):
+            # A client ending a duration transfer closes the connection on us
+            if deadline is None:
+                _count_send_error(counters)
+                raise
+        except OSError:
+            _count_send_error(counters)
+            raise
+
+        return bytes_sent
+
+    def close(self):
+        """Release the memfd backing the pattern, if any."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PayloadSink:
+    """Counts and discards payload uploaded by clients.
+
+    Uploaded bytes are never looked at, so every connection receives into
+    the same scratch buffer with recv_into; sinking an upload allocates
+    nothing per chunk or per connection and only keeps a byte count.
+    """
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """Allocate the scratch buffer.
+
+        Args:
+            chunk_size (int): Most bytes taken from the kernel per receive call.
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        self.buffer = bytearray(chunk_size)
+
+    def receive(self, sock: socket.socket, nbytes: int, deadline: Optional[float] = None,
+                counters: Optional['TransferCounters'] = None) -> Tuple[int, float]:
+        """Receive and discard data until EOF, nbytes or the deadline.
+
+        Args:
+            sock (socket.socket): Connected TCP socket
+            nbytes (int): Number of bytes to receive; 0 means no limit when a deadline is given
+            deadline (Optional[float]): time.perf_counter value to stop counting at
+            counters (Optional[TransferCounters]): Live counters kept up to date after every read
+
+        Returns:
+            Tuple[int, float]: Bytes received and the perf_counter value of the
+            last one (of the call if nothing arrived).
+        """
+        bytes_received = 0
+        last_byte_at = time.perf_counter()
+        limit = nbytes if nbytes or deadline is None else float('inf')
+
+        while bytes_received < limit and (deadline is None or last_byte_at < deadline):
+            count = sock.recv_into(self.buffer)
+            if not count:
+                break
+            bytes_received += count
+            last_byte_at = time.perf_counter()
+            if counters is not None:
+                counters.bytes_received = bytes_received
+
+        return bytes_received, last_byte_at
+
+
+class _SinkProtocol(asyncio.BufferedProtocol):
+    """Counts and discards one upload for AsyncSpeedTestServer.
+
+    Installed on a connection's transport in place of its stream protocol,
+    so the event loop reads straight into the PayloadSink's scratch buffer.
+    done resolves to (bytes received, perf_counter of the last byte) on EOF,
+    at the byte limit or at the deadline.
+    """
+
+    def __init__(self, buffer: bytearray, transport: asyncio.Transport,
+                 nbytes: int, deadline: Optional[float] = None,
+                 counters: Optional['TransferCounters'] = None):
+        self._buffer = memoryview(buffer)
+        self._transport = transport
+        self._counters = counters
+        self.limit = nbytes if nbytes or deadline is None else float('inf')
+        self.deadline = deadline
+        self.bytes_received = 0
+        self.last_byte_at = time.perf_counter()
+        self.done = asyncio.get_running_loop().create_future()
+        if self.limit == 0:
+            self.finish()
+
+    def get_buffer(self, sizehint: int):
+        return self._buffer
+
+    def buffer_updated(self, nbytes: int):
+        self.bytes_received += nbytes
+        self.last_byte_at = time.perf_counter()
+        if self._counters is not None:
+            self._counters.bytes_received = self.bytes_received
+        if self.bytes_received >= self.limit or \
+                (self.deadline is not None and self.last_byte_at >= self.deadline):
+            self.finish()
+
+    def eof_received(self) -> bool:
+        self.finish()
+        # Keep the transport open to send the report
+        return True
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if exc is not None and not self.done.done():
+            self.done.set_exception(exc)
+        self.finish()
+
+    def finish(self):
+        """Resolve done with what has been counted so far and stop reading."""
+        if not self.done.done():
+            self._transport.pause_reading()
+            self.done.set_result((self.bytes_received, self.last_byte_at))
+
+
+PAYLOAD_HEADER = struct.Struct('!IbQQI')
+TIMING_FIELD = struct.Struct('!IQ')  # transmission sequence number, send time in ns since the epoch
+SEGMENT_FIELD = struct.Struct('!Q')
+SEGMENT_FIELD_OFFSET = struct.calcsize('!IbQ')
+GSO_SIZE = struct.Struct('=H')
+SHARED_UDP_SNDBUF = 4 * 1024 * 1024
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)  # Linux UDP GSO, not exported before Python 3.12
+MAX_SEGMENT_SIZE = MAX_UDP_PAYLOAD - PAYLOAD_HEADER.size
+DEFAULT_SEGMENT_SIZE = 64000  # Close to UDP max size (65,535 bytes - headers)
+PACING_BURST_SECONDS = 0.001
+
+
+class TokenBucket:
+    """Paces a sender to a target bitrate.
+
+    Tokens are tracked as a byte balance refilled from a monotonic clock.
+    A send that overdraws the balance sleeps off the debt, and any
+    oversleep is credited back on the next call (up to the burst size),
+    so the average rate stays exact even with coarse sleep granularity.
+
+    A bucket belongs to the one thread or task sending with it. Only
+    set_rate may be called from elsewhere: it leaves the new rate for the
+    owner to pick up on its next reserve.
+    """
+
+    def __init__(self, rate_bps: float, burst_bytes: int):
+        """Create a bucket that starts full.
+
+        Args:
+            rate_bps (float): Target rate in bits per second
+            burst_bytes (int): Maximum bytes that may be sent back to back
+        """
+        if rate_bps <= 0:
+            raise ValueError("rate_bps must be positive")
+        self.rate = rate_bps / 8
+        self.burst = burst_bytes
+        self._tokens = float(burst_bytes)
+        self._last = time.perf_counter()
+        self._pending_rate = self.rate
+
+    def reserve(self, nbytes: int) -> float:
+        """Take nbytes from the bucket.
+
+        Returns:
+            float: Seconds the caller must wait before sending them.
+        """
+        now = time.perf_counter()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate) - nbytes
+        self._last = now
+        # A single read, so a concurrent set_rate is either seen whole or on the next call
+        self.rate = self._pending_rate
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def consume(self, nbytes: int):
+        """Take nbytes from the bucket, sleeping until the debt is repaid."""
+        delay = self.reserve(nbytes)
+        if delay:
+            time.sleep(delay)
+
+    def set_rate(self, rate_bps: float):
+        """Change the target rate from the owner's next reserve on; safe to call from any thread."""
+        if rate_bps <= 0:
+            raise ValueError("rate_bps must be positive")
+        self._pending_rate = rate_bps / 8
+
+
+class EgressLimiter:
+    """Shares a global egress rate evenly between active transfers.
+
+    Every transfer paces itself with its own TokenBucket, whose rate is
+    re-split as rate / active transfers whenever a transfer opens or
+    closes (a fluid approximation of fair queuing). A client that asks for
+    a lot cannot crowd out the others, and each admitted transfer knows
+    the rate it will get.
+    """
+
+    def __init__(self, rate_bps: float):
+        """Create a limiter for rate_bps bits per second of total egress."""
+        if rate_bps <= 0:
+            raise ValueError("rate_bps must be positive")
+        self.rate_bps = rate_bps
+        self._shares: Set[TokenBucket] = set()
+        self._lock = threading.Lock()
+
+    def open(self, burst_bytes: int) -> TokenBucket:
+        """Register a transfer and return the bucket it must pace itself with."""
+        with self._lock:
+            share = TokenBucket(self.rate_bps / (len(self._shares) + 1), burst_bytes)
+            self._shares.add(share)
+            self._rebalance()
+        return share
+
+    def close(self, share: TokenBucket):
+        """Unregister a transfer, giving its share back to the others."""
+        with self._lock:
+            if share in self._shares:
+                self._shares.remove(share)
+                self._rebalance()
+
+    def _rebalance(self):
+        for share in self._shares:
+            share.set_rate(self.rate_bps / len(self._shares))
+
+
+class UdpTransmitter:
+    """Sends one UDP transfer in batches of pre-built datagrams.
+
+    A buffer holding one datagram per payload slot (see payload_slots) is
+    laid out once with the constant header fields and payload, so sending
+    a batch only rewrites each datagram's segment counter in place. Segment
+    N always leaves from slot N % slots; batches hold a power of two of
+    datagrams and start at a multiple of it, so a batch is a contiguous
+    run of slots. Where the kernel supports UDP_SEGMENT the whole batch
+    leaves in one sendmsg call; the segment size travels with each call, so
+    transfers of different segment sizes can share one socket. Otherwise
+    each datagram is sent from a slice of the same buffer. Retransmitted
+    segments leave one per batch, from their own slot.
+
+    A transfer with a duration and a file_size of 0 streams until the
+    duration is over or until stop is called; its headers carry a total
+    segment count of 0. The duration counts from start, or from
+    construction if start is never called.
+
+    A reliable transfer resends the segments passed to retransmit ahead of
+    new ones, and after its first pass stays open for RELIABLE_LINGER
+    seconds past the last send or retransmit request.
+
+    With timestamps, a TIMING_FIELD follows the header of every datagram,
+    holding a sequence number counting transmissions (retransmissions
+    included) and the wall-clock time its batch was sent. The datagrams of
+    a batch share one send time, so delay and jitter measured from it
+    include the up to MAX_GSO_SEGMENTS datagrams of serialization within
+    a batch.
+
+    Slot i carries the pattern of the payload generator at
+    generator.datagram_offset(i, segment_size, slots), copied in once by
+    set_payload, so the client can check every segment against its number.
+    """
+
+    def __init__(self, magic_cookie: int, msg_type: int, file_size: int,
+                 segment_size: int, session_id: int = 0, use_gso: bool = True,
+                 max_batch_bytes: int = MAX_UDP_PAYLOAD,
+                 duration: Optional[float] = None, reliable: bool = False,
+                 timestamps: bool = False, generator: Optional[PayloadGenerator] = None):
+        """Build the batch buffer for a transfer.
+
+        Args:
+            magic_cookie (int): Magic cookie written into every header
+            msg_type (int): Payload message type written into every header
+            file_size (int): Total payload bytes to send
+            segment_size (int): Payload bytes per datagram
+            session_id (int): Session ID written into every header. Defaults to 0.
+            use_gso (bool): Try UDP generic segmentation offload. Defaults to True.
+            max_batch_bytes (int): Upper bound on bytes sent back to back in one batch.
+            duration (Optional[float]): Seconds to send for.
+            reliable (bool): Accept retransmit requests. Defaults to False.
+            timestamps (bool): Add a TIMING_FIELD to every datagram. Defaults to False.
+            generator (Optional[PayloadGenerator]): Payload content. Defaults to zeros.
+        """
+        self.file_size = file_size
+        self.segment_size = segment_size
+        self.session_id = session_id
+        self.duration = duration
+        self.reliable = reliable
+        self.timestamps = timestamps
+        self.sequence = 0
+        self.stopped = False
+        self.streaming = duration is not None and file_size == 0
+        self.total_segments = (file_size + segment_size - 1) // segment_size
+        self.next_segment = 0
+        self.retransmitted = 0
+        self.start()
+        self.header_size = PAYLOAD_HEADER.size + (TIMING_FIELD.size if timestamps else 0)
+        self.datagram_size = self.header_size + segment_size
+        self.slots = payload_slots(self.datagram_size)
+        limit = min(max_batch_bytes // self.datagram_size,
+                    self.slots if self.streaming else self.total_segments)
+        self.batch_count = self.slots
+        while self.batch_count > 1 and self.batch_count > limit:
+            self.batch_count //= 2
+        self._gso_cmsg = None
+        if use_gso and self.batch_count > 1:
+            self._gso_cmsg = [(SOL_UDP, UDP_SEGMENT, GSO_SIZE.pack(self.datagram_size))]
+
+        # retransmit may be called from another thread; only the sending
+        # thread moves requests from _requested into _resend
+        self._requested: Deque[List[int]] = deque()
+        self._resend: Deque[int] = deque()
+        self._resend_pending: Set[int] = set()
+        self._requested_at = 0.0
+        self._resending = False
+
+        self._batch = bytearray(self.datagram_size * self.slots)
+        for i in range(self.slots):
+            PAYLOAD_HEADER.pack_into(self._batch, i * self.datagram_size,
+                                     magic_cookie, msg_type, self.total_segments, 0, session_id)
+        self._view = memoryview(self._batch)
+        if generator is not None:
+            self.set_payload(generator)
+
+    def start(self):
+        """Restart the clock of the duration and the completion time; call when sending begins."""
+        self.started_at = self.last_sent_at = time.perf_counter()
+        self.deadline = None if self.duration is None else self.started_at + self.duration
+
+    def set_payload(self, generator: PayloadGenerator):
+        """Copy the payload of every slot out of generator's pattern."""
+        for i in range(self.slots):
+            start = i * self.datagram_size + self.header_size
+            offset = generator.datagram_offset(i, self.segment_size, self.slots)
+            self._batch[start:start + self.segment_size] = generator.pattern[offset:offset + self.segment_size]
+
+    @property
+    def done(self) -> bool:
+        if self.stopped or (self.deadline is not None and time.perf_counter() >= self.deadline):
+            return True
+        if self.streaming or self.next_segment < self.total_segments:
+            return False
+        if not self.reliable:
+            return True
+        return not self.has_pending and time.perf_counter() >= self.idle_until
+
+    @property
+    def has_pending(self) -> bool:
+        """Whether there is anything to send right now."""
+        self._collect_requests()
+        return bool(self._resend) or self.streaming or self.next_segment < self.total_segments
+
+    @property
+    def idle_until(self) -> float:
+        """perf_counter value at which a reliable transfer with nothing to send is done."""
+        return max(self.last_sent_at, self._requested_at) + RELIABLE_LINGER
+
+    @property
+    def bytes_sent(self) -> int:
+        """Payload bytes sent so far, not counting retransmissions."""
+        if self.streaming:
+            return self.next_segment * self.segment_size
+        return min(self.next_segment * self.segment_size, self.file_size)
+
+    def stop(self):
+        """End the transfer before its next batch."""
+        self.stopped = True
+
+    def retransmit(self, segments: List[int]):
+        """Queue already sent segments to be sent again; safe to call from any thread."""
+        self._requested.append(segments)
+        self._requested_at = time.perf_counter()
+
+    def _collect_requests(self):
+        while self._requested:
+            for segment in self._requested.popleft():
+                if segment < self.next_segment and segment not in self._resend_pending:
+                    self._resend_pending.add(segment)
+                    self._resend.append(segment)
+
+    def _payload_length(self, segment: int) -> int:
+        if self.streaming:
+            return self.segment_size
+        return min(self.segment_size, self.file_size - segment * self.segment_size)
+
+    def _next_batch(self) -> Tuple[int, int]:
+        """Return the first segment and the datagram count of the next batch."""
+        self._collect_requests()
+        if self._resend:
+            return self._resend[0], 1
+        first = self.next_segment
+        # Up to the next multiple of batch_count, which a partly sent batch may have left us short of
+        count = self.batch_count - first % self.batch_count
+        if not self.streaming:
+            count = min(count, self.total_segments - first)
+        return first, count
+
+    def next_batch_bytes(self) -> int:
+        """Return the number of bytes the next send_batch call will put on the wire."""
+        first, count = self._next_batch()
+        return (count - 1) * self.datagram_size + self.header_size + self._payload_length(first + count - 1)
+
+    def _fill_batch(self) -> Tuple[int, int, int]:
+        """Write the segment counters of the next batch.
+
+        Returns:
+            Tuple[int, int, int]: Buffer offset, datagram count and total byte length of the batch.
+        """
+        first, count = self._next_batch()
+        self._resending = bool(self._resend)
+        start = (first % self.slots) * self.datagram_size
+        for i in range(count):
+            SEGMENT_FIELD.pack_into(self._batch, start + i * self.datagram_size + SEGMENT_FIELD_OFFSET,
+                                    first + i)
+        if self.timestamps:
+            # One clock read per batch; its datagrams leave back to back
+            sent_ns = time.time_ns()
+            for i in range(count):
+                TIMING_FIELD.pack_into(self._batch, start + i * self.datagram_size + PAYLOAD_HEADER.size,
+                                       (self.sequence + i) & 0xffffffff, sent_ns)
+        length = (count - 1) * self.datagram_size + self.header_size + self._payload_length(first + count - 1)
+        return start, count, length
+
+    def _advance(self, count: int):
+        """Account for count datagrams of the current batch having been sent."""
+        self.sequence += count
+        if self._resending:
+            for _ in range(count):
+                self._resend_pending.discard(self._resend.popleft())
+            self.retransmitted += count
+        else:
+            self.next_segment += count
+        if self.reliable:
+            self.last_sent_at = time.perf_counter()
+
+    def send_batch(self, sock: socket.socket, address: Tuple[str, int]) -> int:
+        """Send the next batch of datagrams.
+
+        Args:
+            sock (socket.socket): UDP socket to send from
+            address (Tuple[str, int]): Client's address and port
+
+        Returns:
+            int: Number of datagrams sent.
+
+        Raises:
+            BlockingIOError: If a non-blocking sock is full. Datagrams sent
+                before that are accounted for, so the call can simply be retried.
+        """
+        start, count, length = self._fill_batch()
+        end = start + length
+
+        if self._gso_cmsg is not None:
+            try:
+                sock.sendmsg([self._view[start:end]], self._gso_cmsg, 0, address)
+                self._advance(count)
+                return count
+            except BlockingIOError:
+                raise
+            except OSError:
+                # Device or kernel refused offload; use plain datagrams from now on
+                self._gso_cmsg = None
+
+        for i in range(count):
+            offset = start + i * self.datagram_size
+            try:
+                sock.sendto(self._view[offset:min(offset + self.datagram_size, end)], address)
+            except BlockingIOError:
+                self._advance(i)
+                raise
+        self._advance(count)
+        return count
+
+
+@dataclass
+class UdpSession:
+    """Data class for one UDP transfer served by a UdpSessionScheduler."""
+    session_id: int
+    address: Tuple[str, int]
+    transmitter: UdpTransmitter
+    pacer: Optional[TokenBucket] = None
+    share: Optional[TokenBucket] = None
+    ready_at: float = 0.0
+    reserved: bool = False
+    duration: Optional[float] = None
+    counters: Optional['TransferCounters'] = None
+    payload: Optional[Tuple[str, float, Optional[int]]] = None  # payload options of the request
+
+    def reserve(self, nbytes: int) -> float:
+        """Take nbytes from the session's pacer and egress share; return the longer wait."""
+        delay = 0.0
+        if self.pacer is not None:
+            delay = self.pacer.reserve(nbytes)
+        if self.share is not None:
+            delay = max(delay, self.share.reserve(nbytes))
+        return delay
+
+
+class UdpSessionScheduler:
+    """Round-robin sender for every UDP session served from one socket.
+
+    Each pass over the active sessions sends at most one batch per session
+    whose pacer allows it, so concurrent transfers interleave on the wire
+    and all replies leave from the server's bound UDP port.
+    """
+
+    def __init__(self, sock: socket.socket,
+                 on_complete: Callable[[UdpSession], None],
+                 on_error: Callable[[UdpSession, Exception], None]):
+        """Create a scheduler sending on sock.
+
+        Args:
+            sock (socket.socket): Bound UDP socket shared by all sessions
+            on_complete (Callable): Called with each session that finished sending
+            on_error (Callable): Called with each session that failed and its exception
+        """
+        self.sock = sock
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self._sessions: Dict[Tuple[Tuple[str, int], int], UdpSession] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def add(self, session: UdpSession) -> bool:
+        """Register a session.
+
+        Returns:
+            bool: False if the same client already has a session with this ID.
+        """
+        key = (session.address, session.session_id)
+        with self._lock:
+            if key in self._sessions:
+                return False
+            self._sessions[key] = session
+            return True
+
+    def stop(self, address: Tuple[str, int], session_id: int) -> bool:
+        """Ask a session to finish; it completes on the next pass.
+
+        Returns:
+            bool: False if no such session is active.
+        """
+        with self._lock:
+            session = self._sessions.get((address, session_id))
+            if session is None:
+                return False
+            session.transmitter.stop()
+            session.ready_at = 0.0
+            return True
+
+    def retransmit(self, address: Tuple[str, int], session_id: int, segments: List[int]) -> bool:
+        """Queue segments of a reliable session to be sent again.
+
+        Returns:
+            bool: False if no such reliable session is active.
+        """
+        with self._lock:
+            session = self._sessions.get((address, session_id))
+        if session is None or not session.transmitter.reliable:
+            return False
+        session.transmitter.retransmit(segments)
+        return True
+
+    def _remove(self, session: UdpSession):
+        with self._lock:
+            self._sessions.pop((session.address, session.session_id), None)
+
+    def run_once(self) -> Optional[float]:
+        """Make one round-robin pass over the active sessions.
+
+        Returns:
+            Optional[float]: None when no session is active, otherwise the
+            seconds until some session may send again (0 if one may already).
+
+        Raises:
+            BlockingIOError: If a non-blocking socket is full; retry once writable.
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+        if not sessions:
+            return None
+
+        now = time.perf_counter()
+        next_ready = float('inf')
+        for session in sessions:
+            if session.transmitter.done:
+                # Stopped by the client or past its deadline
+                self._remove(session)
+                self.on_complete(session)
+                continue
+            if session.ready_at > now:
+                next_ready = min(next_ready, session.ready_at)
+                continue
+            if not session.transmitter.has_pending:
+                # Reliable session waiting for retransmit requests
+                next_ready = min(next_ready, session.transmitter.idle_until)
+                continue
+            try:
+                if (session.pacer is not None or session.share is not None) and not session.reserved:
+                    delay = session.reserve(session.transmitter.next_batch_bytes())
+                    session.reserved = True
+                    if delay:
+                        session.ready_at = now + delay
+                        next_ready = min(next_ready, session.ready_at)
+                        continue
+
+                session.transmitter.send_batch(self.sock, session.address)
+                session.reserved = False
+                if session.counters is not None:
+                    session.counters.bytes_sent = session.transmitter.bytes_sent
+                    session.counters.packets_sent = session.transmitter.sequence
+            except BlockingIOError:
+                raise
+            except Exception as e:
+                _count_send_error(session.counters)
+                self._remove(session)
+                self.on_error(session, e)
+                continue
+
+            if session.transmitter.done:
+                self._remove(session)
+                self.on_complete(session)
+            else:
+                next_ready = now
+
+        if next_ready == float('inf'):
+            return None if not self._sessions else 0.0
+        return max(0.0, next_ready - time.perf_counter())
+
+
+@dataclass
+class ServerStats:
+    """Data class for counting what a server (or one worker) has served."""
+    tcp_transfers: int = 0
+    udp_transfers: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    failed_transfers: int = 0
+    rejected_requests: int = 0
+    retransmitted_segments: int = 0
+
+    def merge(self, other: 'ServerStats'):
+        """Add other's counters to this one."""
+        for field in fields(self):
+            setattr(self, field.name, getattr(self, field.name) + getattr(other, field.name))
+
+
+class TransferCounters:
+    """Live progress of one transfer.
+
+    Written only by the thread or task moving the transfer's data, with
+    plain attribute stores and no lock, and read when metrics are scraped.
+    """
+    __slots__ = ('bytes_sent', 'bytes_received', 'packets_sent', 'send_errors')
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.packets_sent = 0  # UDP datagrams, retransmissions included; TCP leaves it at 0
+        self.send_errors = 0  # failed send calls
+
+
+def _count_send_error(counters: Optional[TransferCounters]):
+    """Count a send call that raised, if the transfer has counters."""
+    if counters is not None:
+        counters.send_errors += 1
+
+
+@dataclass
+class _LiveTransfer:
+    """Data class for a transfer registered with ServerMetrics."""
+    protocol: str
+    client: str
+    session_id: Optional[int]
+    counters: TransferCounters
+
+
+def _transfer_labels(transfer: _LiveTransfer) -> str:
+    """Format the Prometheus labels identifying one live transfer."""
+    labels = f'protocol="{transfer.protocol.lower()}",client="{transfer.client}"'
+    if transfer.session_id is not None:
+        labels += f',session="{transfer.session_id}"'
+    return '{' + labels + '}'
+
+
+class ServerMetrics:
+    """Metrics registry of a running server, rendered in Prometheus text format.
+
+    Transfer, failure and reject counts are read from the server's
+    ServerStats. Byte, packet and send error totals are the counters of
+    finished transfers, folded in when they are closed, plus the
+    TransferCounters of transfers still in progress, so they grow while
+    data flows and never go down. Transfers in progress also export their
+    own byte counters; rates are left to the scraper (rate() in PromQL),
+    so rendering changes no state and any number of scrapers can share the
+    endpoint. The registry lock is only taken when a transfer opens or
+    closes and when metrics are scraped, never per chunk.
+    """
+
+    def __init__(self, stats: ServerStats):
+        self.stats = stats
+        self._live: Dict[int, _LiveTransfer] = {}
+        self._totals = TransferCounters()
+        self._lock = threading.Lock()
+        self._httpd: Optional[http.server.ThreadingHTTPServer] = None
+
+    def open(self, protocol: str, address: Tuple[str, int],
+             session_id: Optional[int] = None) -> TransferCounters:
+        """Register a transfer and return the counters its sender must keep up to date.
+
+        Args:
+            protocol (str): "TCP" or "UDP"
+            address (Tuple[str, int]): Client's address and port
+            session_id (Optional[int]): UDP session ID
+        """
+        counters = TransferCounters()
+        live = _LiveTransfer(protocol, f"{address[0]}:{address[1]}", session_id, counters)
+        with self._lock:
+            self._live[id(counters)] = live
+        return counters
+
+    def close(self, counters: TransferCounters):
+        """Unregister a finished or failed transfer, adding its counters to the totals."""
+        with self._lock:
+            if self._live.pop(id(counters), None) is None:
+                return
+            self._totals.bytes_sent += counters.bytes_sent
+            self._totals.bytes_received += counters.bytes_received
+            self._totals.packets_sent += counters.packets_sent
+            self._totals.send_errors += counters.send_errors
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            live = [(transfer, transfer.counters.bytes_sent, transfer.counters.bytes_received)
+                    for transfer in self._live.values()]
+            bytes_sent = self._totals.bytes_sent
+            bytes_received = self._totals.bytes_received
+            packets_sent = self._totals.packets_sent
+            send_errors = self._totals.send_errors
+            for transfer, sent, received in live:
+                bytes_sent += sent
+                bytes_received += received
+                packets_sent += transfer.counters.packets_sent
+                send_errors += transfer.counters.send_errors
+
+        stats = self.stats
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: List[Tuple[str, float]]):
+            lines.append(f"# HELP speedtest_{name} {help_text}")
+            lines.append(f"# TYPE speedtest_{name} {kind}")
+            lines.extend(f"speedtest_{name}{labels} {value}" for labels, value in samples)
+
+        metric('active_sessions', 'gauge', "Transfers in progress.",
+               [(f'{{protocol="{protocol.lower()}"}}',
+                 sum(transfer.protocol == protocol for transfer, _, _ in live)) for protocol in ('TCP', 'UDP')])
+        metric('transfers_total', 'counter', "Completed transfers.",
+               [('{protocol="tcp"}', stats.tcp_transfers), ('{protocol="udp"}', stats.udp_transfers)])
+        metric('bytes_sent_total', 'counter', "Payload bytes sent.", [('', bytes_sent)])
+        metric('bytes_received_total', 'counter', "Payload bytes received from uploads.", [('', bytes_received)])
+        metric('packets_sent_total', 'counter', "UDP datagrams sent, retransmissions included.",
+               [('{protocol="udp"}', packets_sent)])
+        metric('send_errors_total', 'counter', "Send calls that failed.", [('', send_errors)])
+        metric('failed_transfers_total', 'counter', "Transfers that ended with an error.",
+               [('', stats.failed_transfers)])
+        metric('rejected_requests_total', 'counter', "Requests refused by admission control.",
+               [('', stats.rejected_requests)])
+        metric('retransmitted_segments_total', 'counter', "Segments resent for reliable UDP transfers.",
+               [('', stats.retransmitted_segments)])
+        metric('session_bytes_sent_total', 'counter', "Payload bytes sent by each transfer in progress.",
+               [(_transfer_labels(transfer), sent) for transfer, sent, _ in live])
+        metric('session_bytes_received_total', 'counter', "Payload bytes received by each transfer in progress.",
+               [(_transfer_labels(transfer), received) for transfer, _, received in live])
+        return '\n'.join(lines) + '\n'
+
+    def start_endpoint(self, port: int, host: str = '127.0.0.1'):
+        """Serve render() at http://host:port/metrics from a daemon thread."""
+        self._httpd = http.server.ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.metrics = self
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop_endpoint(self):
+        """Stop serving metrics, if the endpoint is running."""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answers GET /metrics with ServerMetrics.render."""
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be logged to stderr
+        pass
+
+
+def _describe_tcp_info(sock: socket.socket) -> str:
+    """Summarize what TCP_INFO says about sending on sock, for a completion log line.
+
+    Returns:
+        str: The summary in parentheses, or an empty string where TCP_INFO is unavailable.
+    """
+    if not hasattr(socket, 'TCP_INFO'):
+        return ''
+    try:
+        info = read_tcp_info(sock)
+    except OSError:
+        return ''
+    return (f" (rtt {info.rtt * 1000:.3f} ms, min rtt {info.min_rtt * 1000:.3f} ms, cwnd {info.cwnd} segments, "
+            f"retransmits {info.retransmits}, delivery rate {info.delivery_rate:.0f} bits/second)")
+
+
+@dataclass
+class ServerLimits:
+    """Data class for admission limits; None means unlimited."""
+    max_tcp_sessions: Optional[int] = None
+    max_udp_sessions: Optional[int] = None
+    max_request_bytes: Optional[int] = None
+    egress_rate: Optional[int] = None  # bits per second shared by all transfers
+    max_duration: Optional[float] = None  # seconds a duration request may ask for
+
+
 class SpeedTestServer:
     MAGIC_COOKIE = 0xabcddcba
     OFFER_MESSAGE_TYPE = 0x2
     REQUEST_MESSAGE_TYPE = 0x3
     PAYLOAD_MESSAGE_TYPE = 0x4
+    TIMED_PAYLOAD_MESSAGE_TYPE = 0x8
+    REJECT_MESSAGE_TYPE = 0x5
+    STOP_MESSAGE_TYPE = 0x6
+    NACK_MESSAGE_TYPE = 0x7
+    READY_MESSAGE_TYPE = 0x9
+    REPORT_MESSAGE_TYPE = 0xa
+    PROBE_MESSAGE_TYPE = 0xb
+    PROBE_REPLY_MESSAGE_TYPE = 0xc
+    REJECT_SERVER_BUSY = 0x1
+    REJECT_REQUEST_TOO_LARGE = 0x2
+    REQUEST_HEADER = struct.Struct('!IbQ')
+    REJECT_MESSAGE = struct.Struct('!IbB')
+    STOP_MESSAGE = struct.Struct('!IbI')
+    NACK_HEADER = NACK_HEADER
+    READY_MESSAGE = struct.Struct('!Ib')
+    REPORT_MESSAGE = struct.Struct('!IbQQ')
+    PROBE_MESSAGE = struct.Struct('!IbQ')
+    PROBE_REPLY_MESSAGE = struct.Struct('!IbQHHI')
 
-    def __init__(self, team_name, broadcast_port: int = 13117):
+    def __init__(self, team_name, broadcast_port: int = 13117,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, backlog: int = socket.SOMAXCONN,
+                 limits: Optional[ServerLimits] = None, metrics_port: Optional[int] = None,
+                 payload: Optional[PayloadGenerator] = None, tcp_tuning: Optional[TcpTuning] = None):
         """Initialize a new SpeedTestServer instance.
 
         Sets up the server with random TCP and UDP ports, initializes logging,
@@ -61,6 +1177,18 @@ class SpeedTestServer:
 
         Args:
             broadcast_port (int): Port number for broadcasting server offers. Defaults to 13117.
+            chunk_size (int): Bytes per TCP send call. Defaults to DEFAULT_CHUNK_SIZE.
+            backlog (int): TCP accept backlog. Defaults to socket.SOMAXCONN.
+            limits (Optional[ServerLimits]): Admission limits. Defaults to unlimited.
+            metrics_port (Optional[int]): Local port serving Prometheus metrics at /metrics.
+                Defaults to no metrics endpoint.
+            payload (Optional[PayloadGenerator]): Payload of requests that do not ask for one.
+                Defaults to an unseeded random pattern.
+            tcp_tuning (Optional[TcpTuning]): Socket options of every TCP connection. Defaults to
+                the kernel's defaults.
+
+        Raises:
+            OSError: If the host cannot apply an option of tcp_tuning
         """
         self.team_name = team_name
         self.ip_address = get_server_ip()
@@ -69,6 +1197,28 @@ class SpeedTestServer:
         self.udp_port = _get_random_port()
         self.running = False
         self.logger = setup_logger('SpeedTestServer', Fore.CYAN)
+        self.payload = PayloadEngine(chunk_size, generator=payload)
+        self._payload_patterns: Dict[Tuple[str, int], PayloadGenerator] = {}
+        self._payload_lock = threading.Lock()
+        # Generates patterns one at a time, off the threads and event loop serving requests
+        self._payload_executor = ThreadPoolExecutor(max_workers=1)
+        self.sink = PayloadSink(chunk_size)
+        self.backlog = backlog
+        self.reuse_port = False
+        self.stats = ServerStats()
+        self._stats_lock = threading.Lock()
+        self.metrics = ServerMetrics(self.stats)
+        self.metrics_port = metrics_port
+        self._udp_scheduler: Optional[UdpSessionScheduler] = None
+        self._udp_wakeup = threading.Event()
+        self.limits = limits or ServerLimits()
+        self.egress = EgressLimiter(self.limits.egress_rate) if self.limits.egress_rate else None
+        self._active_tcp_sessions = 0
+        # Admitted UDP sessions not registered with the scheduler yet, e.g. waiting for their payload
+        self._pending_udp_sessions = 0
+        self.tcp_tuning = tcp_tuning or TcpTuning()
+        for warning in check_tcp_tuning(self.tcp_tuning):
+            self.logger.warning(warning)
 
     def _create_offer_message(self) -> bytes:
         """Create a formatted offer message for broadcasting.
@@ -98,21 +1248,260 @@ class SpeedTestServer:
         """
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.logger.info("Server started, listening on IP address %s", self.ip_address)
             while self.running:
                 try:
-                    self.logger.info(f"Server started, listening on IP address {self.ip_address}")
                     sock.sendto(self._create_offer_message(),
                                 ('<broadcast>', self.broadcast_port))  # broadcast_port is destination port for broadcasting which the client listens on
                     time.sleep(1)
                 except Exception as e:
-                    self.logger.error(f"Error broadcasting offer: {e}")
+                    self.logger.error("Error broadcasting offer: %s", e)
+
+    def _record_transfer(self, protocol: str, bytes_sent: int):
+        """Count one completed transfer; called once per transfer, not per chunk."""
+        with self._stats_lock:
+            if protocol == 'TCP':
+                self.stats.tcp_transfers += 1
+            else:
+                self.stats.udp_transfers += 1
+            self.stats.bytes_sent += bytes_sent
+
+    def _record_upload(self, bytes_received: int):
+        """Count one completed TCP upload."""
+        with self._stats_lock:
+            self.stats.tcp_transfers += 1
+            self.stats.bytes_received += bytes_received
+
+    def _record_failure(self):
+        """Count one transfer that ended with an error."""
+        with self._stats_lock:
+            self.stats.failed_transfers += 1
+
+    def _log_tcp_transfer(self, bytes_sent: int, address: Tuple[str, int], sock: socket.socket):
+        """Log a completed TCP download with the sender's TCP_INFO.
+
+        TCP_INFO is read here, while the socket is still open, and only if
+        the record will be logged at all.
+        """
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("Completed TCP transfer of %s bytes to %s,%s%s",
+                             bytes_sent, address, self.team_name, _describe_tcp_info(sock), extra=RESULT)
+
+    def _admit(self, protocol: str, file_size: int, duration: Optional[float] = None) -> Optional[int]:
+        """Apply the admission limits to a new request.
+
+        Admitted TCP requests count against max_tcp_sessions until
+        _release_tcp_session is called. An admitted UDP session holds a
+        reserved slot until _add_udp_session registers it with the
+        scheduler, which counts it from then on. A duration request without a file size has no
+        byte bound, so max_request_bytes alone rejects it; it is only
+        admitted when max_duration bounds it instead.
+
+        Returns:
+            Optional[int]: None if admitted, otherwise the reject reason code.
+        """
+        limits = self.limits
+        unbounded = duration is not None and file_size == 0
+        if limits.max_request_bytes is not None and (
+                file_size > limits.max_request_bytes or unbounded and limits.max_duration is None):
+            reason = self.REJECT_REQUEST_TOO_LARGE
+        elif limits.max_duration is not None and duration is not None and duration > limits.max_duration:
+            reason = self.REJECT_REQUEST_TOO_LARGE
+        elif protocol == 'TCP':
+            with self._stats_lock:
+                if limits.max_tcp_sessions is not None and \
+                        self._active_tcp_sessions >= limits.max_tcp_sessions:
+                    reason = self.REJECT_SERVER_BUSY
+                else:
+                    self._active_tcp_sessions += 1
+                    return None
+        else:
+            with self._stats_lock:
+                if limits.max_udp_sessions is not None and \
+                        len(self._udp_scheduler) + self._pending_udp_sessions >= limits.max_udp_sessions:
+                    reason = self.REJECT_SERVER_BUSY
+                else:
+                    self._pending_udp_sessions += 1
+                    return None
+
+        with self._stats_lock:
+            self.stats.rejected_requests += 1
+        return reason
+
+    def _release_tcp_session(self):
+        with self._stats_lock:
+            self._active_tcp_sessions -= 1
+
+    def _cached_payload(self, spec: Optional[Tuple[str, float, Optional[int]]]) -> Optional[PayloadGenerator]:
+        """Return the generator for a request's payload options, or None if its pattern is not built yet.
+
+        Seeds only pick an offset, so every seed of a mode and ratio is a
+        view of the same cached pattern.
+        """
+        if spec is None:
+            return self.payload.generator
+        mode, ratio, seed = spec
+        key = pattern_key(mode, ratio)
+        with self._payload_lock:
+            pattern = self._payload_patterns.get(key)
+        if pattern is None and key == self.payload.generator.key:
+            pattern = self.payload.generator
+        return None if pattern is None else pattern.reseeded(seed)
+
+    def _generate_payload(self, spec: Tuple[str, float, Optional[int]]) -> PayloadGenerator:
+        """Build and cache the pattern of a request's payload options; runs on the payload executor.
+
+        The MAX_CACHED_PAYLOADS most recently built patterns are kept.
+        """
+        generator = self._cached_payload(spec)
+        if generator is not None:
+            # Built for a request queued before this one
+            return generator
+        mode, ratio, seed = spec
+        pattern = PayloadGenerator(mode, ratio)
+        with self._payload_lock:
+            if len(self._payload_patterns) >= MAX_CACHED_PAYLOADS:
+                del self._payload_patterns[next(iter(self._payload_patterns))]
+            self._payload_patterns[pattern.key] = pattern
+        return pattern.reseeded(seed)
+
+    def _payload_engine(self, spec: Optional[Tuple[str, float, Optional[int]]]) -> PayloadEngine:
+        """Return the engine sending an admitted TCP request's payload, waiting for its pattern if needed."""
+        if spec is None:
+            return self.payload
+        generator = self._cached_payload(spec)
+        if generator is None:
+            generator = self._payload_executor.submit(self._generate_payload, spec).result()
+        return PayloadEngine(self.payload.chunk_size, generator=generator)
+
+    def _create_reject_message(self, reason: int) -> bytes:
+        """Create a reject message telling the client why its request was refused."""
+        return self.REJECT_MESSAGE.pack(self.MAGIC_COOKIE, self.REJECT_MESSAGE_TYPE, reason)
+
+    def _create_ready_message(self) -> bytes:
+        """Create the message telling an upload client to start sending."""
+        return self.READY_MESSAGE.pack(self.MAGIC_COOKIE, self.READY_MESSAGE_TYPE)
+
+    def _create_report_message(self, bytes_received: int, receive_time: float) -> bytes:
+        """Create the message reporting what the server received of an upload.
+
+        Args:
+            bytes_received (int): Payload bytes received
+            receive_time (float): Seconds from the ready message to the last byte received
+        """
+        return self.REPORT_MESSAGE.pack(self.MAGIC_COOKIE, self.REPORT_MESSAGE_TYPE,
+                                        bytes_received, int(receive_time * 1e9))
+
+    def _create_probe_reply(self, token: int) -> bytes:
+        """Create the reply to a unicast probe, echoing its token and carrying the current load.
+
+        The load is the number of active TCP and UDP transfers (of this
+        worker, when several share the ports).
+        """
+        with self._stats_lock:
+            load = self._active_tcp_sessions + self._pending_udp_sessions
+        load += len(self._udp_scheduler)
+        return self.PROBE_REPLY_MESSAGE.pack(self.MAGIC_COOKIE, self.PROBE_REPLY_MESSAGE_TYPE, token,
+                                             self.udp_port, self.tcp_port, load)
+
+    def _bind_listener(self, sock: socket.socket, port: int):
+        """Bind a listening socket, sharing the port with other workers if reuse_port is set."""
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', port))
+
+    def _parse_tcp_request(self, request: bytes) -> Tuple[int, Optional[float], str,
+                                                        Optional[Tuple[str, float, Optional[int]]]]:
+        """Parse a TCP request line.
+
+        The file size may be followed by options:
+        - duration: stream for this many seconds; the file size, if not 0, still caps the transfer
+        - direction: download (default) for the server to send, upload for the client to send
+        - payload, ratio, seed: PayloadGenerator mode, compression ratio and seed (default the server's payload)
+
+        Args:
+            request (bytes): Request line sent by the client
+
+        Returns:
+            Tuple[int, Optional[float], str, Optional[Tuple[str, float, Optional[int]]]]: Requested
+            file size in bytes, duration in seconds, direction and payload options.
+
+        Raises:
+            ValueError: If the request or an option is malformed
+        """
+        size, _, text = request.decode().strip().partition(' ')
+        options = _parse_request_options(text)
+        return int(size), _parse_duration(options), _parse_direction(options), _parse_payload(options)
+
+    def _create_udp_session(self, request: bytes, address: Tuple[str, int]) -> Optional[UdpSession]:
+        """Parse a UDP request and prepare the session it asks for.
+
+        The fixed request header may be followed by options:
+        - segment_size: payload bytes per datagram (default DEFAULT_SEGMENT_SIZE)
+        - rate: target bitrate in bits/second, paced with a TokenBucket (default unpaced)
+        - session: 32-bit session ID echoed in every payload header (default random)
+        - duration: stream for this many seconds; a file_size of 0 means no size limit
+        - reliable: 1 to resend segments the client reports missing in NACK messages
+        - timestamps: 1 to send timed payload messages carrying a sequence number and send time
+        - payload, ratio, seed: PayloadGenerator mode, compression ratio and seed (default the server's payload)
+
+        Args:
+            request (bytes): Request datagram sent by the client
+            address (Tuple[str, int]): Client's address and port
+
+        Returns:
+            Optional[UdpSession]: The session, or None if the request is corrupted. Its
+            payload is filled in by _start_udp_session once it is admitted.
+
+        Raises:
+            ValueError: If an option is malformed or out of range
+        """
+        magic_cookie, msg_type, file_size = self.REQUEST_HEADER.unpack_from(request)
+
+        if magic_cookie != self.MAGIC_COOKIE or msg_type != self.REQUEST_MESSAGE_TYPE:
+            self.logger.warning("Received request corrupted UDP packet, ignoring...")
+            return None
+
+        options = _parse_request_options(request[self.REQUEST_HEADER.size:].decode('ascii'))
+        segment_size = int(options.get('segment_size', DEFAULT_SEGMENT_SIZE))
+        rate = int(options.get('rate', 0))
+        session_id = int(options.get('session', random.getrandbits(32)))
+        duration = _parse_duration(options)
+        reliable = _parse_flag(options, 'reliable')
+        timestamps = _parse_flag(options, 'timestamps')
+        payload = _parse_payload(options)
+        header_size = PAYLOAD_HEADER.size + (TIMING_FIELD.size if timestamps else 0)
+        max_segment_size = MAX_UDP_PAYLOAD - header_size
+        if not 0 < segment_size <= max_segment_size:
+            raise ValueError(f"segment_size must be between 1 and {max_segment_size}")
+        if rate < 0:
+            raise ValueError("rate must not be negative")
+        if not 0 <= session_id < 2 ** 32:
+            raise ValueError("session must be a 32-bit unsigned integer")
+        if reliable and duration is not None:
+            raise ValueError("reliable transfers need a file size, not a duration")
+
+        pacer = None
+        max_batch_bytes = MAX_UDP_PAYLOAD
+        if rate:
+            # Keep bursts to about a millisecond of traffic at the target rate
+            max_batch_bytes = int(rate / 8 * PACING_BURST_SECONDS)
+            pacer = TokenBucket(rate, max(max_batch_bytes, header_size + segment_size))
+        msg_type = self.TIMED_PAYLOAD_MESSAGE_TYPE if timestamps else self.PAYLOAD_MESSAGE_TYPE
+        transmitter = UdpTransmitter(self.MAGIC_COOKIE, msg_type,
+                                     file_size, segment_size, session_id,
+                                     max_batch_bytes=max_batch_bytes, duration=duration,
+                                     reliable=reliable, timestamps=timestamps)
+        return UdpSession(session_id, address, transmitter, pacer, duration=duration, payload=payload)
 
     def _handle_tcp_client(self, client_socket: socket.socket,
                            address: Tuple[str, int]):
         """Handle individual TCP client connections.
 
-        Receives requested file size from client and streams random data
-        in response.
+        Receives requested file size from client and streams data from the
+        shared payload engine in response. For an upload request it instead
+        sends a ready message, sinks what the client sends into the shared
+        payload sink and replies with a report message.
 
         Args:
             client_socket (socket.socket): Connected client socket
@@ -121,75 +1510,221 @@ class SpeedTestServer:
         Notes:
             Closes client socket when transfer is complete or on error.
         """
+        admitted = False
+        share = None
+        counters = None
         try:
             client_socket.settimeout(2)
             # Receive the requested file size
-            size_str = client_socket.recv(1024).decode().strip()
-            file_size = int(size_str)
+            file_size, duration, direction, payload_spec = self._parse_tcp_request(client_socket.recv(1024))
 
-            # Generate and send random data
-            bytes_sent = 0
-            chunk_size = 8192
+            reason = self._admit('TCP', file_size, duration)
+            if reason is not None:
+                client_socket.sendall(self._create_reject_message(reason))
+                self.logger.warning("Rejected TCP request of %s bytes from %s", file_size, address)
+                return
+            admitted = True
+            counters = self.metrics.open('TCP', address)
 
-            while bytes_sent < file_size:
-                remaining = file_size - bytes_sent
-                current_chunk = min(chunk_size, remaining)
-                data = random.randbytes(current_chunk)
-                client_socket.sendall(data)
-                bytes_sent += current_chunk
+            if direction == UPLOAD:
+                client_socket.sendall(self._create_ready_message())
+                started = time.perf_counter()
+                deadline = None if duration is None else started + duration + UPLOAD_GRACE
+                bytes_received, last_byte_at = self.sink.receive(client_socket, file_size, deadline, counters)
+                client_socket.sendall(self._create_report_message(bytes_received, last_byte_at - started))
+                self._record_upload(bytes_received)
+                self.logger.info(
+                    "Completed TCP upload of %s bytes from %s,%s", bytes_received, address, self.team_name,
+                    extra=RESULT)
+                return
 
-            self.logger.info(
-                f"Completed TCP transfer of {file_size} bytes to {address},{self.team_name}")
+            payload = self._payload_engine(payload_spec)
+            if self.egress is not None:
+                share = self.egress.open(PACED_CHUNK_SIZE)
+
+            # Stream the pre-generated payload pattern
+            deadline = None if duration is None else time.perf_counter() + duration
+            bytes_sent = payload.send(client_socket, file_size, share, deadline, counters)
+            self._record_transfer('TCP', bytes_sent)
+
+            self._log_tcp_transfer(bytes_sent, address, client_socket)
 
         except Exception as e:
-            self.logger.error(f"Error handling TCP client {address}: {e}")
+            self._record_failure()
+            self.logger.error("Error handling TCP client %s: %s", address, e)
         except socket.timeout:
-            self.logger.error(f"Client {address} timed out due to inactivity.")
+            self._record_failure()
+            self.logger.error("Client %s timed out due to inactivity.", address)
         finally:
+            if share is not None:
+                self.egress.close(share)
+            if counters is not None:
+                self.metrics.close(counters)
+            if admitted:
+                self._release_tcp_session()
             client_socket.close()
 
     def _handle_udp_client(self, request: bytes, address: Tuple[str, int]):
-        """Handle individual UDP client requests with optimized segment size."""
+        """Handle individual UDP client requests by queueing a session on the UDP scheduler.
+
+        A stop message ends the client's matching session instead, a NACK
+        message queues the segments it reports missing for resending, and a
+        probe message is answered right away with a probe reply.
+        """
         try:
+            if len(request) == self.PROBE_MESSAGE.size:
+                magic_cookie, msg_type, token = self.PROBE_MESSAGE.unpack(request)
+                if magic_cookie == self.MAGIC_COOKIE and msg_type == self.PROBE_MESSAGE_TYPE:
+                    self._udp_scheduler.sock.sendto(self._create_probe_reply(token), address)
+                    return
+
+            if len(request) == self.STOP_MESSAGE.size:
+                magic_cookie, msg_type, session_id = self.STOP_MESSAGE.unpack(request)
+                if magic_cookie == self.MAGIC_COOKIE and msg_type == self.STOP_MESSAGE_TYPE:
+                    if self._udp_scheduler.stop(address, session_id):
+                        self._udp_wakeup.set()
+                    return
+
+            if len(request) >= self.NACK_HEADER.size:
+                magic_cookie, msg_type, session_id, base, end = self.NACK_HEADER.unpack_from(request)
+                if magic_cookie == self.MAGIC_COOKIE and msg_type == self.NACK_MESSAGE_TYPE:
+                    missing = _missing_segments(memoryview(request)[self.NACK_HEADER.size:], base, end)
+                    if self._udp_scheduler.retransmit(address, session_id, missing):
+                        self._udp_wakeup.set()
+                    return
+
             # Parse request
-            magic_cookie, msg_type, file_size = struct.unpack('!IbQ', request)
+            session = self._create_udp_session(request, address)
+            if session is None:
+                return
 
-            if magic_cookie != self.MAGIC_COOKIE or msg_type != self.REQUEST_MESSAGE_TYPE:
-                self.logger.warning("Received request corrupted UDP packet, ignoring...")
+            reason = self._admit('UDP', session.transmitter.file_size, session.duration)
+            if reason is not None:
+                self._udp_scheduler.sock.sendto(self._create_reject_message(reason), address)
+                self.logger.warning(
+                    "Rejected UDP request of %s bytes from %s", session.transmitter.file_size, address)
                 return
+            self._start_udp_session(session)
 
-            # Set maximum feasible segment size
-            segment_size = 64000  # Close to UDP max size (65,535 bytes - headers)
-            total_segments = (file_size + segment_size - 1) // segment_size
+        except Exception as e:
+            self._record_failure()
+            self.logger.error("Error handling UDP client %s: %s", address, e)
 
-            # Pre-generate a payload of max size for efficiency
-            payload = b'\x00' * segment_size
+    def _start_udp_session(self, session: UdpSession):
+        """Give an admitted UDP session its payload and hand it to the scheduler.
 
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-                # Increase socket buffer size for large packets
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65535)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65535)
+        A pattern that is not cached yet is built on the payload executor
+        first, so the thread or event loop receiving requests never waits
+        for it.
+        """
+        try:
+            generator = self._cached_payload(session.payload)
+            if generator is None:
+                self._payload_executor.submit(self._generate_udp_payload, session)
+                return
+        except Exception:
+            self._release_udp_reservation()
+            raise
+        self._add_udp_session(session, generator)
 
-                header_base = struct.pack('!IbQ', self.MAGIC_COOKIE, self.PAYLOAD_MESSAGE_TYPE, total_segments)
+    def _release_udp_reservation(self):
+        """Give back the slot _admit reserved for a UDP session."""
+        with self._stats_lock:
+            self._pending_udp_sessions -= 1
 
-                for segment in range(total_segments):
-                    remaining = file_size - (segment * segment_size)
-                    current_chunk_size = min(segment_size, remaining)
+    def _generate_udp_payload(self, session: UdpSession):
+        """Build the pattern of a UDP session on the payload executor, then add the session."""
+        try:
+            generator = self._generate_payload(session.payload)
+        except Exception as e:
+            self._release_udp_reservation()
+            self._record_failure()
+            self.logger.error("Error handling UDP client %s: %s", session.address, e)
+            return
+        self._call_soon(self._add_udp_session, session, generator)
 
-                    # Trim payload to the current chunk size
-                    packet_payload = payload[:current_chunk_size]
+    def _call_soon(self, callback: Callable, *args):
+        """Run callback from another thread where the server's state may be changed; here, right away."""
+        callback(*args)
 
-                    # Create packet with header and payload
-                    header = header_base + struct.pack('!Q', segment)
-                    packet = header + packet_payload
+    def _add_udp_session(self, session: UdpSession, generator: PayloadGenerator):
+        """Fill in a session's payload and register it with the scheduler, releasing its reserved slot."""
+        try:
+            session.transmitter.set_payload(generator)
+            if self.egress is not None:
+                session.share = self.egress.open(session.transmitter.datagram_size)
+            session.counters = self.metrics.open('UDP', session.address, session.session_id)
+            # The requested duration counts from here, not from the request, which may have waited for its payload
+            session.transmitter.start()
+            added = self._udp_scheduler.add(session)
+        finally:
+            self._release_udp_reservation()
 
-                    # Send the packet
-                    sock.sendto(packet, address)
+        if not added:
+            if session.share is not None:
+                self.egress.close(session.share)
+            self.metrics.close(session.counters)
+            self.logger.warning("Duplicate UDP request from %s, ignoring...", session.address)
+            return
+        self._udp_wakeup.set()
 
-            self.logger.info(f"Completed UDP transfer of {file_size} bytes to {address}, {self.team_name}")
+    def _close_udp_metrics(self, session: UdpSession):
+        """Bring a UDP session's counters up to date and unregister them."""
+        if session.counters is not None:
+            session.counters.bytes_sent = session.transmitter.bytes_sent
+            session.counters.packets_sent = session.transmitter.sequence
+            self.metrics.close(session.counters)
 
-        except Exception as e:
-            self.logger.error(f"Error handling UDP client {address}: {e}")
+    def _complete_udp_session(self, session: UdpSession):
+        """UdpSessionScheduler callback for a session that finished sending."""
+        if session.share is not None:
+            self.egress.close(session.share)
+        self._close_udp_metrics(session)
+        transmitter = session.transmitter
+        self._record_transfer('UDP', transmitter.bytes_sent)
+        if not transmitter.reliable:
+            self.logger.info(
+                "Completed UDP transfer of %s bytes to %s, %s", transmitter.bytes_sent, session.address,
+                self.team_name, extra=RESULT)
+            return
+
+        with self._stats_lock:
+            self.stats.retransmitted_segments += transmitter.retransmitted
+        completion_time = transmitter.last_sent_at - transmitter.started_at
+        goodput = transmitter.bytes_sent * 8 / completion_time if completion_time > 0 else 0.0
+        ratio = transmitter.retransmitted / transmitter.total_segments if transmitter.total_segments else 0.0
+        self.logger.info(
+            "Completed reliable UDP transfer of %s bytes to %s in %.2f seconds (%.1f bits/second), "
+            "retransmitted %s of %s segments (%.1f%%), %s",
+            transmitter.bytes_sent, session.address, completion_time, goodput,
+            transmitter.retransmitted, transmitter.total_segments, ratio * 100, self.team_name, extra=RESULT)
+
+    def _fail_udp_session(self, session: UdpSession, error: Exception):
+        """UdpSessionScheduler callback for a session that failed."""
+        if session.share is not None:
+            self.egress.close(session.share)
+        self._close_udp_metrics(session)
+        self._record_failure()
+        self.logger.error("Error handling UDP client %s: %s", session.address, error)
+
+    def _open_udp_socket(self) -> socket.socket:
+        """Bind the UDP socket that receives requests and sends every session's payload."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SHARED_UDP_SNDBUF)
+        self._bind_listener(sock, self.udp_port)
+        self._udp_scheduler = UdpSessionScheduler(sock, self._complete_udp_session,
+                                                  self._fail_udp_session)
+        return sock
+
+    def _run_udp_scheduler(self):
+        """Send all UDP sessions from the shared socket until the server is stopped."""
+        while self.running:
+            self._udp_wakeup.clear()
+            delay = self._udp_scheduler.run_once()
+            if delay is None:
+                self._udp_wakeup.wait(1)
+            elif delay > 0:
+                self._udp_wakeup.wait(delay)
 
     def _start_tcp_server(self):
         """Start TCP server to handle client connections.
@@ -198,8 +1733,9 @@ class SpeedTestServer:
             for each new client. Runs until server is stopped.
             """
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.bind(('', self.tcp_port))
-            sock.listen(5)
+            self._bind_listener(sock, self.tcp_port)
+            apply_tcp_tuning(sock, self.tcp_tuning)
+            sock.listen(self.backlog)
 
             while self.running:
                 try:
@@ -212,30 +1748,57 @@ class SpeedTestServer:
                     thread.start()
                 except Exception as e:
                     if self.running:
-                        self.logger.error(f"Error accepting TCP connection: {e}")
+                        self.logger.error("Error accepting TCP connection: %s", e)
 
     def _start_udp_server(self):
         """Start UDP server to handle client requests.
 
-        Listens for incoming UDP requests and spawns handler thread
-        for each new client. Runs until server is stopped.
+        Listens for incoming UDP requests and hands each one to the UDP
+        scheduler thread, which sends every session from this same socket.
+        Runs until server is stopped.
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.bind(('', self.udp_port))
+        with self._open_udp_socket() as sock:
+            scheduler_thread = threading.Thread(target=self._run_udp_scheduler)
+            scheduler_thread.daemon = True
+            scheduler_thread.start()
 
             while self.running:
                 try:
-                    data, address = sock.recvfrom(1024)  # listening to client's udp requests at this channel
-                    thread = threading.Thread(  # initiating a new thread to handle multiple clients simultaneously
-                        target=self._handle_udp_client,
-                        args=(data, address)
-                        # data is the client's request message, address is referring to the client connected to the socket
-                    )
-                    thread.daemon = True
-                    thread.start()
+                    data, address = sock.recvfrom(MAX_NACK_SIZE)  # listening to client's udp requests at this channel
+                    self._handle_udp_client(data, address)
                 except Exception as e:
                     if self.running:
-                        self.logger.error(f"Error handling UDP request: {e}")
+                        self.logger.error("Error handling UDP request: %s", e)
+
+    def serve(self):
+        """Serve TCP and UDP transfers until the server is stopped.
+
+        Launches the TCP and UDP server daemon threads and blocks the
+        calling thread while self.running is set. Does not broadcast offers.
+        """
+        self._start_metrics()
+
+        # Start TCP server thread
+        tcp_thread = threading.Thread(target=self._start_tcp_server)
+        tcp_thread.daemon = True
+        tcp_thread.start()
+
+        # Start UDP server thread
+        udp_thread = threading.Thread(target=self._start_udp_server)
+        udp_thread.daemon = True
+        udp_thread.start()
+
+        try:
+            while self.running:
+                time.sleep(1)
+        finally:
+            self.metrics.stop_endpoint()
+
+    def _start_metrics(self):
+        """Start the metrics endpoint if a metrics port is configured."""
+        if self.metrics_port is not None:
+            self.metrics.start_endpoint(self.metrics_port)
+            self.logger.info("Serving metrics at http://127.0.0.1:%s/metrics", self.metrics_port)
 
     def start(self):
         """Start the speed test server.
@@ -254,27 +1817,393 @@ class SpeedTestServer:
         broadcast_thread.daemon = True
         broadcast_thread.start()
 
-        # Start TCP server thread
-        tcp_thread = threading.Thread(target=self._start_tcp_server)
-        tcp_thread.daemon = True
-        tcp_thread.start()
+        try:
+            self.serve()
+        except KeyboardInterrupt:
+            return
+        finally:
+            self.running = False
 
-        # Start UDP server thread
-        udp_thread = threading.Thread(target=self._start_udp_server)
-        udp_thread.daemon = True
-        udp_thread.start()
 
+class _UdpRequestProtocol(asyncio.DatagramProtocol):
+    """Receives UDP requests on the server's UDP port for AsyncSpeedTestServer."""
+
+    def __init__(self, server: 'AsyncSpeedTestServer'):
+        self.server = server
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.server._handle_udp_client(data, addr)
 
+    def error_received(self, exc: Exception):
+        self.server.logger.error("Error handling UDP request: %s", exc)
+
+
+class AsyncSpeedTestServer(SpeedTestServer):
+    """Speed test server running every transfer on one asyncio event loop.
+
+    Speaks the same wire protocol as SpeedTestServer, but TCP connections are
+    asyncio streams and UDP requests arrive through a DatagramProtocol, so
+    thousands of concurrent transfers need no extra threads. TCP transfers
+    wait for their transport to drain and UDP sessions share the scheduler
+    task's single socket, which keeps memory bounded. Only the offer
+    broadcaster still runs in a thread.
+    """
+
+    async def _serve_tcp_client(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        """Handle one TCP connection; the asyncio counterpart of _handle_tcp_client."""
+        address = writer.get_extra_info('peername')
+        admitted = False
+        share = None
+        counters = None
         try:
-            while True:
+            request = await asyncio.wait_for(reader.readline(), 2)
+            file_size, duration, direction, payload_spec = self._parse_tcp_request(request)
+
+            reason = self._admit('TCP', file_size, duration)
+            if reason is not None:
+                writer.write(self._create_reject_message(reason))
+                await writer.drain()
+                self.logger.warning("Rejected TCP request of %s bytes from %s", file_size, address)
+                return
+            admitted = True
+            counters = self.metrics.open('TCP', address)
+
+            if direction == UPLOAD:
+                writer.write(self._create_ready_message())
+                await writer.drain()
+                started = time.perf_counter()
+                deadline = None if duration is None else started + duration + UPLOAD_GRACE
+                bytes_received, last_byte_at = await self._sink_upload(writer, file_size, deadline, counters)
+                writer.write(self._create_report_message(bytes_received, last_byte_at - started))
+                await writer.drain()
+                self._record_upload(bytes_received)
+                self.logger.info(
+                    "Completed TCP upload of %s bytes from %s,%s", bytes_received, address, self.team_name,
+                    extra=RESULT)
+                return
+
+            payload = self.payload
+            if payload_spec is not None:
+                generator = self._cached_payload(payload_spec)
+                if generator is None:
+                    generator = await asyncio.wrap_future(
+                        self._payload_executor.submit(self._generate_payload, payload_spec))
+                payload = PayloadEngine(self.payload.chunk_size, generator=generator)
+            if self.egress is not None:
+                share = self.egress.open(PACED_CHUNK_SIZE)
+
+            deadline = None if duration is None else time.perf_counter() + duration
+            bytes_sent = await payload.send_async(writer, file_size, share, deadline, counters)
+            self._record_transfer('TCP', bytes_sent)
+
+            self._log_tcp_transfer(bytes_sent, address, writer.get_extra_info('socket'))
+
+        except asyncio.TimeoutError:
+            self._record_failure()
+            self.logger.error("Client %s timed out due to inactivity.", address)
+        except Exception as e:
+            self._record_failure()
+            self.logger.error("Error handling TCP client %s: %s", address, e)
+        finally:
+            if share is not None:
+                self.egress.close(share)
+            if counters is not None:
+                self.metrics.close(counters)
+            if admitted:
+                self._release_tcp_session()
+            writer.close()
+
+    async def _sink_upload(self, writer: asyncio.StreamWriter, nbytes: int, deadline: Optional[float],
+                           counters: Optional[TransferCounters] = None) -> Tuple[int, float]:
+        """Count and discard an upload; the asyncio counterpart of PayloadSink.receive.
+
+        The client only starts sending after the ready message, so nothing
+        is buffered in the stream reader when its protocol is swapped for a
+        _SinkProtocol. The stream protocol is put back once the upload ends.
+
+        Raises:
+            asyncio.TimeoutError: If no data arrives for 2 seconds
+        """
+        transport = writer.transport
+        stream_protocol = transport.get_protocol()
+        sink = _SinkProtocol(self.sink.buffer, transport, nbytes, deadline, counters)
+        transport.set_protocol(sink)
+        try:
+            while not sink.done.done():
+                bytes_received = sink.bytes_received
+                try:
+                    await asyncio.wait_for(asyncio.shield(sink.done), 2)
+                except asyncio.TimeoutError:
+                    if deadline is not None and time.perf_counter() >= deadline:
+                        sink.finish()
+                    elif sink.bytes_received == bytes_received:
+                        raise
+            return sink.done.result()
+        finally:
+            transport.set_protocol(stream_protocol)
+
+    def _call_soon(self, callback: Callable, *args):
+        """Run callback on the event loop."""
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    async def _wait_udp_wakeup(self, timeout: float):
+        """Wait until a UDP session is added or timeout seconds pass."""
+        handle = asyncio.get_running_loop().call_later(timeout, self._udp_wakeup.set)
+        await self._udp_wakeup.wait()
+        handle.cancel()
+
+    async def _wait_writable(self, sock: socket.socket):
+        """Wait until the non-blocking sock can accept more datagrams."""
+        loop = asyncio.get_running_loop()
+        writable = loop.create_future()
+        loop.add_writer(sock.fileno(), writable.set_result, None)
+        try:
+            await writable
+        finally:
+            loop.remove_writer(sock.fileno())
+
+    async def _run_udp_scheduler(self):
+        """Send all UDP sessions from the shared socket; the asyncio counterpart of the scheduler thread."""
+        sock = self._udp_scheduler.sock
+        while self.running:
+            self._udp_wakeup.clear()
+            try:
+                delay = self._udp_scheduler.run_once()
+            except BlockingIOError:
+                await self._wait_writable(sock)
+                continue
+            if delay is None:
+                await self._wait_udp_wakeup(1)
+            elif delay > 0:
+                await self._wait_udp_wakeup(delay)
+            else:
+                # Let TCP transfers run between scheduler passes
+                await asyncio.sleep(0)
+
+    async def _serve(self):
+        """Open the TCP and UDP listeners and serve while self.running is set."""
+        loop = self._loop = asyncio.get_running_loop()
+        tcp_server = await asyncio.start_server(
+            self._serve_tcp_client, port=self.tcp_port, backlog=self.backlog,
+            reuse_port=self.reuse_port or None)
+        for sock in tcp_server.sockets:
+            apply_tcp_tuning(sock, self.tcp_tuning)
+        # Replaces the threading.Event set up by SpeedTestServer.__init__
+        self._udp_wakeup = asyncio.Event()
+        udp_sock = self._open_udp_socket()
+        udp_sock.setblocking(False)
+        udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UdpRequestProtocol(self), sock=udp_sock)
+        scheduler_task = loop.create_task(self._run_udp_scheduler())
+        try:
+            async with tcp_server:
+                while self.running:
+                    await asyncio.sleep(1)
+        finally:
+            scheduler_task.cancel()
+            udp_transport.close()
+
+    def serve(self):
+        """Serve TCP and UDP transfers on an asyncio event loop until the server is stopped."""
+        self._start_metrics()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.metrics.stop_endpoint()
+
+
+def _run_worker(server: SpeedTestServer, worker_id: int,
+                stop_event, results: 'multiprocessing.Queue'):
+    """Entry point of a WorkerPool process.
+
+    Serves on the shared ports until the supervisor sets stop_event, then
+    reports the worker's ServerStats back through results.
+    """
+    # Interrupts are handled by the supervisor, which then sets stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if server.metrics_port is not None:
+        # Each worker has its own registry, so each needs its own port
+        server.metrics_port += worker_id
+    server.running = True
+    serve_thread = threading.Thread(target=server.serve)
+    serve_thread.daemon = True
+    serve_thread.start()
+
+    stop_event.wait()
+    server.running = False
+    with server._stats_lock:
+        results.put((worker_id, server.stats))
+    results.close()
+    results.join_thread()
+    stop_logging()
+
+
+class WorkerPool:
+    """Runs a server's listeners in several forked worker processes.
+
+    Every worker binds the server's TCP and UDP ports with SO_REUSEPORT, so
+    the kernel spreads connections and requests across them. The supervising
+    process only broadcasts offers, stops the workers together on interrupt
+    and logs their combined statistics.
+    """
+
+    STOP_TIMEOUT = 5
+
+    def __init__(self, server: SpeedTestServer, workers: int):
+        """Prepare a pool for server.
+
+        Args:
+            server (SpeedTestServer): Configured server; each worker runs a forked copy
+            workers (int): Number of worker processes
+
+        Raises:
+            ValueError: If workers is not positive
+            OSError: If the platform lacks fork or SO_REUSEPORT
+        """
+        if workers <= 0:
+            raise ValueError("workers must be positive")
+        if not hasattr(socket, 'SO_REUSEPORT') or 'fork' not in multiprocessing.get_all_start_methods():
+            raise OSError("Worker processes need fork and SO_REUSEPORT support")
+        self.server = server
+        self.workers = workers
+        self.logger = server.logger
+
+    def start(self):
+        """Fork the workers and broadcast offers until interrupted, then shut the pool down."""
+        context = multiprocessing.get_context('fork')
+        stop_event = context.Event()
+        results = context.Queue()
+        self.server.reuse_port = True
+
+        # Fork before this process starts a scheduler, executor or serving thread. The logging
+        # listener thread is already running; the at-fork hook resets the logging state in each worker
+        processes: List[multiprocessing.Process] = []
+        for worker_id in range(self.workers):
+            process = context.Process(target=_run_worker,
+                                      args=(self.server, worker_id, stop_event, results))
+            process.start()
+            processes.append(process)
+
+        self.server.running = True
+        broadcast_thread = threading.Thread(target=self.server._broadcast_offers)
+        broadcast_thread.daemon = True
+        broadcast_thread.start()
+
+        try:
+            while all(process.is_alive() for process in processes):
                 time.sleep(1)
+            self.logger.error("A worker process exited unexpectedly, shutting down")
         except KeyboardInterrupt:
-            return
+            pass
+        finally:
+            self.server.running = False
+            expected = sum(process.is_alive() for process in processes)
+            stop_event.set()
+            self._report(self._collect(results, processes, expected))
+
+    def _collect(self, results, processes: List[multiprocessing.Process],
+                 expected: int) -> Dict[int, ServerStats]:
+        """Gather the stats of the expected number of workers and reap the processes."""
+        worker_stats: Dict[int, ServerStats] = {}
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        while len(worker_stats) < expected and time.monotonic() < deadline:
+            try:
+                worker_id, stats = results.get(timeout=max(0.0, deadline - time.monotonic()))
+                worker_stats[worker_id] = stats
+            except queue.Empty:
+                break
+
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        return worker_stats
+
+    def _report(self, worker_stats: Dict[int, ServerStats]):
+        """Log per-worker and aggregated statistics."""
+        total = ServerStats()
+        for worker_id in sorted(worker_stats):
+            stats = worker_stats[worker_id]
+            total.merge(stats)
+            self.logger.info(
+                "Worker %s: %s TCP and %s UDP transfers, %s bytes sent, %s bytes received, "
+                "%s failed, %s rejected",
+                worker_id, stats.tcp_transfers, stats.udp_transfers, stats.bytes_sent, stats.bytes_received,
+                stats.failed_transfers, stats.rejected_requests, extra=RESULT)
+        self.logger.info(
+            "All %s workers: %s TCP and %s UDP transfers, %s bytes sent, %s bytes received, "
+            "%s failed, %s rejected",
+            len(worker_stats), total.tcp_transfers, total.udp_transfers, total.bytes_sent,
+            total.bytes_received, total.failed_transfers, total.rejected_requests, extra=RESULT)
+
+
+SERVER_ENGINES = {
+    'threads': SpeedTestServer,
+    'asyncio': AsyncSpeedTestServer,
+}
 
 
 def main():
-    server = SpeedTestServer("TheIndigenous_server")
-    server.start()
+    parser = argparse.ArgumentParser(description="Network speed test server")
+    parser.add_argument('--team-name', default="TheIndigenous_server")
+    parser.add_argument('--engine', choices=sorted(SERVER_ENGINES), default='threads',
+                        help="threads: one thread per transfer, asyncio: one event loop for all transfers")
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN,
+                        help="TCP accept backlog")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="bytes per TCP send call")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes sharing the ports via SO_REUSEPORT")
+    parser.add_argument('--max-tcp-sessions', type=int,
+                        help="concurrent TCP transfers admitted (per worker)")
+    parser.add_argument('--max-udp-sessions', type=int,
+                        help="concurrent UDP transfers admitted (per worker)")
+    parser.add_argument('--max-request-bytes', type=int,
+                        help="largest file size a single request may ask for")
+    parser.add_argument('--egress-rate', type=int,
+                        help="bits/second shared fairly by all transfers (per worker)")
+    parser.add_argument('--max-duration', type=float,
+                        help="longest duration in seconds a single request may ask for")
+    parser.add_argument('--payload', choices=PAYLOAD_MODES, default='random',
+                        help="payload sent to clients that do not ask for one")
+    parser.add_argument('--payload-ratio', type=float, default=1.0,
+                        help="target compression ratio of the ratio payload")
+    parser.add_argument('--payload-seed', type=int,
+                        help="seed picking the offset into the payload pattern the payload starts at (default random)")
+    parser.add_argument('--tcp-profile', choices=TCP_PROFILES, default='default',
+                        help="socket options of every TCP connection; the options below override it")
+    parser.add_argument('--sndbuf', type=int, help="SO_SNDBUF in bytes for every TCP connection")
+    parser.add_argument('--rcvbuf', type=int, help="SO_RCVBUF in bytes for every TCP connection")
+    parser.add_argument('--tcp-congestion', help="TCP congestion control algorithm, e.g. cubic or bbr")
+    parser.add_argument('--notsent-lowat', type=int, help="TCP_NOTSENT_LOWAT in bytes")
+    parser.add_argument('--mss', type=int, help="TCP maximum segment size in bytes")
+    parser.add_argument('--log-json', metavar='PATH',
+                        help="also append log records to PATH as JSON lines")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics on 127.0.0.1 at this port (worker N uses port + N)")
+    args = parser.parse_args()
+    tcp_tuning = replace(TCP_PROFILES[args.tcp_profile], **{
+        key: value for key, value in (('sndbuf', args.sndbuf), ('rcvbuf', args.rcvbuf),
+                                      ('congestion', args.tcp_congestion),
+                                      ('notsent_lowat', args.notsent_lowat), ('mss', args.mss))
+        if value is not None})
+
+    limits = ServerLimits(args.max_tcp_sessions, args.max_udp_sessions,
+                          args.max_request_bytes, args.egress_rate, args.max_duration)
+    server = SERVER_ENGINES[args.engine](args.team_name, chunk_size=args.chunk_size,
+                                         backlog=args.backlog, limits=limits,
+                                         metrics_port=args.metrics_port,
+                                         payload=PayloadGenerator(args.payload, args.payload_ratio,
+                                                                  args.payload_seed),
+                                         tcp_tuning=tcp_tuning)
+    if args.log_json:
+        add_json_log(server.logger, args.log_json)
+    if args.workers > 1:
+        WorkerPool(server, args.workers).start()
+    else:
+        server.start()
 
 
 if __name__ == "__main__":
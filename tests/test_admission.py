@@ -0,0 +1,31 @@
+import pytest
+
+from speed_test_server import ServerLimits, SpeedTestServer
+
+
+@pytest.fixture
+def server():
+    server = SpeedTestServer('test', limits=ServerLimits(max_udp_sessions=2))
+    sock = server._open_udp_socket()
+    yield server
+    sock.close()
+
+
+def probed_load(server: SpeedTestServer) -> int:
+    return server.PROBE_REPLY_MESSAGE.unpack(server._create_probe_reply(1))[-1]
+
+
+def test_udp_sessions_waiting_for_their_payload_hold_a_slot(server):
+    assert server._admit('UDP', 1000) is None
+    assert server._admit('UDP', 1000) is None
+    assert server._admit('UDP', 1000) == server.REJECT_SERVER_BUSY
+    assert probed_load(server) == 2
+    assert server.stats.rejected_requests == 1
+
+
+def test_released_reservation_frees_the_slot(server):
+    assert server._admit('UDP', 1000) is None
+    assert server._admit('UDP', 1000) is None
+    server._release_udp_reservation()
+    assert probed_load(server) == 1
+    assert server._admit('UDP', 1000) is None
@@ -0,0 +1,57 @@
+from speed_test_client import SegmentBitmap
+
+
+def test_duplicates_and_out_of_range_segments_are_not_counted():
+    segments = SegmentBitmap(10)
+    assert segments.add(3)
+    assert not segments.add(3)
+    assert not segments.add(10)
+    assert segments.received == 1
+    assert segments.frontier == 4
+    assert 3 in segments and 4 not in segments and 10 not in segments
+
+
+def test_complete_only_when_every_segment_arrived():
+    segments = SegmentBitmap(9)
+    for segment in reversed(range(9)):
+        assert not segments.complete
+        segments.add(segment)
+    assert segments.complete
+    assert not SegmentBitmap(0).complete
+
+
+def test_first_missing_skips_full_bytes():
+    segments = SegmentBitmap(40)
+    for segment in range(40):
+        if segment not in (17, 33):
+            segments.add(segment)
+    assert segments.first_missing() == 17
+    assert segments.first_missing(18) == 33
+    assert segments.first_missing(34) == 40
+
+
+def test_first_missing_ignores_padding_bits():
+    segments = SegmentBitmap(5)
+    for segment in range(5):
+        segments.add(segment)
+    assert segments.first_missing() == 5
+
+
+def test_window_copies_whole_bytes():
+    segments = SegmentBitmap(24)
+    segments.add(8)
+    segments.add(15)
+    assert segments.window(1, 2) == bytes([0b10000001, 0])
+
+
+def test_grow_keeps_received_segments():
+    segments = SegmentBitmap(4)
+    segments.add(2)
+    for total in range(5, 100):
+        segments.grow(total)
+        assert segments.total_segments == total
+    assert 2 in segments
+    assert segments.first_missing() == 0
+    assert segments.add(98)
+    segments.grow(50)
+    assert segments.total_segments == 99
@@ -0,0 +1,86 @@
+import logging
+import queue
+
+from speed_test_common import RESULT, _LazyQueueHandler, _LogPipeline, _RateLimitFilter
+
+
+def make_record(args, created=100.0, level=logging.INFO, msg="Sent %s", **extra) -> logging.LogRecord:
+    return logging.makeLogRecord(dict(msg=msg, args=args, levelno=level, levelname=logging.getLevelName(level),
+                                      created=created, **extra))
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_group_passes_its_limit_then_counts_the_rest_on_the_next_window():
+    rate_limit = _RateLimitFilter(limit=2, interval=1.0)
+    passed = [rate_limit.filter(make_record((i,))) for i in range(5)]
+    assert passed == [True, True, False, False, False]
+    record = make_record((5,), created=101.0)
+    assert rate_limit.filter(record)
+    assert record.suppressed == 3
+
+
+def test_repeated_arguments_are_suppressed():
+    rate_limit = _RateLimitFilter(limit=10)
+    assert rate_limit.filter(make_record((1,)))
+    assert not rate_limit.filter(make_record((1,)))
+    assert rate_limit.filter(make_record((2,)))
+
+
+def test_warnings_and_results_are_never_suppressed():
+    rate_limit = _RateLimitFilter(limit=1)
+    assert all(rate_limit.filter(make_record((1,), level=logging.WARNING)) for _ in range(5))
+    assert all(rate_limit.filter(make_record((1,), **RESULT)) for _ in range(5))
+
+
+def test_flush_reports_counts_of_ended_windows_only():
+    rate_limit = _RateLimitFilter(limit=1, interval=1.0)
+    for i in range(4):
+        rate_limit.filter(make_record((i,)))
+    rate_limit.filter(make_record((0,), msg="Other %s", created=100.5))
+    rate_limit.filter(make_record((1,), msg="Other %s", created=100.5))
+    assert rate_limit.flush(100.9) == []
+
+    [record] = rate_limit.flush(101.0)
+    assert (record.args, record.suppressed) == ((3,), 2)
+    assert rate_limit.flush(101.0) == []
+    [record] = rate_limit.flush()
+    assert (record.args, record.suppressed) == ((1,), 0)
+
+
+def test_pipeline_writes_pending_counts_when_closed():
+    handler = ListHandler()
+    pipeline = _LogPipeline(handler)
+    logger = logging.getLogger('test_pipeline_writes_pending_counts_when_closed')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(pipeline.queue_handler)
+    for _ in range(3):
+        logger.info("Same %s", 1)
+    pipeline.close()
+    assert [(record.getMessage(), getattr(record, 'suppressed', 0)) for record in handler.records] == \
+        [("Same 1", 0), ("Same 1", 1)]
+
+
+def test_full_queue_counts_dropped_records():
+    handler = _LazyQueueHandler(queue.Queue(1))
+    for i in range(3):
+        handler.handle(make_record((i,)))
+    handler.queue.get_nowait()
+    record = make_record((3,))
+    handler.handle(record)
+    assert record.dropped == 2
+
+
+def test_reset_after_fork_replaces_a_held_lock():
+    rate_limit = _RateLimitFilter()
+    rate_limit._lock.acquire()
+    rate_limit.reset_after_fork()
+    assert rate_limit.filter(make_record((1,)))
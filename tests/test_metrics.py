@@ -0,0 +1,42 @@
+import pytest
+
+from speed_test_common import PayloadGenerator
+from speed_test_server import PayloadEngine, ServerMetrics, ServerStats
+
+
+def samples(metrics: ServerMetrics) -> dict:
+    return dict(line.rsplit(' ', 1) for line in metrics.render().splitlines() if not line.startswith('#'))
+
+
+def test_scrapes_do_not_change_what_the_next_one_sees():
+    metrics = ServerMetrics(ServerStats())
+    counters = metrics.open('UDP', ('10.0.0.1', 4000), 7)
+    counters.bytes_sent = 1000
+    counters.packets_sent = 1
+    first = samples(metrics)
+    assert samples(metrics) == first
+    assert first['speedtest_session_bytes_sent_total{protocol="udp",client="10.0.0.1:4000",session="7"}'] == '1000'
+
+
+def test_totals_keep_growing_after_a_transfer_closes():
+    metrics = ServerMetrics(ServerStats())
+    counters = metrics.open('TCP', ('10.0.0.1', 4000))
+    counters.bytes_sent = 1000
+    assert samples(metrics)['speedtest_bytes_sent_total'] == '1000'
+    metrics.close(counters)
+    after = samples(metrics)
+    assert after['speedtest_bytes_sent_total'] == '1000'
+    assert not any(name.startswith('speedtest_session_') for name in after)
+
+
+def test_failed_sends_are_counted_where_they_happen():
+    class Broken:
+        def sendall(self, data):
+            raise ConnectionResetError
+
+    metrics = ServerMetrics(ServerStats())
+    counters = metrics.open('TCP', ('10.0.0.1', 4000))
+    engine = PayloadEngine(4096, generator=PayloadGenerator('zeros', size=65536))
+    with pytest.raises(ConnectionResetError):
+        engine.send(Broken(), 10000, counters=counters)
+    assert samples(metrics)['speedtest_send_errors_total'] == '1'
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from speed_test_common import PayloadGenerator
+from speed_test_server import PACED_CHUNK_SIZE, EgressLimiter, PayloadEngine, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, 'perf_counter', clock)
+    return clock
+
+
+def test_bucket_allows_its_burst_then_charges_debt(clock):
+    bucket = TokenBucket(8000, 500)  # 1000 bytes/second
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(250) == pytest.approx(0.25)
+    clock.now += 0.25
+    assert bucket.reserve(0) == 0.0
+
+
+def test_bucket_credits_oversleep_up_to_its_burst(clock):
+    bucket = TokenBucket(8000, 500)
+    bucket.reserve(500)
+    clock.now += 10
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(100) == pytest.approx(0.1)
+
+
+def test_set_rate_leaves_the_balance_to_the_owner(clock):
+    bucket = TokenBucket(8000, 500)
+    bucket.reserve(1500)
+    tokens, last = bucket._tokens, bucket._last
+    bucket.set_rate(16000)
+    assert (bucket._tokens, bucket._last, bucket.rate) == (tokens, last, 1000)
+    # Debt run up at the old rate is repaid at the new one
+    assert bucket.reserve(0) == pytest.approx(0.5)
+
+
+def test_limiter_splits_rate_evenly_and_gives_it_back(clock):
+    limiter = EgressLimiter(8000)
+    first = limiter.open(100)
+    second = limiter.open(100)
+    for share in (first, second):
+        share.reserve(0)
+    assert first.rate == second.rate == 500
+    limiter.close(second)
+    first.reserve(0)
+    assert first.rate == 1000
+    limiter.close(second)
+
+
+def test_paced_transfer_sends_in_slices_of_the_burst():
+    sizes = []
+
+    class Recorder:
+        def sendall(self, data):
+            sizes.append(len(data))
+
+    engine = PayloadEngine(128 * 1024, generator=PayloadGenerator('zeros', size=1024 * 1024))
+    share = TokenBucket(8e12, PACED_CHUNK_SIZE)
+    assert engine.send(Recorder(), 300 * 1024, share) == 300 * 1024
+    assert max(sizes) == PACED_CHUNK_SIZE
@@ -0,0 +1,138 @@
+import socket
+import threading
+import time
+import zlib
+
+import pytest
+
+from speed_test_client import PayloadVerifier
+from speed_test_common import PAYLOAD_MODES, PayloadGenerator, payload_slots
+from speed_test_server import PAYLOAD_HEADER, PayloadEngine, UdpTransmitter
+
+SIZE = 256 * 1024
+
+
+def _receive_udp(transmitter: UdpTransmitter):
+    """Send a whole transfer over loopback and return (segment, payload) of every datagram."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        receiver.bind(('127.0.0.1', 0))
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        receiver.settimeout(1)
+        while not transmitter.done:
+            transmitter.send_batch(sender, receiver.getsockname())
+        datagrams = []
+        for _ in range(transmitter.total_segments):
+            data = receiver.recv(65535)
+            segment = PAYLOAD_HEADER.unpack_from(data)[3]
+            datagrams.append((segment, data[transmitter.header_size:]))
+        return datagrams
+
+
+def _receive_tcp(engine: PayloadEngine, nbytes: int) -> bytes:
+    """Send nbytes from engine over a socket pair and return what arrived."""
+    left, right = socket.socketpair()
+    with right:
+        sender = threading.Thread(target=lambda: (engine.send(left, nbytes), left.close()))
+        sender.start()
+        data = bytearray()
+        while chunk := right.recv(65536):
+            data += chunk
+        sender.join()
+    return bytes(data)
+
+
+@pytest.mark.parametrize('mode', PAYLOAD_MODES)
+@pytest.mark.parametrize('seed', [0, 1, 2 ** 32 - 1])
+def test_tcp_stream_verifies(mode, seed):
+    engine = PayloadEngine(4096, generator=PayloadGenerator(mode, 3.0, seed, size=SIZE))
+    verifier = PayloadVerifier(PayloadGenerator(mode, 3.0, seed, size=SIZE))
+    data = _receive_tcp(engine, SIZE * 2 + 12345)
+    assert len(data) == SIZE * 2 + 12345
+    verifier.update(data)
+    assert verifier.verified
+
+
+def test_tcp_stream_with_another_seed_fails():
+    engine = PayloadEngine(4096, generator=PayloadGenerator('random', seed=1, size=SIZE))
+    verifier = PayloadVerifier(PayloadGenerator('random', seed=2, size=SIZE))
+    verifier.update(_receive_tcp(engine, 10000))
+    assert not verifier.verified
+
+
+@pytest.mark.parametrize('mode', PAYLOAD_MODES)
+@pytest.mark.parametrize('segment_size', [100, 1400, 8000])
+@pytest.mark.parametrize('timestamps', [False, True])
+def test_udp_segments_carry_their_slot(mode, segment_size, timestamps):
+    generator = PayloadGenerator(mode, 2.0, 7, size=SIZE)
+    transmitter = UdpTransmitter(0xabcddcba, 0x4, segment_size * 150 - 3, segment_size,
+                                 timestamps=timestamps, generator=generator)
+    verifier = PayloadVerifier(PayloadGenerator(mode, 2.0, 7, size=SIZE), segment_size)
+    datagrams = _receive_udp(transmitter)
+    assert sorted(segment for segment, _ in datagrams) == list(range(150))
+    for segment, payload in datagrams:
+        verifier.check(segment, payload, transmitter.header_size)
+    assert verifier.verified
+
+
+def test_udp_segment_with_another_slots_payload_fails():
+    generator = PayloadGenerator('random', seed=7, size=SIZE)
+    transmitter = UdpTransmitter(0xabcddcba, 0x4, 1400 * 8, 1400, generator=generator)
+    verifier = PayloadVerifier(PayloadGenerator('random', seed=7, size=SIZE), 1400)
+    datagrams = dict(_receive_udp(transmitter))
+    verifier.check(0, datagrams[1], transmitter.header_size)
+    assert not verifier.verified
+
+
+def test_udp_duration_counts_from_start():
+    transmitter = UdpTransmitter(0xabcddcba, 0x4, 0, 1400, duration=0.05)
+    # e.g. the payload pattern being built before the session is registered
+    time.sleep(0.1)
+    assert transmitter.done
+    transmitter.start()
+    assert not transmitter.done
+
+
+def test_retransmitted_segments_carry_their_slot():
+    generator = PayloadGenerator('random', seed=3, size=SIZE)
+    transmitter = UdpTransmitter(0xabcddcba, 0x4, 1400 * 40, 1400, reliable=True, generator=generator)
+    verifier = PayloadVerifier(PayloadGenerator('random', seed=3, size=SIZE), 1400)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        while transmitter.next_segment < transmitter.total_segments:
+            transmitter.send_batch(sender, receiver.getsockname())
+        for _ in range(40):
+            receiver.recv(65535)
+        transmitter.retransmit([5, 17, 33])
+        while transmitter.has_pending:
+            transmitter.send_batch(sender, receiver.getsockname())
+        for expected in (5, 17, 33):
+            data = receiver.recv(65535)
+            segment = PAYLOAD_HEADER.unpack_from(data)[3]
+            assert segment == expected
+            verifier.check(segment, data[transmitter.header_size:], transmitter.header_size)
+    assert transmitter.retransmitted == 3
+    assert verifier.verified
+
+
+def test_seeds_share_one_pattern():
+    generator = PayloadGenerator('ratio', 4.0, 1, size=SIZE)
+    other = generator.reseeded(2)
+    assert other.pattern is generator.pattern
+    assert other.offset != generator.offset
+    assert other.offset == PayloadGenerator('ratio', 4.0, 2, size=SIZE).offset
+
+
+@pytest.mark.parametrize('ratio', [1.0, 2.0, 8.0])
+def test_ratio_pattern_compresses_by_about_ratio(ratio):
+    pattern = PayloadGenerator('ratio', ratio, size=SIZE).pattern
+    achieved = len(pattern) / len(zlib.compress(pattern))
+    assert ratio * 0.8 < achieved < ratio * 1.2
+
+
+def test_payload_slots_fit_one_batch():
+    assert payload_slots(64025) == 1
+    assert payload_slots(1425) == 32
+    assert payload_slots(125) == 64
@@ -0,0 +1,90 @@
+import socket
+import threading
+import time
+
+from speed_test_client import NACK_HEADER, NACK_INTERVAL, RetransmitRequester, SegmentBitmap
+from speed_test_common import MAX_NACK_SIZE
+from speed_test_server import SpeedTestServer, _missing_segments
+
+
+def requested(messages):
+    """Decode NACK messages the way the server does."""
+    segments = []
+    for message in messages:
+        _, _, _, base, end = NACK_HEADER.unpack_from(message)
+        segments += _missing_segments(memoryview(message)[NACK_HEADER.size:], base, end)
+    return segments
+
+
+def make_requester(total: int, received) -> RetransmitRequester:
+    segments = SegmentBitmap(total)
+    for segment in received:
+        segments.add(segment)
+    return RetransmitRequester(0xabcddcba, 0x7, 1, segments)
+
+
+def test_only_gaps_below_the_frontier_are_requested_while_data_flows():
+    requester = make_requester(100, [0, 1, 4, 5, 9])
+    assert requested(requester.create_messages(10.0, last_packet_time=10.0)) == [2, 3, 6, 7, 8]
+    assert requester.requested == 5
+
+
+def test_tail_is_requested_once_the_server_goes_quiet():
+    requester = make_requester(12, [0, 1, 2, 3, 4, 5, 6, 7, 8])
+    assert requested(requester.create_messages(10.0, last_packet_time=10.0 - NACK_INTERVAL)) == [9, 10, 11]
+
+
+def test_gap_is_not_requested_again_until_its_retransmission_had_a_round_trip():
+    requester = make_requester(100, [0, 3, 20])
+    requester.rtt = 0.1
+    assert requested(requester.create_messages(10.0, 10.0)) == [1, 2] + list(range(4, 20))
+
+    requester.segments.add(30)
+    # Only the new gap is requested before the backoff has passed
+    assert requested(requester.create_messages(10.05, 10.05)) == list(range(21, 30))
+    requester.segments.add(1)
+    assert requested(requester.create_messages(10.0 + requester.backoff, 10.15)) == [2] + list(range(4, 20))
+    assert requester.requested == 2 + 16 + 9 + 1 + 16
+
+
+def test_windows_are_split_at_the_bitmap_size():
+    total = 3 * 8192
+    requester = make_requester(total, [total - 1])
+    messages = requester.create_messages(10.0, 10.0)
+    assert len(messages) == 3
+    assert requested(messages) == list(range(total - 1))
+
+
+def test_complete_transfer_sends_nothing():
+    requester = make_requester(16, range(16))
+    assert requester.create_messages(10.0, 0.0) == []
+
+
+def test_threaded_server_reads_a_whole_nack():
+    server = SpeedTestServer('test')
+    server.running = True
+    threading.Thread(target=server._start_udp_server, daemon=True).start()
+    received = []
+    received_event = threading.Event()
+    deadline = time.monotonic() + 5
+    while getattr(server, '_udp_scheduler', None) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    def retransmit(address, session_id, segments):
+        received.append(segments)
+        received_event.set()
+        return False
+    server._udp_scheduler.retransmit = retransmit
+
+    requester = make_requester(3 * 8192, [3 * 8192 - 1])
+    message = requester.create_messages(10.0, 10.0)[0]
+    assert len(message) == MAX_NACK_SIZE
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto(message, ('127.0.0.1', server.udp_port))
+            assert received_event.wait(5)
+        finally:
+            server.running = False
+            # Wake the request loop so it sees running is cleared
+            sock.sendto(b'', ('127.0.0.1', server.udp_port))
+    assert received == [list(range(8192))]
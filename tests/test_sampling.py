@@ -0,0 +1,27 @@
+from speed_test_client import TransferStats, aggregate_samples, interval_percentiles
+
+
+def test_no_samples_give_zeros():
+    assert interval_percentiles([]) == (0.0, 0.0, 0.0)
+
+
+def test_partial_first_and_last_intervals_are_left_out():
+    samples = [1] + [1000] * 10 + [1]
+    assert interval_percentiles(samples, interval=0.1) == (80000.0, 80000.0, 80000.0)
+
+
+def test_short_transfers_keep_every_interval():
+    assert interval_percentiles([100, 300], interval=1.0) == (800.0, 2400.0, 2400.0)
+
+
+def test_nearest_rank_percentiles():
+    # 100 full intervals of 1..100 bytes between two partial ones
+    samples = [0] + list(range(1, 101)) + [0]
+    assert interval_percentiles(samples, interval=1.0) == (400.0, 760.0, 792.0)
+
+
+def test_aggregate_samples_line_up_by_start_interval():
+    first = TransferStats('TCP', 1, 1.0, 0.0, sample_start=0, samples=[1, 2, 3])
+    second = TransferStats('TCP', 2, 1.0, 0.0, sample_start=2, samples=[10, 20])
+    idle = TransferStats('UDP', 1, 1.0, 0.0)
+    assert aggregate_samples([first, second, idle]) == [1, 2, 13, 20]
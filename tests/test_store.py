@@ -0,0 +1,70 @@
+import sqlite3
+
+import pytest
+
+from speed_test_client import ResultStore, ServerOffer, TransferStats
+
+SERVER = ServerOffer('10.0.0.5', 40001, 40002)
+HOUR = 3600
+
+
+def record(store: ResultStore, started: float, speeds):
+    store.add_round(SERVER, started, len(speeds), 0,
+                    [TransferStats('TCP', i + 1, 1.0, speed) for i, speed in enumerate(speeds)])
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'results.db')
+
+
+def test_percentiles_come_from_the_histograms(path):
+    store = ResultStore(path)
+    record(store, 10 * HOUR, [1e6] * 50 + [2e6] * 45 + [4e6] * 5)
+    store.close()
+
+    stats = ResultStore(path, read_only=True).percentiles('10.0.0.5', 'TCP', 10 * HOUR, 11 * HOUR)
+    assert stats.count == 100
+    assert stats.p50_speed == pytest.approx(1e6, rel=0.05)
+    assert stats.p95_speed == pytest.approx(2e6, rel=0.05)
+    assert stats.p99_speed == pytest.approx(4e6, rel=0.05)
+
+
+def test_empty_window_has_no_percentiles(path):
+    store = ResultStore(path)
+    record(store, 10 * HOUR, [1e6])
+    store.close()
+
+    stats = ResultStore(path, read_only=True).percentiles('10.0.0.5', 'TCP', 20 * HOUR, 21 * HOUR)
+    assert (stats.count, stats.p50_speed) == (0, 0.0)
+
+
+def test_rolling_window_drops_hours_that_leave_it(path):
+    store = ResultStore(path)
+    record(store, 0 * HOUR, [1e6])
+    record(store, 1 * HOUR, [4e6])
+    record(store, 2 * HOUR, [4e6])
+    store.close()
+
+    windows = ResultStore(path, read_only=True).rolling_percentiles(
+        '10.0.0.5', 'TCP', 0, 3 * HOUR, window=2 * HOUR, step=HOUR)
+    assert [window.count for window in windows] == [1, 2, 2]
+    assert windows[-1].p50_speed == pytest.approx(4e6, rel=0.05)
+
+
+def test_opening_does_not_apply_retention(path):
+    store = ResultStore(path)
+    record(store, 0, [1e6])
+    store.close()
+
+    ResultStore(path).close()
+    db = sqlite3.connect(path)
+    try:
+        assert db.execute("SELECT COUNT(*) FROM transfers").fetchone() == (1,)
+    finally:
+        db.close()
+
+
+def test_read_only_store_needs_an_existing_database(path):
+    with pytest.raises(sqlite3.Error):
+        ResultStore(path, read_only=True)
@@ -0,0 +1,57 @@
+import pytest
+
+from speed_test_client import SEQUENCE_MODULUS, PacketTimingAnalyzer
+
+
+def feed(sequences, transit_ns=1000) -> PacketTimingAnalyzer:
+    analyzer = PacketTimingAnalyzer()
+    for i, sequence in enumerate(sequences):
+        analyzer.add(sequence % SEQUENCE_MODULUS, i * 1000, i * 1000 + transit_ns)
+    return analyzer
+
+
+def test_in_order_packets_have_no_loss_or_reordering():
+    result = feed(range(10)).result()
+    assert (result.packets, result.lost_packets, result.reordered_packets) == (10, 0, 0)
+    assert result.jitter == 0.0
+
+
+def test_gaps_are_counted_as_bursts_and_late_packets_as_reordered():
+    analyzer = feed([0, 1, 4, 5, 3, 9])
+    result = analyzer.result()
+    assert result.burst_losses == {2: 1, 3: 1}
+    assert result.lost_packets == 4
+    assert (result.reordered_packets, result.max_reorder_depth) == (1, 2)
+
+
+@pytest.mark.parametrize('start', [SEQUENCE_MODULUS - 3, 5 * SEQUENCE_MODULUS - 1])
+def test_sequence_numbers_unwrap_across_the_modulus(start):
+    analyzer = PacketTimingAnalyzer()
+    analyzer.highest = start - 1
+    for offset in (0, 1, 3, 2, 4, 5):
+        analyzer.add((start + offset) % SEQUENCE_MODULUS, 0, 1000)
+    result = analyzer.result()
+    assert analyzer.highest == start + 5
+    assert result.lost_packets == 0
+    assert result.burst_losses == {1: 1}
+    assert (result.reordered_packets, result.max_reorder_depth) == (1, 1)
+
+
+def test_late_packet_from_before_the_wrap_is_reordered_not_a_jump():
+    analyzer = PacketTimingAnalyzer()
+    analyzer.highest = SEQUENCE_MODULUS - 3
+    analyzer.add(1, 0, 1000)  # wrapped around past three missing packets
+    analyzer.add(SEQUENCE_MODULUS - 1, 0, 1000)
+    result = analyzer.result()
+    assert result.lost_packets == 2
+    assert (result.reordered_packets, result.max_reorder_depth) == (1, 2)
+
+
+def test_delay_variation_is_relative_to_the_fastest_packet():
+    analyzer = PacketTimingAnalyzer()
+    for sequence, transit in enumerate([5000, 7000, 5000, 9000]):
+        analyzer.add(sequence, 0, transit)
+    result = analyzer.result()
+    assert result.delay_variation_max == pytest.approx(4e-6)
+    assert result.delay_variation_mean == pytest.approx(1.5e-6)
+    assert result.jitter > 0